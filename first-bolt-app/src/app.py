@@ -4,6 +4,8 @@ import os
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from dotenv import load_dotenv
+from llm_cache import install_llm_cache
+from slack_outbox import SlackOutbox
 
 # GPT-3.5-turbo
 from langchain.chat_models import ChatOpenAI
@@ -31,6 +33,8 @@ load_dotenv()
 
 # ボットトークンとソケットモードハンドラーを使ってアプリを初期化します
 app = App(token=os.environ.get("SLACK_BOT_TOKEN"))
+# 投稿はキューに積んで別スレッドでレートリミットに合わせて送るので、429のリトライでリスナーが止まらない
+outbox = SlackOutbox(app.client)
 
 # モデル作成
 llm = ChatOpenAI(temperature=0, openai_api_key=os.environ.get("OPEN_API_KEY"))
@@ -74,9 +78,10 @@ chain = LLMChain(llm=llm, prompt=chat_prompt)
 
 @app.event("message")
 def handle_message_events(body, say):
+    say = outbox.wrap(say)
     # メンションの内容を取得
     text = body["event"]["text"]
-    say(text="回答を生成しています。しばらくお待ちください。")
+    say(text="回答を生成しています。しばらくお待ちください。", progress=True)
     # LLMを動作させてチャンネルで発言
     say(chain.run(text=text))
 
@@ -93,4 +98,6 @@ def handle_message_events(body, say):
 
 
 if __name__ == "__main__":
+    # temperature=0の同じプロンプトへの回答は、APIを呼ばずにSQLiteのキャッシュから返す
+    install_llm_cache()
     SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"]).start()
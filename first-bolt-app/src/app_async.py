@@ -0,0 +1,62 @@
+# app.pyのAsyncApp版
+# LLMの応答を待つ間もスレッドを専有しないので、1つのイベントループで多数の会話を同時に扱える
+
+import asyncio
+import os
+
+from dotenv import load_dotenv
+from langchain import LLMChain
+from langchain.chat_models import ChatOpenAI
+from langchain.prompts.chat import (ChatPromptTemplate,
+                                    HumanMessagePromptTemplate,
+                                    SystemMessagePromptTemplate)
+from llm_cache import install_llm_cache
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_bolt.async_app import AsyncApp
+from slack_outbox import AsyncSlackOutbox
+
+# 環境変数を設定
+load_dotenv()
+
+# ボットトークンとソケットモードハンドラーを使ってアプリを初期化します
+app = AsyncApp(token=os.environ.get("SLACK_BOT_TOKEN"))
+# 投稿はチャンネルごとのレートリミットに合わせて送り、429が返ったらRetry-Afterだけ待って送り直す
+outbox = AsyncSlackOutbox(app.client)
+
+# モデル作成
+llm = ChatOpenAI(temperature=0, openai_api_key=os.environ.get("OPEN_API_KEY"))
+
+# 日本語で ChatGPT っぽく丁寧に説明させる
+system_message_prompt = SystemMessagePromptTemplate.from_template("You are an assistant who thinks step by step and includes a thought path in your response. Your answers are in Japanese.")
+# ユーザーからの入力
+human_template = "{text}"
+# User role のテンプレートに
+message_prompt = HumanMessagePromptTemplate.from_template(human_template)
+
+# ひとつのChatTemplateに
+chat_prompt = ChatPromptTemplate.from_messages([system_message_prompt, message_prompt])
+chat_prompt.input_variables = ["text"]
+
+# カスタムプロンプトを入れてchain 化
+chain = LLMChain(llm=llm, prompt=chat_prompt)
+
+
+@app.event("message")
+async def handle_message_events(body, say):
+    say = outbox.wrap(say)
+    # メンションの内容を取得
+    text = body["event"]["text"]
+    await say(text="回答を生成しています。しばらくお待ちください。")
+    # LLMの応答を待つ間は他の会話のイベントを処理する
+    await say(await chain.arun(text=text))
+
+
+async def main():
+    await AsyncSocketModeHandler(app, os.environ["SLACK_APP_TOKEN"]).start_async()
+
+
+# アプリを起動します
+if __name__ == "__main__":
+    # temperature=0の同じプロンプトへの回答は、APIを呼ばずにSQLiteのキャッシュから返す
+    install_llm_cache()
+    asyncio.run(main())
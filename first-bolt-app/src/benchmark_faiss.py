@@ -0,0 +1,232 @@
+"""
+ネットワークに繋がずに実行できる探索のベンチマーク
+OpenAIのAPIは呼ばず、合成したベクトル（または保存済みのembeddingの.npy）をtest_faiss.Testに読み込ませ、
+件数とindexの種類ごとにinit_voronoi_indexerでindexを作って、作成時間・メモリ・QPS・recall@kを計測する
+結果はJSONに書き出すので、CIで前回の結果（--baseline）と比べてrecallやQPSの劣化を検出できる
+
+使い方:
+    python benchmark_faiss.py --sizes 1000,10000,100000 --output benchmark_results.json
+    python benchmark_faiss.py --fixture embeddings.npy --baseline benchmark_baseline.json
+    # CIが比べるbenchmark_baseline.jsonを作り直す（indexの選び方を意図して変えた時）
+    python benchmark_faiss.py --sizes 1000,10000 --dim 256 --queries 200 --output benchmark_baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import faiss
+import numpy as np
+from index_factory import HNSW_M, MIN_POINTS_PER_CENTROID, IndexSpec, index_kind, index_memory_bytes, index_storage, normalize
+from test_faiss import Test
+
+# 合成したベクトルの保存先。同じ件数・次元数・シードなら2回目以降は作り直さずに読み込む
+BENCHMARK_FIXTURE_DIR = os.environ.get("BENCHMARK_FIXTURE_DIR", ".cache/benchmark")
+# text-embedding-ada-002の次元数
+DEFAULT_DIM = 1536
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_KINDS = ["auto", "flat", "ivf", "hnsw"]
+DEFAULT_STORAGES = ["float32", "int8"]
+N_QUERIES = 1000
+K = 10
+# 合成するベクトルのクラスタ数。文書のチャンクは話題ごとに固まるので、一様な乱数よりも実データに近い
+N_CLUSTERS = 100
+# 1クエリずつ探索して応答時間を計測するクエリ数
+LATENCY_QUERIES = 100
+# --baselineと比べて、recallがこれ以上下がるか、QPSがこの割合を下回ったら失敗にする
+# QPSはマシンによって変わるので、別のマシンで作ったbaselineと比べる時は--qps-toleranceで緩める（0なら比べない）
+RECALL_TOLERANCE = 0.02
+QPS_TOLERANCE = float(os.environ.get("BENCHMARK_QPS_TOLERANCE", 0.5))
+
+
+def synthetic_embeddings(n: int, d: int, seed: int = 0, n_clusters: int = N_CLUSTERS) -> np.ndarray:
+    """クラスタの中心の周りに散らばった、長さ1のベクトル群を作る"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, d), dtype="float32")
+    vectors = np.empty((n, d), dtype="float32")
+    # 1Mベクトルでも一時的なメモリが膨らまないよう、少しずつ作る
+    for start in range(0, n, 100000):
+        end = min(start + 100000, n)
+        labels = rng.integers(0, n_clusters, end - start)
+        vectors[start:end] = centers[labels] + rng.standard_normal((end - start, d), dtype="float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def load_fixture(n: int, d: int, seed: int = 0, fixture_dir: str = BENCHMARK_FIXTURE_DIR) -> np.ndarray:
+    """合成したベクトルを.npyに保存し、次回からはメモリマップで読み込む"""
+    path = os.path.join(fixture_dir, f"synthetic_{n}x{d}_seed{seed}.npy")
+    if not os.path.exists(path):
+        os.makedirs(fixture_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.npy"
+        np.save(tmp_path, synthetic_embeddings(n, d, seed))
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
+def make_bot() -> Test:
+    # Slackへの接続やindexの保存先を作らないよう、__init__を呼ばずに探索に必要な属性だけ持たせる
+    bot = Test.__new__(Test)
+    bot.index_spec = None
+    return bot
+
+
+def make_spec(kind: str, n: int, d: int, storage: str) -> Optional[IndexSpec]:
+    """ベンチマークで比べるindexのIndexSpec。"auto"ならNone（choose_index_specに選ばせる）"""
+    if kind == "auto":
+        return None
+    if kind == "ivf":
+        nlist = max(1, min(int(round(np.sqrt(n))), n // MIN_POINTS_PER_CENTROID))
+        return IndexSpec("ivf", d, nlist=nlist, storage=storage)
+    if kind == "hnsw":
+        return IndexSpec("hnsw", d, m=HNSW_M, storage=storage)
+    return IndexSpec(kind, d, storage=storage)
+
+
+def run_case(bot: Test, corpus: np.ndarray, queries: np.ndarray, truth: np.ndarray, kind: str, storage: str, k: int) -> dict:
+    """1つの(件数, indexの種類, 保持形式)の組み合わせを計測する"""
+    n, d = corpus.shape
+    bot.embedding_array = corpus
+    bot.index_spec = make_spec(kind, n, d, storage)
+
+    start = time.perf_counter()
+    bot.init_voronoi_indexer()
+    build_seconds = time.perf_counter() - start
+
+    # 複数のクエリをまとめて探索した時のスループット
+    start = time.perf_counter()
+    _, found = bot.indexer.search(queries, k)
+    search_seconds = time.perf_counter() - start
+
+    # Slackの質問と同じく1クエリずつ探索した時の応答時間
+    latencies = []
+    for query in queries[:LATENCY_QUERIES]:
+        start = time.perf_counter()
+        bot.indexer.search(query[np.newaxis], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    recall = np.mean([len(set(row) & set(expected)) / k for row, expected in zip(found, truth)])
+    tuning = bot.search_tuning
+    return {
+        "n": n,
+        "d": d,
+        "kind": kind,
+        "index": index_kind(bot.indexer),
+        "storage": index_storage(bot.indexer),
+        "nprobe": tuning.nprobe if tuning is not None else None,
+        "ef_search": tuning.ef_search if tuning is not None else None,
+        "build_seconds": build_seconds,
+        "memory_bytes": index_memory_bytes(bot.indexer),
+        "qps": len(queries) / search_seconds,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        f"recall@{k}": float(recall),
+    }
+
+
+def run(sizes: List[int], kinds: List[str], storages: List[str], d: int = DEFAULT_DIM, n_queries: int = N_QUERIES,
+        k: int = K, fixture: Optional[str] = None, seed: int = 0) -> List[dict]:
+    """
+    件数ごとに正解（総当たり探索の上位k件）を求め、indexの種類と保持形式の組み合わせを順に計測する
+
+    Args:
+        sizes (List[int]): indexに入れるベクトルの件数
+        kinds (List[str]): indexの種類（"auto"はchoose_index_specに選ばせる）
+        storages (List[str]): ベクトルの保持形式
+        d (int): 合成するベクトルの次元数
+        n_queries (int): クエリの数
+        k (int): recall@kのk
+        fixture (str): 保存済みのembeddingの.npy。指定すれば合成せずにこれを使う（先頭からn_queries件をクエリにする）
+        seed (int): 合成の乱数シード
+
+    Returns:
+        results (List[dict]): 組み合わせごとの計測結果
+    """
+    if fixture is not None:
+        vectors = np.load(fixture, mmap_mode="r")
+        queries, pool = normalize(vectors[:n_queries]), vectors[n_queries:]
+    else:
+        # クエリはindexに入れるベクトルとは別に、同じ分布から作る
+        queries = synthetic_embeddings(n_queries, d, seed=seed + 1)
+    bot = make_bot()
+    results = []
+    for n in sizes:
+        if fixture is not None:
+            if n > len(pool):
+                print(f"{fixture}には{len(pool)}件しかないので{n}件の計測は飛ばします")
+                continue
+            corpus = normalize(pool[:n])
+        else:
+            corpus = np.ascontiguousarray(load_fixture(n, d, seed))
+        exact = faiss.IndexFlatIP(corpus.shape[1])
+        exact.add(corpus)
+        _, truth = exact.search(queries, k)
+        for kind in kinds:
+            for storage in (storages if kind != "auto" else storages[:1]):
+                result = run_case(bot, corpus, queries, truth, kind, storage, k)
+                print(json.dumps(result, ensure_ascii=False))
+                results.append(result)
+    return results
+
+
+def compare_with_baseline(results: List[dict], baseline: List[dict], k: int = K,
+                          qps_tolerance: float = QPS_TOLERANCE) -> List[str]:
+    """前回の結果と同じ組み合わせを比べ、recallかQPSが許容範囲を超えて下がったものを返す"""
+    previous = {(r["n"], r["d"], r["kind"], r["storage"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result["n"], result["d"], result["kind"], result["storage"]))
+        if before is None:
+            continue
+        name = f"n={result['n']} {result['kind']}/{result['storage']}"
+        if result[f"recall@{k}"] < before[f"recall@{k}"] - RECALL_TOLERANCE:
+            regressions.append(f"{name}: recall@{k} {before[f'recall@{k}']:.3f} -> {result[f'recall@{k}']:.3f}")
+        if result["qps"] < before["qps"] * qps_tolerance:
+            regressions.append(f"{name}: qps {before['qps']:.0f} -> {result['qps']:.0f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FAISSのindexの種類ごとの作成時間・メモリ・QPS・recall@kを計測する")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="ベクトルの件数（カンマ区切り。例: 1000,10000,1000000）")
+    parser.add_argument("--kinds", default=",".join(DEFAULT_KINDS), help="indexの種類（auto, flat, ivf, hnsw）")
+    parser.add_argument("--storages", default=",".join(DEFAULT_STORAGES), help="ベクトルの保持形式（float32, fp16, int8, pq）")
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM, help="合成するベクトルの次元数")
+    parser.add_argument("--queries", type=int, default=N_QUERIES, help="クエリの数")
+    parser.add_argument("-k", type=int, default=K, help="recall@kのk")
+    parser.add_argument("--fixture", help="合成せずに使う保存済みのembeddingの.npy")
+    parser.add_argument("--output", default="benchmark_results.json", help="結果を書き出すJSONファイル")
+    parser.add_argument("--baseline", help="比較する前回の結果のJSONファイル。劣化していれば終了コード1で終わる")
+    parser.add_argument("--qps-tolerance", type=float, default=QPS_TOLERANCE,
+                        help="baselineのQPSのこの割合を下回ったら劣化とみなす（0ならQPSは比べない）")
+    args = parser.parse_args()
+
+    results = run([int(n) for n in args.sizes.split(",")], args.kinds.split(","), args.storages.split(","),
+                  d=args.dim, n_queries=args.queries, k=args.k, fixture=args.fixture)
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {"python": platform.python_version(), "faiss": faiss.__version__, "numpy": np.__version__,
+                        "machine": platform.machine(), "cpus": os.cpu_count()},
+        "k": args.k,
+        "n_queries": args.queries,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"{len(results)}件の結果を{args.output}に書き出しました")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f)["results"], args.k, args.qps_tolerance)
+        for regression in regressions:
+            print(f"劣化: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List
+
+from embedder import EMBEDDING_MODEL
+from utility import get_encoding, num_tokens
+
+# 1チャンクあたりのトークン数の上限
+CHUNK_TOKENS = 400
+# 前後のチャンクと重複させるトークン数。チャンクの境目で文脈が切れないようにする
+CHUNK_OVERLAP = 50
+
+
+@dataclass
+class Chunk:
+    page_number: int
+    text: str
+
+
+def split_page(text: str, page_number: int, max_tokens: int = CHUNK_TOKENS,
+               overlap: int = CHUNK_OVERLAP, model: str = EMBEDDING_MODEL) -> List[Chunk]:
+    """
+    1ページ分のテキストをトークン数の上限に収まるように、前後を少し重複させながら分割するメソッド
+
+    Args:
+        text (str): 1ページ分のテキスト
+        page_number (int): ページ番号（分割後の各チャンクに引き継ぐ）
+        max_tokens (int): 1チャンクあたりのトークン数の上限
+        overlap (int): 隣り合うチャンクで重複させるトークン数
+        model (str): トークン数の計測に使うモデル名
+
+    Returns:
+        chunks (List[Chunk]): 分割したチャンク。空白だけのページは空のリストになる
+    """
+    if not text.strip():
+        return []
+    if num_tokens(text, model) <= max_tokens:
+        return [Chunk(page_number=page_number, text=text)]
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text)
+    chunks = []
+    step = max_tokens - overlap
+    for start in range(0, len(tokens), step):
+        window = tokens[start:start + max_tokens]
+        # 日本語は1文字が複数トークンにまたがることがあるので、境目で切れた文字は捨てる
+        chunk_text = encoding.decode_bytes(window).decode("utf-8", errors="ignore")
+        chunks.append(Chunk(page_number=page_number, text=chunk_text))
+        if start + max_tokens >= len(tokens):
+            break
+    return chunks
+
+
+def iter_chunks(pages_text: Iterable[str], max_tokens: int = CHUNK_TOKENS,
+                overlap: int = CHUNK_OVERLAP, model: str = EMBEDDING_MODEL) -> Iterator[Chunk]:
+    """ページのテキストを受け取った順にチャンクへ分割して返すジェネレータ"""
+    for idx, page_text in enumerate(pages_text):
+        yield from split_page(page_text, idx + 1, max_tokens, overlap, model)
@@ -0,0 +1,72 @@
+from dataclasses import dataclass
+from typing import Iterable, List
+
+from utility import num_tokens
+
+# モデルごとのコンテキストウィンドウのトークン数
+MODEL_CONTEXT_TOKENS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo-16k-0613": 16384,
+    "gpt-4": 8192,
+    "gpt-4-0613": 8192,
+}
+# 回答の生成用に残しておくトークン数
+ANSWER_RESERVE_TOKENS = 1000
+# 探索で取ってくる候補のチャンク数。この中から予算に収まる分だけをLLMに渡す
+N_CANDIDATES = 20
+# https://github.com/openai/openai-cookbook/blob/main/examples/Question_answering_using_embeddings.ipynb
+SEPARATOR = "\n* "
+
+
+@dataclass
+class PackedContext:
+    text: str
+    # 実際に使ったトークン数と予算
+    used_tokens: int
+    budget: int
+    # 詰め込んだチャンク数と候補のチャンク数
+    n_packed: int
+    n_candidates: int
+    # 詰め込んだチャンクの候補内での順位
+    packed_ranks: List[int]
+
+    def __str__(self):
+        return (f"context: {self.used_tokens}/{self.budget} tokens, "
+                f"{self.n_packed}/{self.n_candidates} passages (ranks {self.packed_ranks})")
+
+
+def context_budget(model: str, prompt_tokens: int, answer_reserve: int = ANSWER_RESERVE_TOKENS) -> int:
+    """モデルのコンテキストウィンドウからプロンプトと回答用の分を引いた、参考文書に使えるトークン数"""
+    return max(MODEL_CONTEXT_TOKENS.get(model, 4096) - prompt_tokens - answer_reserve, 0)
+
+
+def pack_context(passages: Iterable[str], budget: int, model: str) -> PackedContext:
+    """
+    関連度の高い順に並んだチャンクを、トークン数の予算がいっぱいになるまで貪欲に詰め込むメソッド
+    予算に収まらないチャンクは飛ばして、後ろの短いチャンクで残りの予算を埋める
+
+    Args:
+        passages (Iterable[str]): 関連度の高い順に並んだチャンクのテキスト
+        budget (int): 参考文書に使えるトークン数
+        model (str): トークン数の計測に使うモデル名
+
+    Returns:
+        packed (PackedContext): 詰め込んだテキストと使ったトークン数
+    """
+    separator_tokens = num_tokens(SEPARATOR, model)
+    texts = []
+    packed_ranks = []
+    used_tokens = 0
+    n_candidates = 0
+    for rank, passage in enumerate(passages):
+        n_candidates += 1
+        cost = separator_tokens + num_tokens(passage, model)
+        if used_tokens + cost > budget:
+            continue
+        texts.append(passage)
+        packed_ranks.append(rank)
+        used_tokens += cost
+    return PackedContext(text="".join(SEPARATOR + text for text in texts), used_tokens=used_tokens, budget=budget,
+                         n_packed=len(texts), n_candidates=n_candidates, packed_ranks=packed_ranks)
@@ -8,20 +8,32 @@ from langchain.chat_models import ChatOpenAI
 from langchain.prompts.chat import (ChatPromptTemplate,
                                     HumanMessagePromptTemplate,
                                     SystemMessagePromptTemplate)
+from llm_cache import install_llm_cache
 from notion_fetcher import NotionWeeklyReportFetcher
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
+from slack_outbox import SlackOutbox
 from tqdm import tqdm
-from utility import ACADEMIC_PERIODS, SlackCallbackHandler
+from utility import ACADEMIC_PERIODS, SlackStreamingHandler
 
 load_dotenv()
 
 
 class CoPyBot:
     def __init__(self):
-        self.app = App(token=os.environ.get("SLACK_BOT_TOKEN"))
+        # temperature=0の同じプロンプトへの回答は、APIを呼ばずにSQLiteのキャッシュから返す（importした時にはファイルを作らない）
+        install_llm_cache()
+        self.app = self.create_slack_app()
+        # 投稿はキューに積み、チャンネルごとのレートリミットに合わせて別スレッドで送る
+        self.outbox = self.create_outbox()
         self.register_listeners()
 
+    def create_slack_app(self):
+        return App(token=os.environ.get("SLACK_BOT_TOKEN"))
+
+    def create_outbox(self):
+        return SlackOutbox(self.app.client)
+
     def create_chain(self, llm):
         system_template = """
         You are an assistant who thinks step by step and includes a thought path in your response.
@@ -70,10 +82,8 @@ class CoPyBot:
         return chain
 
     def get_llm(self, say):
-        def say_function(message):
-            say(message)
-
-        callback_manager = CallbackManager([SlackCallbackHandler(say_function)]) if self.is_streaming else None
+        # ストリーミングモードでは、回答を1つのメッセージに流し込みながら書き換える
+        callback_manager = CallbackManager([SlackStreamingHandler(say, self.outbox)]) if self.is_streaming else None
 
         return ChatOpenAI(temperature=0,
                           openai_api_key=os.environ.get("OPENAI_API_KEY"),
@@ -91,7 +101,7 @@ class CoPyBot:
             return None
 
         if self.is_streaming:
-            say(f"{month}月第{i + 1}週の週報を要約しています...")
+            say(f"{month}月第{i + 1}週の週報を要約しています...", progress=True)
 
         return self.chain.run(month=month, weekly_reports=weekly_reports)
 
@@ -99,59 +109,69 @@ class CoPyBot:
         launch_comment = "各週の内容から１か月分の要約を作成中..."
         print(launch_comment)
         if self.is_streaming:
-            say(launch_comment)
+            say(launch_comment, progress=True)
 
         concat_summary = " ".join(summaries)
         monthly_report = self.chain.run(month=month, weekly_reports=concat_summary)
         return monthly_report
 
+    def mode_selection_message(self):
+        text = "こんにちは。co-py-bot だよ。\nストリーミングモードで実行する？"
+        return {
+            "blocks": [
+                {
+                    "type": "section",
+                    "block_id": "section677",
+                    "text": {"type": "mrkdwn", "text": text},
+                    "accessory": {
+                        "action_id": "mode_selection",
+                        "type": "static_select",
+                        "placeholder": {"type": "plain_text", "text": "選択してください"},
+                        "options": [{"text": {"type": "plain_text", "text": "はい"}, "value": "1"}, {"text": {"type": "plain_text", "text": "いいえ"}, "value": "0"}],
+                    },
+                }
+            ],
+            "text": text,
+        }
+
+    def month_selection_message(self):
+        text = "マンスリーレビューを作成したい対象月を選んでね。"
+        return {
+            "blocks": [
+                {
+                    "type": "section",
+                    "block_id": "section678",
+                    "text": {"type": "mrkdwn", "text": text},
+                    "accessory": {
+                        "action_id": "month_selection",
+                        "type": "static_select",
+                        "placeholder": {"type": "plain_text", "text": "対象月を選択"},
+                        "options": [{"text": {"type": "plain_text", "text": f"{month}月"}, "value": str(month)} for month in range(1, 13)],
+                    },
+                }
+            ],
+            "text": text,
+        }
+
     def register_listeners(self):
         @self.app.message(re.compile("(週報要約|マンスリーレビュー作って|たのむ|たのんだ)"))
         def message_streamling_mode_selection(say):
-            text = "こんにちは。co-py-bot だよ。\nストリーミングモードで実行する？"
-            say(
-                blocks=[
-                    {
-                        "type": "section",
-                        "block_id": "section677",
-                        "text": {"type": "mrkdwn", "text": text},
-                        "accessory": {
-                            "action_id": "mode_selection",
-                            "type": "static_select",
-                            "placeholder": {"type": "plain_text", "text": "選択してください"},
-                            "options": [{"text": {"type": "plain_text", "text": "はい"}, "value": "1"}, {"text": {"type": "plain_text", "text": "いいえ"}, "value": "0"}],
-                        },
-                    }
-                ],
-                text=text,
-            )
+            say = self.outbox.wrap(say)
+            say(**self.mode_selection_message())
 
         @self.app.action("mode_selection")
         def message_month_selection(body, ack, say):
             ack()
+            say = self.outbox.wrap(say)
             self.is_streaming = int(body["actions"][0]["selected_option"]["value"])
 
-            text = "マンスリーレビューを作成したい対象月を選んでね。"
-            say(
-                blocks=[
-                    {
-                        "type": "section",
-                        "block_id": "section678",
-                        "text": {"type": "mrkdwn", "text": text},
-                        "accessory": {
-                            "action_id": "month_selection",
-                            "type": "static_select",
-                            "placeholder": {"type": "plain_text", "text": "対象月を選択"},
-                            "options": [{"text": {"type": "plain_text", "text": f"{month}月"}, "value": str(month)} for month in range(1, 13)],
-                        },
-                    }
-                ],
-                text=text,
-            )
+            say(**self.month_selection_message())
 
         @self.app.action("month_selection")
         def make_monthly_review(body, ack, say):
             ack()
+            # 週ごとの途中経過や回答の書き換えが続くので、送信を待たずに要約の生成を進める
+            say = self.outbox.wrap(say)
 
             month = body["actions"][0]["selected_option"]["value"]
             period = ACADEMIC_PERIODS[month]
@@ -167,7 +187,9 @@ class CoPyBot:
                     print(weekly_summary)
 
             monthly_report = self.monthly_summary(summaries, month, say)
-            say(monthly_report)
+            # ストリーミングモードでは、回答はもうメッセージに流し込まれている
+            if not self.is_streaming:
+                say(monthly_report)
             print("Done!")
 
     def start(self):
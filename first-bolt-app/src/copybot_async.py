@@ -0,0 +1,104 @@
+import asyncio
+import os
+import re
+
+from copybot import CoPyBot
+from langchain.callbacks.manager import AsyncCallbackManager
+from langchain.chat_models import ChatOpenAI
+from notion_fetcher import AsyncNotionWeeklyReportFetcher
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_bolt.async_app import AsyncApp
+from slack_outbox import AsyncSlackOutbox
+from utility import ACADEMIC_PERIODS, AsyncSlackStreamingHandler
+
+
+class AsyncCoPyBot(CoPyBot):
+    """
+    CoPyBotのAsyncApp版
+    LLM・Notion・Slackの呼び出しを全てawaitするので、要約の生成を待つ間もOSのスレッドを専有せず、
+    1つのイベントループで多数の会話を同時に扱える。週ごとの要約も並行して生成する
+    """
+    def create_slack_app(self):
+        return AsyncApp(token=os.environ.get("SLACK_BOT_TOKEN"))
+
+    def create_outbox(self):
+        # 送信はイベントループの中でawaitするので、スレッドを持たないasync版の送信キューでレートリミットに合わせる
+        return AsyncSlackOutbox(self.app.client)
+
+    def get_llm(self, say):
+        callback_manager = AsyncCallbackManager([AsyncSlackStreamingHandler(say, self.outbox)]) if self.is_streaming else None
+
+        return ChatOpenAI(temperature=0,
+                          openai_api_key=os.environ.get("OPENAI_API_KEY"),
+                          model_name="gpt-3.5-turbo",
+                          streaming=self.is_streaming,
+                          callback_manager=callback_manager)
+
+    async def aweekly_summary(self, chain, month, i, weekly_reports, say):
+        if not weekly_reports:
+            return None
+
+        if self.is_streaming:
+            await say(f"{month}月第{i + 1}週の週報を要約しています...")
+
+        return await chain.arun(month=month, weekly_reports=weekly_reports)
+
+    async def amonthly_summary(self, chain, summaries, month, say):
+        launch_comment = "各週の内容から１か月分の要約を作成中..."
+        print(launch_comment)
+        if self.is_streaming:
+            await say(launch_comment)
+
+        concat_summary = " ".join(summaries)
+        return await chain.arun(month=month, weekly_reports=concat_summary)
+
+    def register_listeners(self):
+        @self.app.message(re.compile("(週報要約|マンスリーレビュー作って|たのむ|たのんだ)"))
+        async def message_streamling_mode_selection(say):
+            say = self.outbox.wrap(say)
+            await say(**self.mode_selection_message())
+
+        @self.app.action("mode_selection")
+        async def message_month_selection(body, ack, say):
+            await ack()
+            say = self.outbox.wrap(say)
+            self.is_streaming = int(body["actions"][0]["selected_option"]["value"])
+
+            await say(**self.month_selection_message())
+
+        @self.app.action("month_selection")
+        async def make_monthly_review(body, ack, say):
+            await ack()
+            say = self.outbox.wrap(say)
+
+            month = body["actions"][0]["selected_option"]["value"]
+            period = ACADEMIC_PERIODS[month]
+            await say(f"了解。{month}月の週報をもとにマンスリーレビュー資料をまとめるね。少し待ってね。")
+
+            # 会話ごとにchainを作る（self.chainに持つと、同時に動いている他の会話のchainを上書きしてしまう）
+            chain = self.create_chain(self.get_llm(say))
+
+            # Notionのデータベースは1回だけ取得し、週ごとの要約は並行して生成する（gatherは週の順番のまま結果を返す）
+            client = AsyncNotionWeeklyReportFetcher(os.environ.get("NOTION_API_KEY"))
+            weekly_reports = await client.fetch_records_for_weeks(period.quarter, period.weeks)
+            weekly_summaries = await asyncio.gather(
+                *(self.aweekly_summary(chain, month, i, reports, say) for i, reports in enumerate(weekly_reports)))
+            summaries = [summary for summary in weekly_summaries if summary is not None]
+            for summary in summaries:
+                print(summary)
+
+            monthly_report = await self.amonthly_summary(chain, summaries, month, say)
+            if not self.is_streaming:
+                await say(monthly_report)
+            print("Done!")
+
+    async def start_async(self):
+        await AsyncSocketModeHandler(self.app, os.environ["SLACK_APP_TOKEN"]).start_async()
+
+    def start(self):
+        asyncio.run(self.start_async())
+
+
+if __name__ == "__main__":
+    bot = AsyncCoPyBot()
+    bot.start()
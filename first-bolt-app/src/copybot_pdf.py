@@ -1,49 +1,93 @@
-import io
 import os
 import re
-from dataclasses import dataclass
-from typing import List
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import faiss
-import numpy as np
 import openai
-import pandas as pd
 import requests
+from chunker import iter_chunks
+from context_packer import ANSWER_RESERVE_TOKENS, N_CANDIDATES, context_budget, pack_context
+from corpus import CorpusManager
 from dotenv import load_dotenv
+from embedder import BatchEmbedder
+from embedding_cache import normalize_text
+from file_downloader import MAX_FILE_BYTES, FileTooLargeError, download_slack_file
+from index_factory import build_index, index_storage, normalize, tune_search
+from index_store import INDEX_STORE_DIR, IndexStore, document_hash, make_document_key
+from ingestion_queue import IngestionJob, IngestionQueue
 from langchain import LLMChain
 from langchain.callbacks.manager import CallbackManager
 from langchain.chat_models import ChatOpenAI
 from langchain.prompts.chat import (ChatPromptTemplate,
                                     HumanMessagePromptTemplate,
                                     SystemMessagePromptTemplate)
-from openai.embeddings_utils import get_embedding
-from pdfminer.high_level import extract_pages, extract_text
-from pdfminer.layout import LTTextContainer
+from lexical_index import LexicalIndex, extract_exact_terms, normalize_for_match, reciprocal_rank_fusion
+from llm_cache import install_llm_cache
+from page_store import PageStore
+from pdf_reader import iter_page_text
 from pdfminer.pdfparser import PDFSyntaxError
+from query_cache import ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, TTLCache
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
+from slack_outbox import SlackOutbox
 from slack_sdk.errors import SlackApiError
-from tqdm import tqdm
-from utility import SlackCallbackHandler, num_tokens
+from utility import SlackStreamingHandler, num_tokens
 
 load_dotenv()
 openai.api_key = os.environ.get("OPENAI_API_KEY")
 
+# まとめて質問された時に同時に回答を生成する数（ChatOpenAIのレートリミットに合わせて調整する）
+MAX_CONCURRENT_ANSWERS = int(os.environ.get("MAX_CONCURRENT_ANSWERS", 4))
+# 「1. 」「(2)」「③」「Q4:」のように番号の付いた行を1つの質問とみなす（「2023年」や「1.5倍」のような行頭の数字は番号とみなさない）
+NUMBERED_QUESTION_PATTERN = re.compile(
+    r"^\s*(?:[QＱ]\s*[0-9０-９]+\s*[.．)）:：、]?|[(（][0-9０-９]+[)）]|[0-9０-９]+\s*(?:[.．](?![0-9０-９])|[)）:：、])|[①-⑳])\s*(\S.*)$",
+    re.MULTILINE | re.IGNORECASE)
 
-# PDFの各ページの情報を管理するためのデータクラス
-@dataclass
-class Page:
-    page_number: int
-    text: str
-    embedding: List[float]
+
+def split_numbered_questions(text):
+    """
+    番号の付いた行を質問として取り出す
+
+    Args:
+        text (str): Slackのメッセージ
+
+    Returns:
+        questions (List[str]): 番号順に並んだ質問。番号の付いた行が無ければ空のリスト
+    """
+    return [question.strip() for question in NUMBERED_QUESTION_PATTERN.findall(text)]
 
 
 class CoPyBotPDF:
     def __init__(self):
-        self.slack_app = App(token=os.environ.get("SLACK_BOT_TOKEN"))
+        self.slack_app = self.create_slack_app()
+        # 投稿はキューに積み、チャンネルごとのレートリミットに合わせて別スレッドで送る
+        self.outbox = self.create_outbox()
         self.register_listeners()
         self.model_name = "gpt-3.5-turbo-0613"
         self.n_trials = 0
+        # 回答の生成用に残しておくトークン数。残りから質問のプロンプトを引いた分を参考文書に使う
+        self.answer_reserve_tokens = ANSWER_RESERVE_TOKENS
+        self.last_context = None
+        # まとめて質問された時は回答をワーカーで並行して生成するので、n_trialsとlast_contextの更新を直列化する
+        self.trial_lock = threading.Lock()
+        # init_voronoi_indexerで作るindexの種類。Noneなら自動で選ぶ
+        self.index_spec = None
+        self.embedder = BatchEmbedder()
+        # (チャンネル, ドキュメント)ごとのindexを管理する。indexはディスクに保存し、質問が来た時に遅延してメモリマップで読み込む
+        # ベクトルの次元数や空間はプロバイダごとに違うので、保存先もプロバイダ（のモデル名）ごとに分ける
+        self.corpus = CorpusManager(IndexStore(os.path.join(INDEX_STORE_DIR, self.embedder.model)))
+        # (ドキュメントの中身のハッシュ, 正規化した質問, モデル名)ごとの回答。同じ質問ならAPIを呼ばずに返す
+        self.answer_cache = TTLCache("answer cache", ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+        # 回答のキャッシュに無くても、展開後のプロンプトが同じならLLMの応答はSQLiteのキャッシュから返る
+        self.llm_cache = install_llm_cache()
+        # PDFの読み込みはBoltのリスナーではなく、専用のワーカーで実行する
+        self.ingestion_queue = IngestionQueue(self.ingest)
+
+    def create_slack_app(self):
+        return App(token=os.environ.get("SLACK_BOT_TOKEN"))
+
+    def create_outbox(self):
+        return SlackOutbox(self.slack_app.client)
 
     def create_chain(self, llm):
         system_template = """
@@ -68,11 +112,9 @@ class CoPyBotPDF:
 
         return chain
 
-    def get_llm(self, say):
-        def say_function(message):
-            say(message)
-
-        callback_manager = CallbackManager([SlackCallbackHandler(say_function)]) if self.is_streaming else None
+    def get_llm(self, say, prefix=""):
+        # ストリーミングモードでは、回答を1つのメッセージに流し込みながら書き換える（prefixはメッセージの先頭に付ける見出し）
+        callback_manager = CallbackManager([SlackStreamingHandler(say, self.outbox, prefix=prefix)]) if self.is_streaming else None
 
         return ChatOpenAI(temperature=0,
                           openai_api_key=os.environ.get("OPENAI_API_KEY"),
@@ -80,45 +122,66 @@ class CoPyBotPDF:
                           streaming=self.is_streaming,
                           callback_manager=callback_manager)
 
+    def mode_selection_message(self):
+        text = "こんにちは。co-py-bot だよ。\nストリーミングモードで実行する？"
+        return {
+            "blocks": [
+                {
+                    "type": "section",
+                    "block_id": "section677",
+                    "text": {"type": "mrkdwn", "text": text},
+                    "accessory": {
+                        "action_id": "mode_selection",
+                        "type": "static_select",
+                        "placeholder": {"type": "plain_text", "text": "選択してください"},
+                        "options": [{"text": {"type": "plain_text", "text": "はい"}, "value": "1"}, {"text": {"type": "plain_text", "text": "いいえ"}, "value": "0"}],
+                    },
+                }
+            ],
+            "text": text,
+        }
+
+    def mode_selected_message(self):
+        if self.is_streaming:
+            return "了解。ストリーミングモードで実行するね。\n準備はできたよ。要約して欲しいPDFファイル(.pdf)を投稿してね。"
+        return "了解。ストリーミングモードはオフで実行するね。\n準備はできたよ。要約して欲しいPDFファイル(.pdf)を投稿してね。"
+
     def register_listeners(self):
         @self.slack_app.message(re.compile("(PDF|pdf喰ってね|よろしく)"))
         def message_streamling_mode_selection(say):
-            text = "こんにちは。co-py-bot だよ。\nストリーミングモードで実行する？"
-            say(
-                blocks=[
-                    {
-                        "type": "section",
-                        "block_id": "section677",
-                        "text": {"type": "mrkdwn", "text": text},
-                        "accessory": {
-                            "action_id": "mode_selection",
-                            "type": "static_select",
-                            "placeholder": {"type": "plain_text", "text": "選択してください"},
-                            "options": [{"text": {"type": "plain_text", "text": "はい"}, "value": "1"}, {"text": {"type": "plain_text", "text": "いいえ"}, "value": "0"}],
-                        },
-                    }
-                ],
-                text=text,
-            )
+            say = self.outbox.wrap(say)
+            say(**self.mode_selection_message())
 
         @self.slack_app.action("mode_selection")
         def message_ryokai(body, ack, say):
             ack()
+            say = self.outbox.wrap(say)
             self.is_streaming = int(body["actions"][0]["selected_option"]["value"])
-            if self.is_streaming:
-                say("了解。ストリーミングモードで実行するね。\n準備はできたよ。要約して欲しいPDFファイル(.pdf)を投稿してね。")
-            else:
-                say("了解。ストリーミングモードはオフで実行するね。\n準備はできたよ。要約して欲しいPDFファイル(.pdf)を投稿してね。")
+            say(self.mode_selected_message())
 
         @self.slack_app.message(re.compile("(質問だよ|聞くね)"))
         def recieve_question_about_pdf(body, say):
-            say("なるほど。良い質問だね。回答を考えるからちょっと待ってね。")
+            say = self.outbox.wrap(say)
+            say("なるほど。良い質問だね。回答を考えるからちょっと待ってね。", progress=True)
             query = body["event"]["text"]
             print("query: ", query)
-            self.answer_about_pdf(query, say)
+            # このチャンネルのPDFを読み込み中なら、失敗にせず読み込みが終わるのを待ってから回答する
+            if not self.wait_for_ingestion(body["event"]["channel"], say):
+                return
+            # 番号付きで複数の質問が来た場合はまとめて処理し、回答は質問ごとにスレッドに返す
+            questions = split_numbered_questions(query)
+            if len(questions) > 1:
+                self.answer_batch_about_pdf(questions, say, body["event"]["channel"], body["event"]["ts"])
+            else:
+                self.answer_about_pdf(query, say, body["event"]["channel"])
+
+        @self.slack_app.message(re.compile("キャッシュの状況"))
+        def report_cache_stats(say):
+            say = self.outbox.wrap(say)
+            say(self.cache_stats())
 
         @self.slack_app.event("message")
-        def handle_file_share_events(body, say, client):
+        def handle_file_share_events(body):
             # eventのsubtypeがfile_shareでない場合、メソッドを抜ける
             if "subtype" not in body["event"] or body["event"]["subtype"] != "file_share":
                 return
@@ -126,41 +189,48 @@ class CoPyBotPDF:
                 self.is_streaming
             except AttributeError:
                 self.is_streaming = 0
-            say("ファイルを受け取ったよ。なかなか良いドキュメントだね。まずは内容を頭に入れるからちょっと待ってね。")
+            # ダウンロード・parse・embeddingには数分かかることがあるので、ジョブを積むだけですぐに戻る
             event = body["event"]
-            try:
-                self.process_file_share(event, say, client)
-            except KeyError:
-                pass
+            self.ingestion_queue.submit(IngestionJob(self.outbox, event["channel"], event))
 
-    def init_voronoi_indexer(self):
+    def ingest(self, job):
         """
-        クラスタリングによってデータ空間をボロノイ領域に分割することにより
-        高速な近傍探索を可能にするためのindexerを初期化するメソッド
-        ボロノイ領域の紹介はこちら --> https://ja.wikipedia.org/?curid=91418
-        このアルゴリズムでは質問クエリに対して、その周辺領域のみで探索できるので
-        総当たりせずに済むので探索にかかる時間を大幅に短縮できる
+        IngestionQueueのワーカーで1つのPDFを読み込むメソッド。メッセージは全てジョブのステータスメッセージに書く
+        ジョブのclientは送信キューなので、files.infoなどの読み出しには送信キューの下のWebClientを使う
+        例外はここで握りつぶさず、IngestionQueue.runに任せてログと失敗のステータスメッセージに残す
         """
+        self.process_file_share(job.event, job.say, self.outbox.client, job)
 
-        # 30ページを超える分量の多いPDFファイルに適用
-        n_pages = len(self.embedding_array)
-        if n_pages > 30:
-            # ボロノイ領域の数
-            # クラスタリング空間を定義する量子化器（Quantizer）つくる（L2ノルム）
-            self.quantizer = faiss.IndexFlatL2(1536)
-            # 下記引数の1536はembeddingの次元数、20はボロノイ領域の数（ボロノイの数は増やすと精度上がって処理時間増えるトレードオフ）
-            # embeddingの次元数は`text-embedding-ada-002`以外を使う場合には変更が必要。BERT-baseなら768次元など。
-            self.indexer = faiss.IndexIVFFlat(self.quantizer, 1536, 20)
-            # ベクトルデータベースからボロノイ領域を生成
-            self.indexer.train(self.embedding_array)
-            # ボロノイ領域にデータを追加
-            self.indexer.add(self.embedding_array)
-        else:
-            # 分量の少ないテキストデータに対しては総当たり探索でも問題ないので
-            # 単体のL2ノルムアルゴリズムを使う。
-            self.indexer = faiss.IndexFlatL2(1536)
-            # データを追加
-            self.indexer.add(self.embedding_array)
+    def wait_for_ingestion(self, channel, say):
+        """
+        チャンネルで読み込み中のPDFがあれば、読み込みが終わるまで待つメソッド
+
+        Args:
+            channel (str): 質問が投稿されたチャンネルのid
+            say: Boltのsay
+
+        Returns:
+            ready (bool): 読み込みが終わって質問に回答できる状態ならTrue
+        """
+        if not self.ingestion_queue.pending(channel):
+            return True
+        say("いまPDFを読み込んでいるところだから、読み終わったら回答するね。", progress=True)
+        if self.ingestion_queue.wait_for_channel(channel):
+            return True
+        say("ごめんね。PDFの読み込みに時間がかかっているみたい。読み込みが終わってからもう一度質問してね。")
+        return False
+
+    def init_voronoi_indexer(self):
+        """
+        self.embedding_array全体に対してボロノイ探索のためのindexerを初期化するメソッド
+        self.index_specがNoneなら、件数とメモリの目安からindexの種類を自動で選ぶ
+        （Slackからの質問はCorpusManagerがチャンネルごとのindexで探索する。こちらは単一ドキュメントの動作確認用）
+        """
+        self.indexer = build_index(self.embedding_array, self.index_spec)
+        # IVFならnprobe、HNSWならefSearchを、目標のrecallを満たす最小の値にする
+        self.search_tuning = tune_search(self.indexer, self.embedding_array)
+        if self.search_tuning is not None:
+            print(self.search_tuning)
 
     def voronoi_diagram_search(self, query_embedding):
         """
@@ -170,81 +240,239 @@ class CoPyBotPDF:
             query_embedding (np.ndarray): 質問クエリをembeddingしたやつ
 
         Returns:
-            top_n_pages (pandas.DataFrame): 上位n件のテキスト情報を格納したデータフレーム
+            top_n_pages (List[PageRow]): 上位n件のテキスト情報
         """
         # 近傍探索の実行。
-        query_embedding = np.array([query_embedding]).astype("float32")
-        _, idx = self.indexer.search(query_embedding, 3)
-        return self.pages_df.iloc[idx[0]]
+        query_embedding = normalize(query_embedding)
+        distances, idx = self.indexer.search(query_embedding, 3)
+        return self.page_store.rows(idx[0], distances[0])
+
+    def answer_cache_key(self, question, channel):
+        """チャンネルのドキュメントの中身・正規化した質問・モデル名から回答のキャッシュのキーを作る"""
+        hashes = tuple(sorted(document_hash(key) for key in self.corpus.document_keys(channel)))
+        return hashes, normalize_text(question), self.model_name
+
+    def cache_stats(self):
+        stats = [self.answer_cache.stats(), self.llm_cache.stats()]
+        if self.embedder.query_cache is not None:
+            stats.append(self.embedder.query_cache.stats())
+        if self.embedder.cache is not None:
+            stats.append(self.embedder.cache.stats())
+        return "\n".join(stats)
+
+    def retrieve(self, query, channel):
+        """質問が投稿されたチャンネルのPDFだけを対象に、質問に関連するチャンクを上位N_CANDIDATES件探すメソッド"""
+        return self.retrieve_many([query], channel)[0]
+
+    def retrieve_many(self, queries, channel):
+        """
+        質問が投稿されたチャンネルのPDFだけを対象に、質問ごとに関連するチャンクを上位N_CANDIDATES件探すメソッド
+        転置インデックスによるBM25の探索とボロノイ探索の結果をReciprocal Rank Fusionで統合する
+        質問に型番や「」で囲まれた語があり、それを全て含むチャンクがBM25で見つかった場合は、embeddingを呼ばずにそれを返す
+        残りの質問はまとめて1回でembeddingし、indexの探索も(質問数, 次元数)の行列で1回だけ行う
 
-    def answer_about_pdf(self, query, say):
-        # query文字列とそのembedding
-        query_embedding = get_embedding(query, engine="text-embedding-ada-002")
+        Args:
+            queries (List[str]): 質問文
+            channel (str): 質問が投稿されたチャンネルのid
 
-        # 初回応答時のみボロノイ探索のためのindexerを初期化
-        if self.n_trials == 0:
-            self.init_voronoi_indexer()
+        Returns:
+            candidates (List[List[PageRow]]): 質問ごとに関連度の高い順に並べたチャンク
+        """
+        results = [None] * len(queries)
+        lexical = [self.corpus.lexical_search(channel, query, N_CANDIDATES) for query in queries]
+        for i, query in enumerate(queries):
+            exact_terms = extract_exact_terms(query)
+            if exact_terms:
+                exact = [row for row in lexical[i] if all(term in normalize_for_match(row.text) for term in exact_terms)]
+                if exact:
+                    print(f"{exact_terms}に完全一致するチャンクが{len(exact)}件見つかったのでembeddingを省略します")
+                    results[i] = exact
+
+        remaining = [i for i, result in enumerate(results) if result is None]
+        if remaining:
+            # query文字列とそのembedding
+            query_embeddings = self.embedder.embed_queries([queries[i] for i in remaining])
+            vectors = self.corpus.search_many(channel, query_embeddings, N_CANDIDATES)
+            for i, vector in zip(remaining, vectors):
+                results[i] = reciprocal_rank_fusion([vector, lexical[i]])[:N_CANDIDATES]
+        return results
+
+    def prepare_answer(self, question, candidates, say, prefix=""):
+        """回答を生成するchainと、トークン数の予算に収まるように詰め込んだ参考文書を用意するメソッド"""
+        for row in candidates:
+            print(f"\nPage {row.page_number}):")
 
-        # ボロノイ探索を実行。上位3件のテキストを取得
-        top_n_pages = self.voronoi_diagram_search(query_embedding)
+        # プロンプトと回答の分を除いたトークン数の予算に収まるだけ、関連度の高い順にチャンクを詰め込む
+        chain = self.create_chain(self.get_llm(say, prefix))
+        prompt_tokens = num_tokens(chain.prompt.format(pdf_content="", query=question), self.model_name)
+        budget = context_budget(self.model_name, prompt_tokens, self.answer_reserve_tokens)
+        context = pack_context([row.text for row in candidates], budget, self.model_name)
+        # 使ったトークン数を記録しておき、応答速度と回答の質のバランスを調整する材料にする
+        print(context)
+        with self.trial_lock:
+            self.last_context = context
+        return chain, context
+
+    def generate_answer(self, question, candidates, say, prefix=""):
+        """関連するチャンクを参考文書にしてLLMで回答を生成するメソッド。prefixはストリーミングするメッセージの先頭に付ける見出し"""
+        chain, context = self.prepare_answer(question, candidates, say, prefix)
+        summary = chain.run(pdf_content=context.text, query=question)
+        with self.trial_lock:
+            self.n_trials += 1
+        return summary
+
+    def answer_about_pdf(self, query, say, channel):
+        if not self.corpus.has_documents(channel):
+            say("このチャンネルではまだPDFを読んでいないよ。先にPDFファイル(.pdf)を投稿してね。")
+            return
+
+        # 同じドキュメントに同じ質問が来ていれば、embeddingもLLMも呼ばずに前回の回答を返す
+        answer_key = self.answer_cache_key(query[5:], channel)
+        summary = self.answer_cache.get(answer_key)
+        print(self.answer_cache.stats())
+        if summary is not None:
+            say(summary)
+            return
+
+        candidates = self.retrieve(query[5:], channel)
+        summary = self.generate_answer(query[5:], candidates, say)
+        self.answer_cache.put(answer_key, summary)
+        # ストリーミングモードでは、回答はもうメッセージに流し込まれている
+        if not self.is_streaming:
+            say(summary)
+
+    def answer_batch_about_pdf(self, questions, say, channel, thread_ts):
+        """
+        番号付きでまとめて投稿された質問に回答するメソッド
+        embeddingとindexの探索は全ての質問をまとめて1回で行い、LLMの回答は並行して生成する
+        回答は質問ごとに、質問のメッセージのスレッドへ返信する
 
-        # 上位n件のテキストを取得してLLMに渡すためのリストに追加
-        similarity_texts = []
-        for index, row in top_n_pages.iterrows():
-            print(f"\nPage {row.page_number}):")
-            similarity_texts.append(row.text)
-
-        # https://github.com/openai/openai-cookbook/blob/main/examples/Question_answering_using_embeddings.ipynb
-        SEPARATOR = "\n* "
-        organized_text = ""
-        for s in similarity_texts:
-            organized_text += SEPARATOR
-            organized_text += s
-
-        if num_tokens(organized_text, self.model_name) > 3000:
-            # トークン数が上限にかかっている場合、強制的に文字数を減らす
-            # 少し余裕をみて3000文字までに設定
-            organized_text = organized_text[:3000]
-
-        self.chain = self.create_chain(self.get_llm(say))
-        summary = self.chain.run(pdf_content=organized_text, query=query[5:])
-        say(summary)
-        self.n_trials += 1
-
-    def process_file_share(self, event, say, client):
+        Args:
+            questions (List[str]): 番号順に並んだ質問
+            say: Boltのsay
+            channel (str): 質問が投稿されたチャンネルのid
+            thread_ts (str): 質問のメッセージのts（スレッドの親）
+        """
+        if not self.corpus.has_documents(channel):
+            say("このチャンネルではまだPDFを読んでいないよ。先にPDFファイル(.pdf)を投稿してね。")
+            return
+
+        def thread_say(message):
+            # ストリーミングで書き換えられるよう、投稿したメッセージのレスポンスを返す
+            return say(text=message, thread_ts=thread_ts)
+
+        def header(i):
+            # 何番目の質問への回答か分かるように、スレッドの返信の先頭に質問を付ける
+            return f"*{i + 1}. {questions[i]}*\n"
+
+        def reply(i):
+            return lambda message: thread_say(header(i) + message)
+
+        answer_keys = [self.answer_cache_key(question, channel) for question in questions]
+        answers = [self.answer_cache.get(key) for key in answer_keys]
+        print(self.answer_cache.stats())
+        pending = [i for i, answer in enumerate(answers) if answer is None]
+        candidates = dict(zip(pending, self.retrieve_many([questions[i] for i in pending], channel))) if pending else {}
+
+        def answer(i):
+            if answers[i] is None:
+                answers[i] = self.generate_answer(questions[i], candidates[i], thread_say, header(i))
+                self.answer_cache.put(answer_keys[i], answers[i])
+                # ストリーミングモードでは、見出し付きの回答がもうスレッドに流し込まれている
+                if self.is_streaming:
+                    return
+            reply(i)(answers[i])
+
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_ANSWERS) as executor:
+            # 1つの質問の回答に失敗しても、他の質問の回答は返す
+            for i, future in enumerate([executor.submit(answer, i) for i in range(len(questions))]):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"{i + 1}番目の質問の回答に失敗: {e}")
+                    reply(i)("ごめんね。この質問には回答できなかったよ。")
+
+    def process_file_share(self, event, say, client, job=None):
         try:
             file_info = client.files_info(file=event["files"][0]["id"]).data["file"]
             if file_info["name"][-4:] == ".pdf":
+                # Content-Lengthを見る前に、files.infoのサイズで大きすぎるファイルを弾く
+                if file_info.get("size", 0) > MAX_FILE_BYTES:
+                    say(f"ごめんね。{MAX_FILE_BYTES // (1024 * 1024)}MBより大きいPDFは読めないんだ。")
+                    return
                 file_url = file_info["url_private_download"]
-                header = {"Authorization": f"Bearer {os.environ.get('SLACK_BOT_TOKEN')}"}
-                response = requests.get(file_url, headers=header)
-                if response.status_code != 200:
-                    print(f"Failed to download file: status code {response.status_code}")
-                    print(f"Response body: {response.text}")
+                try:
+                    # ファイル全体をメモリに載せないよう、一定サイズを超えたらディスクに書き出しながらダウンロードする
+                    pdf_file, content_hash = download_slack_file(file_url, os.environ.get("SLACK_BOT_TOKEN"))
+                except requests.HTTPError as e:
+                    print(f"Failed to download file: status code {e.response.status_code}")
+                    print(f"Response body: {e.response.text}")
+                    say("ごめんね。ファイルをダウンロードできなかったよ。")
+                    return
+                except FileTooLargeError as e:
+                    print(f"Failed to download file: {e}")
+                    say(f"ごめんね。{MAX_FILE_BYTES // (1024 * 1024)}MBより大きいPDFは読めないんだ。")
                     return
+                # 同じファイルが既に読み込み済みなら、parseもembeddingもせずに保存済みのindexを使う
+                document_key = make_document_key(file_info["id"], content_hash)
+                if self.corpus.has_document(document_key):
+                    pdf_file.close()
+                    self.corpus.add(event["channel"], document_key)
+                    say("OK. このPDFは前に読んだことがあるよ。このPDFに関することなら何でも聞いてね。")
+                    return
+                # https://github.com/openai/openai-cookbook/blob/main/examples/Semantic_text_search_using_embeddings.ipynb
+                # PDFは1回だけparseし、parseが終わったページから順にトークン数の上限で重複付きのチャンクに分割して
+                # トークン数の予算内でまとめてベクトル化する
+                # parseとembeddingが並行して進むので、全ページのparseを待ってからembeddingするより早く準備が終わる
+                chunks = []
+
+                def page_texts():
+                    for page_number, page_text in enumerate(iter_page_text(pdf_file), 1):
+                        if job is not None:
+                            job.report_progress(pages_parsed=page_number)
+                        yield page_text
+
+                def chunk_texts():
+                    for chunk in iter_chunks(page_texts()):
+                        chunks.append(chunk)
+                        yield chunk.text
+
+                def embedded(n_chunks):
+                    if job is not None:
+                        job.report_progress(chunks_embedded=n_chunks)
+
                 try:
-                    pdf_file = io.BytesIO(response.content)
-                    pdf_text = extract_text(pdf_file)
-                    print(f'{"#" * 10} PDFの内容（冒頭100文字） {"#" * 10}\n', pdf_text[:100], f'\n{"#" * 46}')
+                    _, embedding_array = self.embedder.embed_stream(chunk_texts(), progress=embedded)
                 except PDFSyntaxError:
                     print("Unable to parse the PDF file.")
-
-                pages_text = self.extract_page_text(pdf_file)
-
-                pages = []
-                self.embedding_array = []
-                for idx, page_text in enumerate(tqdm(pages_text)):
-                    # https://github.com/openai/openai-cookbook/blob/main/examples/Semantic_text_search_using_embeddings.ipynb
-                    # ベクトル埋め込みを行うためのOPENAI APIの関数
-                    embedding = get_embedding(page_text, engine="text-embedding-ada-002")
-                    # ページごとの情報をPageクラスのインスタンスに変換してリストに追加
-                    page = Page(page_number=idx + 1, text=page_text, embedding=embedding)
-                    pages.append(page)
-                    self.embedding_array.append(embedding)
-
-                # pagesリストをDataFrameに変換
-                self.pages_df = pd.DataFrame(pages)
-                self.embedding_array = np.array(self.embedding_array).astype("float32")
+                    say("ごめんね。このPDFは壊れているみたいで読み込めなかったよ。")
+                    return
+                finally:
+                    pdf_file.close()
+                if not chunks:
+                    say("このPDFからはテキストを読み取れなかったよ。画像だけのPDFかもしれないね。")
+                    return
+                print(f'{"#" * 10} PDFの内容（冒頭100文字） {"#" * 10}\n', chunks[0].text[:100], f'\n{"#" * 46}')
+
+                # チャンクのテキストとページ番号を列ごとにまとめて持つ（ベクトルはindexerだけが持つ）
+                page_store = PageStore.from_texts((chunk.text for chunk in chunks), (chunk.page_number for chunk in chunks))
+                # 型番や数字の完全一致を拾うため、同じ行順で文字n-gramの転置インデックスも作る
+                lexical_index = LexicalIndex.from_texts(chunk.text for chunk in chunks)
+                # indexerを作り、投稿されたチャンネルのドキュメントとして登録する（ディスクにも保存される）
+                indexer = build_index(embedding_array)
+                # IVFならnprobe、HNSWならefSearchを、目標のrecallを満たす最小の値にしてindexと一緒に保存する
+                tuning = tune_search(indexer, embedding_array)
+                if tuning is not None:
+                    print(tuning)
+                storage = index_storage(indexer)
+                if storage != "float32":
+                    # indexがベクトルを圧縮して持つ場合は、探索結果の再ランク用に圧縮前のベクトルも保存する
+                    page_store.embeddings = normalize(embedding_array)
+                meta = {"storage": storage}
+                if tuning is not None:
+                    meta["search_tuning"] = tuning.to_dict()
+                # チャンネルのindexが既にあれば、学習し直さずにこのPDFのベクトルを追加するだけで探索できるようになる
+                self.corpus.add(event["channel"], document_key, indexer, page_store, meta, embedding_array, lexical_index)
                 say("OK. 準備ができたよ。このPDFに関することなら何でも聞いてね。")
 
             else:
@@ -252,24 +480,12 @@ class CoPyBotPDF:
 
         except SlackApiError as e:
             print(f"Error getting file info: {e}")
+            # ジョブを失敗として終わらせ、失敗のステータスメッセージを書けるようにIngestionQueue.runまで伝える
+            raise
 
     def extract_page_text(self, pdf_file):
-        pages_text = []
-        # extract_pages関数で各ページのレイアウトを表すLTPageオブジェクトのリストを取得
-        for page_layout in extract_pages(pdf_file):
-            # ページごとのテキスト内容
-            single_page_text = ""
-            for element in page_layout:
-                # LTTextContainer --> テキストを含むレイアウト要素を表す基本クラス
-                # isinstance --> elementがLTTextContainerのインスタンスかどうかを判定
-                if isinstance(element, LTTextContainer):
-                    # get_text() --> elementからテキストを取得
-                    # 改行を置換して`single_page_text`に順位追加していくことで
-                    # chunkデータに変換している
-                    single_page_text += element.get_text().replace("\n", " ")
-            # １ページ１行のchunkデータになるようリストに追加
-            pages_text.append(single_page_text)
-        return pages_text
+        # １ページ１行のchunkデータのリスト
+        return list(iter_page_text(pdf_file))
 
     def start(self):
         SocketModeHandler(self.slack_app, os.environ["SLACK_APP_TOKEN"]).start()
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import re
+
+from copybot_pdf import MAX_CONCURRENT_ANSWERS, CoPyBotPDF, split_numbered_questions
+from ingestion_queue import IngestionJob
+from langchain.callbacks.manager import AsyncCallbackManager
+from langchain.chat_models import ChatOpenAI
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_bolt.async_app import AsyncApp
+from slack_outbox import AsyncSlackOutbox, SlackOutbox
+from slack_sdk import WebClient
+from utility import AsyncSlackStreamingHandler
+
+
+class AsyncCoPyBotPDF(CoPyBotPDF):
+    """
+    CoPyBotPDFのAsyncApp版
+    回答の生成はchain.arunでawaitするので、LLMの応答を待つ間もOSのスレッドを専有せず、1つのイベントループで多数の質問を同時に扱える
+    embeddingとindexの探索はCPUとブロッキングなAPI呼び出しなので、asyncio.to_threadでイベントループの外で実行する
+    PDFの読み込みは同期版と同じくIngestionQueueのワーカーで実行する
+    """
+    def __init__(self):
+        super().__init__()
+        # 回答やストリーミングの書き換えはイベントループの中から送るので、awaitで待てるasync版の送信キューを別に持つ
+        self.async_outbox = AsyncSlackOutbox(self.slack_app.client)
+
+    def create_slack_app(self):
+        return AsyncApp(token=os.environ.get("SLACK_BOT_TOKEN"))
+
+    def create_outbox(self):
+        # IngestionQueueのワーカーはイベントループの外のスレッドなので、ステータスメッセージの更新には同期のクライアントを使う
+        return SlackOutbox(WebClient(token=os.environ.get("SLACK_BOT_TOKEN")))
+
+    def get_llm(self, say, prefix=""):
+        callback_manager = (AsyncCallbackManager([AsyncSlackStreamingHandler(say, self.async_outbox, prefix=prefix)])
+                            if self.is_streaming else None)
+
+        return ChatOpenAI(temperature=0,
+                          openai_api_key=os.environ.get("OPENAI_API_KEY"),
+                          model_name=self.model_name,
+                          streaming=self.is_streaming,
+                          callback_manager=callback_manager)
+
+    def register_listeners(self):
+        @self.slack_app.message(re.compile("(PDF|pdf喰ってね|よろしく)"))
+        async def message_streamling_mode_selection(say):
+            say = self.async_outbox.wrap(say)
+            await say(**self.mode_selection_message())
+
+        @self.slack_app.action("mode_selection")
+        async def message_ryokai(body, ack, say):
+            await ack()
+            say = self.async_outbox.wrap(say)
+            self.is_streaming = int(body["actions"][0]["selected_option"]["value"])
+            await say(self.mode_selected_message())
+
+        @self.slack_app.message(re.compile("(質問だよ|聞くね)"))
+        async def recieve_question_about_pdf(body, say):
+            say = self.async_outbox.wrap(say)
+            await say("なるほど。良い質問だね。回答を考えるからちょっと待ってね。")
+            query = body["event"]["text"]
+            print("query: ", query)
+            if not await self.await_ingestion(body["event"]["channel"], say):
+                return
+            questions = split_numbered_questions(query)
+            if len(questions) > 1:
+                await self.aanswer_batch_about_pdf(questions, say, body["event"]["channel"], body["event"]["ts"])
+            else:
+                await self.aanswer_about_pdf(query, say, body["event"]["channel"])
+
+        @self.slack_app.message(re.compile("キャッシュの状況"))
+        async def report_cache_stats(say):
+            say = self.async_outbox.wrap(say)
+            await say(self.cache_stats())
+
+        @self.slack_app.event("message")
+        async def handle_file_share_events(body):
+            if "subtype" not in body["event"] or body["event"]["subtype"] != "file_share":
+                return
+            try:
+                self.is_streaming
+            except AttributeError:
+                self.is_streaming = 0
+            event = body["event"]
+            # 受付のステータスメッセージは送信キューに積むだけなので、イベントループを止めない
+            self.ingestion_queue.submit(IngestionJob(self.outbox, event["channel"], event))
+
+    async def await_ingestion(self, channel, say):
+        """wait_for_ingestionのasync版。読み込みの完了はイベントループの外のスレッドで待つ"""
+        if not self.ingestion_queue.pending(channel):
+            return True
+        await say("いまPDFを読み込んでいるところだから、読み終わったら回答するね。")
+        if await asyncio.to_thread(self.ingestion_queue.wait_for_channel, channel):
+            return True
+        await say("ごめんね。PDFの読み込みに時間がかかっているみたい。読み込みが終わってからもう一度質問してね。")
+        return False
+
+    async def agenerate_answer(self, question, candidates, say, prefix=""):
+        """generate_answerのasync版"""
+        chain, context = self.prepare_answer(question, candidates, say, prefix)
+        summary = await chain.arun(pdf_content=context.text, query=question)
+        with self.trial_lock:
+            self.n_trials += 1
+        return summary
+
+    async def aanswer_about_pdf(self, query, say, channel):
+        if not self.corpus.has_documents(channel):
+            await say("このチャンネルではまだPDFを読んでいないよ。先にPDFファイル(.pdf)を投稿してね。")
+            return
+
+        answer_key = self.answer_cache_key(query[5:], channel)
+        summary = self.answer_cache.get(answer_key)
+        print(self.answer_cache.stats())
+        if summary is not None:
+            await say(summary)
+            return
+
+        candidates = await asyncio.to_thread(self.retrieve, query[5:], channel)
+        summary = await self.agenerate_answer(query[5:], candidates, say)
+        self.answer_cache.put(answer_key, summary)
+        if not self.is_streaming:
+            await say(summary)
+
+    async def aanswer_batch_about_pdf(self, questions, say, channel, thread_ts):
+        """answer_batch_about_pdfのasync版。回答はスレッドではなくコルーチンで並行して生成する"""
+        if not self.corpus.has_documents(channel):
+            await say("このチャンネルではまだPDFを読んでいないよ。先にPDFファイル(.pdf)を投稿してね。")
+            return
+
+        async def thread_say(message):
+            return await say(text=message, thread_ts=thread_ts)
+
+        def header(i):
+            return f"*{i + 1}. {questions[i]}*\n"
+
+        async def reply(i, message):
+            await thread_say(header(i) + message)
+
+        answer_keys = [self.answer_cache_key(question, channel) for question in questions]
+        answers = [self.answer_cache.get(key) for key in answer_keys]
+        print(self.answer_cache.stats())
+        pending = [i for i, answer in enumerate(answers) if answer is None]
+        candidates = {}
+        if pending:
+            found = await asyncio.to_thread(self.retrieve_many, [questions[i] for i in pending], channel)
+            candidates = dict(zip(pending, found))
+
+        # ChatOpenAIのレートリミットに合わせて、同時に生成する回答の数を抑える
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_ANSWERS)
+
+        async def answer(i):
+            if answers[i] is None:
+                async with semaphore:
+                    answers[i] = await self.agenerate_answer(questions[i], candidates[i], thread_say, header(i))
+                self.answer_cache.put(answer_keys[i], answers[i])
+                if self.is_streaming:
+                    return
+            await reply(i, answers[i])
+
+        results = await asyncio.gather(*(answer(i) for i in range(len(questions))), return_exceptions=True)
+        # 1つの質問の回答に失敗しても、他の質問の回答は返す
+        for i, result in enumerate(results):
+            if isinstance(result, Exception):
+                print(f"{i + 1}番目の質問の回答に失敗: {result}")
+                await reply(i, "ごめんね。この質問には回答できなかったよ。")
+
+    async def start_async(self):
+        await AsyncSocketModeHandler(self.slack_app, os.environ["SLACK_APP_TOKEN"]).start_async()
+
+    def start(self):
+        asyncio.run(self.start_async())
+
+
+if __name__ == "__main__":
+    bot = AsyncCoPyBotPDF()
+    bot.start()
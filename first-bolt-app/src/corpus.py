@@ -0,0 +1,311 @@
+import bisect
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from index_factory import (GrowingIndex, build_index, index_memory_bytes, index_storage, normalize, reconstruct_vectors,
+                           tune_search)
+from index_store import IndexStore
+from lexical_index import CollectionStats, LexicalIndex
+from page_store import PageRow, PageStore
+
+# メモリに常駐させるindexとページ情報の合計サイズの上限（バイト）
+CORPUS_MEMORY_BUDGET = int(os.environ.get("CORPUS_MEMORY_BUDGET", 512 * 1024 * 1024))
+# ベクトルを圧縮したindexで探索する時に、何倍の候補を取ってから圧縮前のベクトルで並べ直すか（1以下なら並べ直さない）
+RERANK_FACTOR = int(os.environ.get("RERANK_FACTOR", 4))
+
+
+class Document:
+    """
+    1つのPDFのページ情報と文字n-gramの転置インデックスをまとめたクラス
+    indexerはチャンネルのindexに取り込まれるまでの間だけ持つ
+    """
+    def __init__(self, key: str, page_store: PageStore, indexer: Optional[faiss.Index] = None,
+                 lexical_index: Optional[LexicalIndex] = None):
+        self.key = key
+        self.page_store = page_store
+        self.indexer = indexer
+        self.lexical_index = lexical_index
+
+    @property
+    def memory_bytes(self) -> int:
+        index_bytes = index_memory_bytes(self.indexer) if self.indexer is not None else 0
+        lexical_bytes = self.lexical_index.nbytes if self.lexical_index is not None else 0
+        return index_bytes + lexical_bytes + self.page_store.nbytes
+
+
+class ChannelIndex:
+    """
+    1つのチャンネルに投稿された全ドキュメントのベクトルを探索するクラス
+    最初のドキュメントの保存済みindexを土台（base）としてメモリマップのまま読み込み、後から投稿されたドキュメントの
+    ベクトルはメモリ上の小さなGrowingIndex（delta）に追加する。質問は両方で探して類似度順にまとめる
+    baseには書き込まないので、メモリマップしたページはプロセス間でページキャッシュとして共有される
+    indexの通し番号（baseの後にdeltaが続く）から(ドキュメント, ドキュメント内の行)を引けるよう、各ドキュメントの先頭の番号を持つ
+    """
+    def __init__(self, indexer: faiss.Index, key: str, mmapped: bool = False):
+        self.base = indexer
+        self.mmapped = mmapped
+        self.delta: Optional[GrowingIndex] = None
+        self.keys = [key]
+        self.starts = [0]
+
+    @property
+    def ntotal(self) -> int:
+        return self.base.ntotal + (self.delta.indexer.ntotal if self.delta is not None else 0)
+
+    @property
+    def storage(self) -> str:
+        """baseとdeltaのどちらかがベクトルを圧縮していれば、その形式を返す"""
+        storages = [index_storage(self.base)] + ([self.delta.storage] if self.delta is not None else [])
+        return next((storage for storage in storages if storage != "float32"), "float32")
+
+    def add(self, key: str, vectors: np.ndarray):
+        self.keys.append(key)
+        self.starts.append(self.ntotal)
+        if self.delta is None:
+            # deltaは件数に合わせて作り、baseと同じ形式でベクトルを持つ
+            indexer = build_index(vectors, storage=index_storage(self.base))
+            tune_search(indexer, vectors)
+            self.delta = GrowingIndex(indexer)
+        else:
+            self.delta.add(vectors)
+
+    @property
+    def memory_bytes(self) -> int:
+        # メモリマップしたbaseはページキャッシュなので、このプロセスのメモリとしては数えない
+        base_bytes = 0 if self.mmapped else index_memory_bytes(self.base)
+        return base_bytes + (index_memory_bytes(self.delta.indexer) if self.delta is not None else 0)
+
+    def search(self, query_embeddings: np.ndarray, k: int) -> List[List[Tuple[str, int, float]]]:
+        """質問クエリ（複数可）ごとに近い上位k件を(ドキュメントのキー, ドキュメント内の行, 類似度)で返す"""
+        queries = normalize(query_embeddings)
+        distances, idx = self.base.search(queries, k)
+        if self.delta is not None:
+            delta_distances, delta_idx = self.delta.indexer.search(queries, k)
+            # deltaの番号はbaseの後に続ける（-1はそのまま残して後で取り除く）
+            delta_idx = np.where(delta_idx < 0, -1, delta_idx + self.base.ntotal)
+            distances = np.hstack([distances, delta_distances])
+            idx = np.hstack([idx, delta_idx])
+            order = np.argsort(-distances, axis=1, kind="stable")[:, :k]
+            distances = np.take_along_axis(distances, order, axis=1)
+            idx = np.take_along_axis(idx, order, axis=1)
+        results = []
+        for row_idx, row_distances in zip(idx, distances):
+            hits = []
+            for i, distance in zip(row_idx, row_distances):
+                # 件数がk件より少ないと-1が返ってくるので取り除く
+                if i < 0:
+                    continue
+                segment = bisect.bisect_right(self.starts, i) - 1
+                hits.append((self.keys[segment], int(i - self.starts[segment]), float(distance)))
+            results.append(hits)
+        return results
+
+
+class CorpusManager:
+    """
+    チャンネルとドキュメントの組ごとにページ情報とindexを管理するクラス
+    質問は投稿されたチャンネルのドキュメントだけを対象に、チャンネルごとにまとめたindexで探索する
+    常駐させるデータの合計サイズが予算を超えたら、最後に質問された時刻が古いものからメモリから追い出す
+    追い出したデータはIndexStoreに保存してあるので、次に質問された時にディスクから読み込み直す
+    """
+    def __init__(self, index_store: Optional[IndexStore] = None, memory_budget: int = CORPUS_MEMORY_BUDGET,
+                 rerank_factor: int = RERANK_FACTOR):
+        self.index_store = index_store
+        self.memory_budget = memory_budget
+        self.rerank_factor = rerank_factor
+        # (channel, key) -> Document。末尾ほど最近質問されたドキュメント
+        self.resident: "OrderedDict[Tuple[str, str], Document]" = OrderedDict()
+        # channel -> ChannelIndex。末尾ほど最近質問されたチャンネル
+        self.channel_indexes: "OrderedDict[str, ChannelIndex]" = OrderedDict()
+        # channel -> そのチャンネルに投稿されたドキュメントのキー
+        self.channels: Dict[str, List[str]] = defaultdict(list)
+        if index_store is not None:
+            # 再起動前にチャンネルに投稿されていたドキュメントを引き継ぐ（indexは質問が来るまで読み込まない）
+            for channel, keys in index_store.load_channels().items():
+                self.channels[channel] = [key for key in keys if index_store.exists(key)]
+        self.lock = threading.RLock()
+
+    def has_documents(self, channel: str) -> bool:
+        return bool(self.channels.get(channel))
+
+    def document_keys(self, channel: str) -> List[str]:
+        with self.lock:
+            return list(self.channels.get(channel, []))
+
+    def has_document(self, key: str) -> bool:
+        return self.index_store is not None and self.index_store.exists(key)
+
+    def add(self, channel: str, key: str, indexer: Optional[faiss.Index] = None, page_store: Optional[PageStore] = None,
+            meta: Optional[dict] = None, embedding_array: Optional[np.ndarray] = None,
+            lexical_index: Optional[LexicalIndex] = None):
+        """
+        チャンネルにドキュメントを登録するメソッド
+        チャンネルのindexが既にあれば、学習し直さずにこのドキュメントのベクトルを追加する
+        indexerを渡さなければ、保存済みのindexを質問が来た時に読み込む
+
+        Args:
+            channel (str): ドキュメントが投稿されたチャンネルのid
+            key (str): make_document_keyで作ったドキュメントのキー
+            indexer (faiss.Index): 学習・追加済みのindex
+            page_store (PageStore): ページ番号とテキストを持つページ情報
+            meta (dict): nprobeの調整結果など、indexと一緒に保存しておく情報
+            embedding_array (np.ndarray): indexに追加したベクトル群。無ければindexから取り出す
+            lexical_index (LexicalIndex): ページ情報と同じ行順で作った文字n-gramの転置インデックス
+        """
+        with self.lock:
+            if indexer is not None:
+                if self.index_store is not None and not self.index_store.exists(key):
+                    self.index_store.save(key, indexer, page_store, meta, lexical_index)
+                self.resident[(channel, key)] = Document(key, page_store, indexer, lexical_index)
+                self.resident.move_to_end((channel, key))
+            if key in self.channels[channel]:
+                return
+            self.channels[channel].append(key)
+            if self.index_store is not None:
+                self.index_store.save_channels(self.channels)
+            channel_index = self.channel_indexes.get(channel)
+            if channel_index is not None:
+                if embedding_array is None:
+                    embedding_array = self.load_vectors(channel, key)
+                channel_index.add(key, embedding_array)
+                self.release_indexer(channel, key)
+            self.enforce_budget()
+
+    def get(self, channel: str, key: str) -> Document:
+        """ドキュメントのページ情報を返すメソッド。メモリに無ければディスクから読み込む"""
+        with self.lock:
+            document = self.resident.get((channel, key))
+            if document is None:
+                document = Document(key, self.index_store.load_pages(key), lexical_index=self.index_store.load_lexical(key))
+                self.resident[(channel, key)] = document
+            self.resident.move_to_end((channel, key))
+            return document
+
+    def load_vectors(self, channel: str, key: str) -> np.ndarray:
+        document = self.resident.get((channel, key))
+        # 圧縮したindexから取り出すと量子化の誤差が乗るので、圧縮前のベクトルが保存してあればそちらを使う
+        page_store = document.page_store if document is not None else self.index_store.load_pages(key)
+        if page_store.embeddings is not None:
+            return np.asarray(page_store.embeddings)
+        indexer = document.indexer if document is not None and document.indexer is not None else self.index_store.load_index(key)
+        return reconstruct_vectors(indexer)
+
+    def release_indexer(self, channel: str, key: str):
+        # チャンネルのindexに取り込んだら、ドキュメント単体のindexはメモリに置いておく必要がない
+        document = self.resident.get((channel, key))
+        if document is not None:
+            document.indexer = None
+
+    def channel_index(self, channel: str) -> ChannelIndex:
+        """
+        チャンネルのindexを返すメソッド。無ければ投稿済みのドキュメントのindexから作る
+        最初のドキュメントの保存済みindexをメモリマップで読み込んで土台にし、残りのドキュメントのベクトルは
+        メモリ上のdeltaに追加するので、土台のindexは学習し直さずメモリにも読み込まない
+        """
+        with self.lock:
+            channel_index = self.channel_indexes.get(channel)
+            if channel_index is None:
+                first, *rest = self.channels[channel]
+                document = self.resident.get((channel, first))
+                if self.index_store is not None:
+                    channel_index = ChannelIndex(self.index_store.load_index(first), first, mmapped=True)
+                else:
+                    # baseには書き込まないので、複製せずにそのまま使う
+                    channel_index = ChannelIndex(document.indexer, first)
+                self.release_indexer(channel, first)
+                for key in rest:
+                    channel_index.add(key, self.load_vectors(channel, key))
+                    self.release_indexer(channel, key)
+                self.channel_indexes[channel] = channel_index
+            self.channel_indexes.move_to_end(channel)
+            return channel_index
+
+    def enforce_budget(self):
+        # 最後に使われたものは残す。ディスクに保存していない場合は追い出すと失われるので追い出さない
+        if self.index_store is None:
+            return
+        while len(self.resident) > 1 and self.memory_bytes > self.memory_budget:
+            (channel, key), _ = self.resident.popitem(last=False)
+            print(f"メモリの予算を超えたので{channel}の{key}をメモリから追い出しました")
+        while len(self.channel_indexes) > 1 and self.memory_bytes > self.memory_budget:
+            channel, _ = self.channel_indexes.popitem(last=False)
+            print(f"メモリの予算を超えたので{channel}のindexをメモリから追い出しました")
+
+    @property
+    def memory_bytes(self) -> int:
+        return (sum(document.memory_bytes for document in self.resident.values())
+                + sum(channel_index.memory_bytes for channel_index in self.channel_indexes.values()))
+
+    def search(self, channel: str, query_embedding: np.ndarray, k: int = 3) -> List[PageRow]:
+        """
+        チャンネルに投稿された全ドキュメントから質問クエリに近いページを探すメソッド
+
+        Args:
+            channel (str): 質問が投稿されたチャンネルのid
+            query_embedding (np.ndarray): 質問クエリをembeddingしたやつ
+            k (int): 返すページの件数
+
+        Returns:
+            top_n_pages (List[PageRow]): 類似度の高い順に並べた上位k件のページ情報
+        """
+        return self.search_many(channel, query_embedding, k)[0]
+
+    def search_many(self, channel: str, query_embeddings: np.ndarray, k: int = 3) -> List[List[PageRow]]:
+        """
+        複数の質問クエリをまとめて探すメソッド。indexのsearchは(質問数, 次元数)の行列で1回だけ呼ぶ
+        indexがベクトルを圧縮して持つ場合は、rerank_factor倍の候補を取ってから圧縮前のベクトルとの内積で並べ直す
+
+        Args:
+            channel (str): 質問が投稿されたチャンネルのid
+            query_embeddings (np.ndarray): (質問数, 次元数)の質問クエリのベクトル群（1本だけでも良い）
+            k (int): 質問ごとに返すページの件数
+
+        Returns:
+            top_n_pages (List[List[PageRow]]): 質問ごとに類似度の高い順に並べた上位k件のページ情報
+        """
+        with self.lock:
+            channel_index = self.channel_index(channel)
+            rerank = self.rerank_factor > 1 and channel_index.storage != "float32"
+            queries = normalize(query_embeddings)
+            results = []
+            for query, hits in zip(queries, channel_index.search(queries, k * self.rerank_factor if rerank else k)):
+                rows = []
+                for key, i, distance in hits:
+                    page_store = self.get(channel, key).page_store
+                    if rerank and page_store.embeddings is not None:
+                        distance = float(np.dot(page_store.embeddings[i], query))
+                    rows.extend(page_store.rows([i], [distance], key))
+                if rerank:
+                    rows = sorted(rows, key=lambda row: row.distance, reverse=True)[:k]
+                results.append(rows)
+            self.enforce_budget()
+            return results
+
+    def lexical_search(self, channel: str, query: str, k: int = 3) -> List[PageRow]:
+        """
+        チャンネルに投稿された全ドキュメントの転置インデックスから、質問とBM25で一致するページを探すメソッド
+        embeddingを使わないので、APIを呼ばずに型番や数字の完全一致を拾える
+        ドキュメントごとのスコアを比べられるよう、IDFと平均の長さはチャンネルの全ドキュメントで数える
+
+        Args:
+            channel (str): 質問が投稿されたチャンネルのid
+            query (str): 質問文
+            k (int): 返すページの件数
+
+        Returns:
+            top_n_pages (List[PageRow]): BM25のスコアの高い順に並べた上位k件のページ情報
+        """
+        with self.lock:
+            documents = [document for document in (self.get(channel, key) for key in self.channels.get(channel, []))
+                         if document.lexical_index is not None]
+            stats = CollectionStats.from_indexes([document.lexical_index for document in documents], query)
+            rows = []
+            for document in documents:
+                scores, idx = document.lexical_index.search(query, k, stats)
+                rows.extend(document.page_store.rows(idx, scores, document.key))
+            self.enforce_budget()
+            return sorted(rows, key=lambda row: row.distance, reverse=True)[:k]
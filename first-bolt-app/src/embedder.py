@@ -0,0 +1,272 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from embedding_cache import EmbeddingCache, get_default_cache, normalize_text
+from embedding_provider import EMBEDDING_MODEL, EmbeddingProvider, get_embedding_provider
+from openai.error import RateLimitError
+from query_cache import QUERY_CACHE_SIZE, QUERY_CACHE_TTL, TTLCache
+from utility import num_tokens
+
+# 1リクエストに詰め込むトークン数の上限（1入力あたりの上限8191トークンより少し余裕をみている）
+MAX_BATCH_TOKENS = 8000
+# 1リクエストに詰め込める入力数の上限（APIの仕様で2048件まで）
+MAX_BATCH_SIZE = 2048
+# 同時にEmbedding APIへリクエストを投げるワーカー数
+MAX_WORKERS = 4
+# 1分あたりのリクエスト数とトークン数の上限（OpenAIのレートリミットに合わせて設定する）
+REQUESTS_PER_MINUTE = 3000
+TOKENS_PER_MINUTE = 1000000
+
+
+def iter_batches(texts: Iterable[str], max_batch_tokens: int = MAX_BATCH_TOKENS,
+                 max_batch_size: int = MAX_BATCH_SIZE, model: str = EMBEDDING_MODEL) -> Iterator[Tuple[int, List[str], int]]:
+    """
+    テキストが届いた順にトークン数の予算内に収まるようにバッチへ詰めるジェネレータ
+    入力もジェネレータで良いので、PDFのparseが終わったページから順にバッチを作れる
+
+    Args:
+        texts (Iterable[str]): ベクトル化したいテキスト群
+        max_batch_tokens (int): 1バッチあたりのトークン数の上限
+        max_batch_size (int): 1バッチあたりの入力数の上限
+        model (str): トークン数の計測に使うモデル名
+
+    Yields:
+        start (int): バッチ先頭のテキストのインデックス（元の順番に戻すために使う）
+        batch (List[str]): バッチに含まれるテキスト
+        batch_tokens (int): バッチのトークン数（レートリミッターに渡す）
+    """
+    start = 0
+    current = []
+    current_tokens = 0
+    for text in texts:
+        n_tokens = num_tokens(text, model)
+        # 予算を超える場合は今のバッチを締めて次のバッチへ
+        # 1件だけで予算を超えるテキストはそれ単体で1バッチとする
+        if current and (current_tokens + n_tokens > max_batch_tokens or len(current) >= max_batch_size):
+            yield start, current, current_tokens
+            start += len(current)
+            current = []
+            current_tokens = 0
+        current.append(text)
+        current_tokens += n_tokens
+    if current:
+        yield start, current, current_tokens
+
+
+class TokenBucket:
+    """
+    トークンバケット方式で単位時間あたりの消費量を制限するクラス
+    1分あたりの上限値を容量とし、1秒ごとに容量の1/60ずつ補充される
+    """
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.fill_rate = per_minute / 60
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.fill_rate)
+        self.updated_at = now
+
+    def acquire(self, amount: float):
+        # 容量を超える要求は永遠に満たされないので容量で頭打ちにする
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.fill_rate
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """
+    リクエスト数/分とトークン数/分の2つのトークンバケットをまとめたクラス
+    全ワーカーで1つのインスタンスを共有することでAPI全体のレートリミットを守る
+    """
+    def __init__(self, requests_per_minute: int = REQUESTS_PER_MINUTE, tokens_per_minute: int = TOKENS_PER_MINUTE):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+
+    def acquire(self, n_tokens: int):
+        self.request_bucket.acquire(1)
+        self.token_bucket.acquire(n_tokens)
+
+
+class BatchEmbedder:
+    """
+    テキスト群をまとめてEmbeddingProviderに渡してベクトル化するクラス
+    1ページ1リクエストだと300ページのPDFで300回の往復が発生するので
+    トークン数の予算に収まる分だけ1リクエストに詰め込んで往復回数を減らす
+    さらにバッチを複数のワーカーで並行してリクエストし、共有のレートリミッターで流量を調整する
+    APIを呼ばないローカルのプロバイダなら、レートリミッターとディスク上のキャッシュは使わない
+    """
+    def __init__(self, provider: Optional[EmbeddingProvider] = None, max_batch_tokens: int = MAX_BATCH_TOKENS,
+                 max_batch_size: int = MAX_BATCH_SIZE, max_workers: int = MAX_WORKERS,
+                 rate_limiter: Optional[RateLimiter] = None, max_retries: int = 5, max_rounds: int = 3,
+                 cache: Optional[EmbeddingCache] = None, use_cache: bool = True, query_cache: Optional[TTLCache] = None):
+        self.provider = provider or get_embedding_provider()
+        self.model = self.provider.model
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_workers = max_workers
+        self.rate_limiter = (rate_limiter or RateLimiter()) if self.provider.is_remote else None
+        # 1バッチあたりの429リトライ回数
+        self.max_retries = max_retries
+        # 失敗したバッチだけをやり直す周回数
+        self.max_rounds = max_rounds
+        # 同じテキストを何度もAPIに投げないよう、ディスク上のキャッシュを先に確認する
+        self.cache = (cache or get_default_cache()) if use_cache and self.provider.is_remote else None
+        # 質問クエリはプロセス内のLRUでも保持し、同じ質問ならSQLiteにも問い合わせずに返す
+        self.query_cache = (query_cache or TTLCache("query embedding cache", QUERY_CACHE_SIZE, QUERY_CACHE_TTL)) if use_cache else None
+
+    def embed_batch(self, texts: List[str]) -> List[np.ndarray]:
+        return self.provider.embed_batch(texts)
+
+    def embed_batch_with_retry(self, texts: List[str], n_tokens: int) -> List[np.ndarray]:
+        """
+        レートリミッターを通してバッチをベクトル化し、429が返ってきたら指数バックオフでリトライするメソッド
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(n_tokens)
+            try:
+                return self.embed_batch(texts)
+            except RateLimitError:
+                if attempt == self.max_retries:
+                    raise
+                # 1, 2, 4, 8...秒に少しゆらぎを加えて、ワーカー同士が同時にリトライしないようにする
+                time.sleep(2 ** attempt + random.random())
+
+    def embed_cached_batch(self, texts: List[str], n_tokens: int) -> List[np.ndarray]:
+        """
+        キャッシュにあるものはそれを使い、無いものだけをAPIでベクトル化してキャッシュに保存するメソッド
+        """
+        if self.cache is None:
+            return self.embed_batch_with_retry(texts, n_tokens)
+        found = self.cache.get_many(self.model, texts)
+        missing = [idx for idx in range(len(texts)) if idx not in found]
+        if missing:
+            missing_texts = [texts[idx] for idx in missing]
+            # トークン数はバッチ全体の値を上限値としてそのまま使う
+            missing_embeddings = self.embed_batch_with_retry(missing_texts, n_tokens)
+            self.cache.put_many(self.model, missing_texts, missing_embeddings)
+            found.update(zip(missing, missing_embeddings))
+        return [found[idx] for idx in range(len(texts))]
+
+    def embed_stream(self, texts: Iterable[str],
+                     progress: Optional[Callable[[int], None]] = None) -> Tuple[List[str], np.ndarray]:
+        """
+        テキストを受け取りながらバッチを作り、バッチが埋まり次第ワーカーに投げてベクトル化するメソッド
+        PDFのparseと並行してembeddingが進むので、準備完了までの時間がparseとembeddingの合計ではなく長い方で済む
+
+        Args:
+            texts (Iterable[str]): ベクトル化したいテキスト群（ジェネレータでも良い）
+            progress (Callable[[int], None]): バッチのembeddingが終わるたびに、それまでにベクトル化できた件数を渡して呼ぶ関数
+
+        Returns:
+            texts (List[str]): 受け取ったテキスト群
+            embedding_array (np.ndarray): 入力と同じ順番に並んだfloat32のベクトル群
+        """
+        start_time = time.perf_counter()
+        received = []
+
+        def receive():
+            for text in texts:
+                received.append(text)
+                yield text
+
+        batches = {}
+        results = {}
+        embedded = [0]
+        progress_lock = threading.Lock()
+
+        def on_done(future, n_texts):
+            # バッチは完了順がばらばらなので、件数だけを足し合わせて通知する
+            if progress is None or future.exception() is not None:
+                return
+            with progress_lock:
+                embedded[0] += n_texts
+                n_embedded = embedded[0]
+            progress(n_embedded)
+
+        def submit(batch, batch_tokens):
+            future = executor.submit(self.embed_cached_batch, batch, batch_tokens)
+            future.add_done_callback(lambda future: on_done(future, len(batch)))
+            return future
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for start, batch, batch_tokens in iter_batches(receive(), self.max_batch_tokens, self.max_batch_size):
+                batches[start] = (batch, batch_tokens)
+                futures[start] = submit(batch, batch_tokens)
+            for round_ in range(self.max_rounds):
+                failed = []
+                for start, future in futures.items():
+                    try:
+                        results[start] = future.result()
+                    except RateLimitError as e:
+                        print(f"{start + 1}ページ目からのバッチのembeddingに失敗: {e}")
+                        failed.append(start)
+                if not failed:
+                    break
+                # 最後の周回で失敗したバッチは、やり直しても結果を受け取らないので投げ直さない
+                if round_ == self.max_rounds - 1:
+                    raise RuntimeError(f"{len(failed)}件のバッチがレートリミットによりembeddingできませんでした。")
+                # 成功したバッチはやり直さず、失敗したバッチだけを次の周回で再実行する
+                futures = {start: submit(*batches[start]) for start in failed}
+
+        # 結果はバッチ先頭のインデックス順に並べ直すので、完了順に関わらずページ順が保たれる
+        embeddings = [embedding for start in sorted(results) for embedding in results[start]]
+        elapsed = time.perf_counter() - start_time
+        print(f"{len(received)}ページを{len(batches)}バッチでembedding: {elapsed:.2f}秒 ({len(received) / max(elapsed, 1e-9):.1f} pages/sec)")
+        if self.cache is not None:
+            print(self.cache.stats())
+        return received, np.array(embeddings).astype("float32")
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        テキスト群をバッチに分けて並行にベクトル化するメソッド
+
+        Args:
+            texts (List[str]): ベクトル化したいテキスト群
+
+        Returns:
+            embedding_array (np.ndarray): 入力と同じ順番に並んだfloat32のベクトル群
+        """
+        return self.embed_stream(texts)[1]
+
+    def embed_query(self, text: str) -> np.ndarray:
+        """質問クエリ1件をベクトル化するメソッド。正規化した質問文が同じならキャッシュのベクトルを返す"""
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: List[str]) -> np.ndarray:
+        """
+        複数の質問クエリをまとめてベクトル化するメソッド
+        キャッシュに無いものだけを1回のembed（質問程度の長さなら1リクエスト）でベクトル化する
+
+        Args:
+            texts (List[str]): 質問クエリ群
+
+        Returns:
+            embedding_array (np.ndarray): 入力と同じ順番に並んだfloat32のベクトル群
+        """
+        if self.query_cache is None:
+            return self.embed(texts)
+        keys = [(self.model, normalize_text(text)) for text in texts]
+        found = {i: embedding for i, embedding in enumerate(map(self.query_cache.get, keys)) if embedding is not None}
+        missing = [i for i in range(len(texts)) if i not in found]
+        if missing:
+            for i, embedding in zip(missing, self.embed([texts[i] for i in missing])):
+                self.query_cache.put(keys[i], embedding)
+                found[i] = embedding
+        print(self.query_cache.stats())
+        return np.array([found[i] for i in range(len(texts))], dtype="float32")
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Dict, List
+
+import numpy as np
+
+# キャッシュファイルの置き場所。複数のbotで同じファイルを共有する
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3")
+# キャッシュに保持する最大件数。ada-002の1件は約6KBなので10万件で600MB程度
+MAX_ENTRIES = 100000
+# SQLiteのプレースホルダ数の上限に引っかからないように分割して問い合わせる
+QUERY_CHUNK_SIZE = 500
+
+
+def normalize_text(text: str) -> str:
+    """
+    キャッシュのキーを作るためにテキストを正規化する
+    全角/半角の揺れをNFKCで吸収し、改行を含む空白の連続を1つの空白にまとめる
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def make_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    (モデル名, 正規化したテキストのハッシュ)をキーにしてベクトルを保存するSQLiteのキャッシュ
+    ベクトルはfloat32のバイト列(BLOB)として保存する
+    件数が上限を超えたら、最後に参照された時刻が古いものから削除する（LRU）
+    """
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_entries: int = MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Boltのリスナーや埋め込みのワーカーなど複数スレッドから使うのでロックで直列化する
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # 複数プロセスから同じファイルを読み書きできるようにWALモードにする
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings (last_access)")
+        self.conn.commit()
+
+    def get_many(self, model: str, texts: List[str]) -> Dict[int, np.ndarray]:
+        """
+        テキスト群のうちキャッシュにあるもののベクトルを返すメソッド
+
+        Args:
+            model (str): ベクトル化に使うモデル名
+            texts (List[str]): ベクトル化したいテキスト群
+
+        Returns:
+            found (Dict[int, np.ndarray]): キャッシュにあったテキストのインデックスとベクトル
+        """
+        keys = [make_key(model, text) for text in texts]
+        rows = {}
+        with self.lock:
+            for i in range(0, len(keys), QUERY_CHUNK_SIZE):
+                chunk = keys[i:i + QUERY_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                rows.update(self.conn.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})", chunk).fetchall())
+            # 参照されたものは最終参照時刻を更新してLRUの末尾に回す
+            now = time.time()
+            self.conn.executemany("UPDATE embeddings SET last_access = ? WHERE key = ?", [(now, key) for key in rows])
+            self.conn.commit()
+            found = {idx: np.frombuffer(rows[key], dtype="float32") for idx, key in enumerate(keys) if key in rows}
+            self.hits += len(found)
+            self.misses += len(texts) - len(found)
+        return found
+
+    def put_many(self, model: str, texts: List[str], embeddings: np.ndarray):
+        now = time.time()
+        records = [(make_key(model, text), model, np.asarray(embedding, dtype="float32").tobytes(), now)
+                   for text, embedding in zip(texts, embeddings)]
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", records)
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        # 上限を超えた分だけ、最終参照時刻の古いものから削除する
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_access LIMIT ?)",
+                (count - self.max_entries,))
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> str:
+        return f"embedding cache: hits={self.hits} misses={self.misses} hit_ratio={self.hit_ratio:.1%}"
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache() -> EmbeddingCache:
+    """プロセス内の全botで共有するキャッシュのインスタンスを返す"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+    return _default_cache
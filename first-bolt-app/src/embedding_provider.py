@@ -0,0 +1,104 @@
+import os
+from abc import ABC, abstractmethod
+from typing import List
+
+import numpy as np
+from openai import Embedding
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.random_projection import SparseRandomProjection
+
+# ベクトル化に使うプロバイダ（"openai" か "local"）
+EMBEDDING_PROVIDER = os.environ.get("EMBEDDING_PROVIDER", "openai")
+# ベクトル埋め込みに使うモデル。次元数は1536
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# ローカルのベクトル化の設定
+# 文字n-gramをハッシュで2^18次元の疎ベクトルにし、ランダム射影でLOCAL_EMBEDDING_DIM次元の密ベクトルに落とす
+LOCAL_EMBEDDING_DIM = int(os.environ.get("LOCAL_EMBEDDING_DIM", 256))
+LOCAL_HASH_FEATURES = 2 ** 18
+LOCAL_NGRAM_RANGE = (2, 3)
+# ランダム射影の乱数シード。変えると保存済みのindexやキャッシュのベクトルと比べられなくなる
+LOCAL_EMBEDDING_SEED = 0
+
+
+class EmbeddingProvider(ABC):
+    """テキスト群をベクトル化するプロバイダの共通のインターフェース"""
+    @property
+    @abstractmethod
+    def model(self) -> str:
+        """キャッシュのキーや保存先の区別に使う名前（プロバイダやモデルが違えばベクトルは比べられない）"""
+
+    @property
+    @abstractmethod
+    def is_remote(self) -> bool:
+        """APIを呼ぶかどうか。APIを呼ぶ場合だけレートリミッターとディスク上のキャッシュを使う"""
+
+    @abstractmethod
+    def embed_batch(self, texts: List[str]) -> List[np.ndarray]:
+        """テキスト群を入力と同じ順番に並んだベクトルにする"""
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """OpenAIのEmbedding APIでベクトル化するプロバイダ"""
+    def __init__(self, model: str = EMBEDDING_MODEL):
+        self.model_name = model
+
+    @property
+    def model(self) -> str:
+        return self.model_name
+
+    @property
+    def is_remote(self) -> bool:
+        return True
+
+    def embed_batch(self, texts: List[str]) -> List[np.ndarray]:
+        # get_embeddingと同じく改行は空白に置き換えてから投げる
+        inputs = [text.replace("\n", " ") for text in texts]
+        response = Embedding.create(input=inputs, model=self.model)
+        # レスポンスの順番は保証されていないのでindexで並べ替える
+        records = sorted(response["data"], key=lambda record: record["index"])
+        return [np.asarray(record["embedding"], dtype="float32") for record in records]
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """
+    APIを呼ばずにCPUだけでベクトル化するプロバイダ
+    文字n-gram（日本語は単語の区切りが無いので文字単位）をHashingVectorizerで疎ベクトルにし、
+    乱数シードを固定したランダム射影で密ベクトルにする
+    次元削減にTruncatedSVD（LSA）を使わないのは、SVDはfitしたコーパスごとに射影が変わるため
+    ドキュメントごとにベクトルの空間がずれ、チャンネルのindexに混ぜると内積が比べられなくなるから
+    ランダム射影は入力の次元数と乱数シードだけで決まり、内積（コサイン類似度）もおおよそ保たれるので、
+    後から投稿されたPDFのベクトルもチャンネルのindexにそのまま追加できる
+    意味の近さは捉えられないので、語の重なりで探せれば十分な小さな文書やオフラインの負荷試験向け
+    """
+    def __init__(self, dimension: int = LOCAL_EMBEDDING_DIM, n_features: int = LOCAL_HASH_FEATURES,
+                 seed: int = LOCAL_EMBEDDING_SEED):
+        self.model_name = f"local-hashing-{n_features}-rp{dimension}-seed{seed}"
+        self.vectorizer = HashingVectorizer(analyzer="char", ngram_range=LOCAL_NGRAM_RANGE, n_features=n_features,
+                                            alternate_sign=False, norm="l2", dtype=np.float32)
+        # ランダム射影の行列は入力の次元数だけで決まるので、空の行列でfitする
+        self.projection = SparseRandomProjection(n_components=dimension, dense_output=True, random_state=seed)
+        self.projection.fit(csr_matrix((1, n_features), dtype="float32"))
+
+    @property
+    def model(self) -> str:
+        return self.model_name
+
+    @property
+    def is_remote(self) -> bool:
+        return False
+
+    def embed_batch(self, texts: List[str]) -> List[np.ndarray]:
+        vectors = self.projection.transform(self.vectorizer.transform(texts)).astype("float32")
+        # 内積のindexに入れるので、長さ1に正規化しておく（テキストが空なら0ベクトルのまま）
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return list(vectors / np.maximum(norms, 1e-12))
+
+
+def get_embedding_provider(name: str = EMBEDDING_PROVIDER) -> EmbeddingProvider:
+    """名前からプロバイダを作る"""
+    if name == "openai":
+        return OpenAIEmbeddingProvider()
+    if name == "local":
+        return LocalEmbeddingProvider()
+    raise ValueError(f"unknown embedding provider: {name}")
@@ -0,0 +1,73 @@
+import hashlib
+import os
+from tempfile import SpooledTemporaryFile
+from typing import Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ダウンロードを許可するファイルサイズの上限（バイト）
+MAX_FILE_BYTES = int(os.environ.get("MAX_FILE_BYTES", 50 * 1024 * 1024))
+# このサイズまではメモリ上に保持し、超えたらディスク上の一時ファイルに切り替える
+SPOOL_THRESHOLD = int(os.environ.get("SPOOL_THRESHOLD", 8 * 1024 * 1024))
+# 1回に読み込むバイト数
+CHUNK_SIZE = 64 * 1024
+# 接続と読み込みのタイムアウト（秒）。読み込みは1チャンクごとの待ち時間なので、ファイル全体の時間ではない
+DOWNLOAD_CONNECT_TIMEOUT = float(os.environ.get("DOWNLOAD_CONNECT_TIMEOUT", 10))
+DOWNLOAD_READ_TIMEOUT = float(os.environ.get("DOWNLOAD_READ_TIMEOUT", 60))
+
+# Slackへの接続を使い回すためにSessionを共有する（毎回TLSハンドシェイクをしなくて済む）
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+
+class FileTooLargeError(Exception):
+    """ファイルサイズが上限を超えている場合の例外"""
+    def __init__(self, size: int, max_bytes: int):
+        super().__init__(f"file size {size} bytes exceeds the limit of {max_bytes} bytes")
+        self.size = size
+        self.max_bytes = max_bytes
+
+
+def download_slack_file(url: str, token: str, max_bytes: int = MAX_FILE_BYTES, spool_threshold: int = SPOOL_THRESHOLD,
+                        timeout: Tuple[float, float] = (DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)
+                        ) -> Tuple[SpooledTemporaryFile, str]:
+    """
+    Slackにアップロードされたファイルを少しずつダウンロードするメソッド
+    ファイル全体をメモリに載せないので、大きなファイルが同時に来てもメモリを使い切らない
+
+    Args:
+        url (str): ファイルのurl_private_download
+        token (str): Slackのボットトークン
+        max_bytes (int): ダウンロードを許可するファイルサイズの上限
+        spool_threshold (int): メモリ上に保持するサイズの上限。超えた分はディスクに書き出す
+        timeout (Tuple[float, float]): 接続と読み込みのタイムアウト（秒）
+
+    Returns:
+        file (SpooledTemporaryFile): 先頭にシークしたダウンロード済みのファイル
+        content_hash (str): ファイルの中身のsha256
+    """
+    header = {"Authorization": f"Bearer {token}"}
+    with session.get(url, headers=header, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        # Content-Lengthが分かる場合は本体を読む前に弾く
+        content_length = int(response.headers.get("Content-Length", 0))
+        if content_length > max_bytes:
+            raise FileTooLargeError(content_length, max_bytes)
+        file = SpooledTemporaryFile(max_size=spool_threshold)
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                size += len(chunk)
+                # Content-Lengthが無い・偽っている場合に備えて、読みながらもサイズを確認する
+                if size > max_bytes:
+                    raise FileTooLargeError(size, max_bytes)
+                sha256.update(chunk)
+                file.write(chunk)
+        except BaseException:
+            # タイムアウトや接続切れでも、ディスクに書き出した一時ファイルを残さない
+            file.close()
+            raise
+    file.seek(0)
+    return file, sha256.hexdigest()
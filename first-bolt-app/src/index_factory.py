@@ -0,0 +1,563 @@
+import math
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+# この件数以下なら総当たり探索（Flat）でも十分速いので、学習の要らないFlatを使う
+FLAT_MAX_VECTORS = 5000
+# この件数を超えたら大規模とみなしてHNSWかIVF-PQを使う
+LARGE_MIN_VECTORS = 200000
+# IVFのクラスタリングで1つのボロノイ領域あたりに最低限必要な学習データ数（FAISSの推奨値）
+MIN_POINTS_PER_CENTROID = 39
+# indexに使って良いメモリの目安（バイト）。大規模な場合にHNSWで収まらなければIVF-PQで圧縮する
+INDEX_MEMORY_TARGET = int(os.environ.get("INDEX_MEMORY_TARGET", 2 * 1024 * 1024 * 1024))
+# HNSWのグラフで1ノードあたりに張るリンク数
+HNSW_M = 32
+# efSearchの自動調整で試す範囲（FAISSの既定値は16）
+HNSW_MIN_EF_SEARCH = 16
+HNSW_MAX_EF_SEARCH = 1024
+# IVF-PQで1ベクトルあたりに使うバイト数の目安（サブ量子化器の数）
+PQ_BYTES_PER_VECTOR = 64
+# 直積量子化の学習に最低限必要な件数（各サブ量子化器の256個の代表値それぞれに39件）
+PQ_MIN_TRAINING = 256 * MIN_POINTS_PER_CENTROID
+# indexにベクトルを保持する形式
+# "float32": そのまま、"fp16": 半精度、"int8": 次元ごとに8bitへスカラー量子化、"pq": 直積量子化
+STORAGE_MODES = ("float32", "fp16", "int8", "pq")
+STORAGE_MODE = os.environ.get("INDEX_STORAGE_MODE", "float32")
+# nprobeとefSearchの自動調整で目標とするrecall@kと、その計測に使うサンプル数
+RECALL_TARGET = float(os.environ.get("RECALL_TARGET", 0.95))
+RECALL_K = 10
+TUNING_SAMPLES = 200
+# 自動調整に使うクエリの種類（tuning_queriesを参照）
+TUNING_QUERY_KINDS = ("held_out", "probe")
+# 後からベクトルを追加した時に、IVFを学習し直す閾値
+# imbalance: 領域ごとの件数の偏り（全領域が同じ件数なら1.0）
+# drift: 追加したベクトルと代表点の平均距離が、学習時の平均距離の何倍になったか
+IMBALANCE_THRESHOLD = 3.0
+DRIFT_THRESHOLD = 1.5
+
+
+@dataclass
+class IndexSpec:
+    """
+    作るindexの種類とパラメータ
+    kind: "flat"（総当たり）, "ivf"（ボロノイ領域）, "hnsw"（グラフ）
+    storage: ベクトルの保持形式（STORAGE_MODESのどれか）。pq_mは"pq"の時のサブ量子化器の数
+    """
+    kind: str
+    d: int
+    nlist: int = 0
+    m: int = 0
+    storage: str = STORAGE_MODE
+    pq_m: int = 0
+
+    def __post_init__(self):
+        if self.storage not in STORAGE_MODES:
+            raise ValueError(f"unknown storage mode: {self.storage}")
+        if self.storage == "pq" and not self.pq_m:
+            self.pq_m = pq_subquantizers(self.d)
+
+    @property
+    def code_size(self) -> int:
+        """1ベクトルを保持するのに使うバイト数"""
+        return {"float32": self.d * 4, "fp16": self.d * 2, "int8": self.d, "pq": self.pq_m}[self.storage]
+
+    @property
+    def factory_string(self) -> str:
+        """faiss.index_factoryに渡す文字列"""
+        storage = {"float32": "Flat", "fp16": "SQfp16", "int8": "SQ8", "pq": f"PQ{self.pq_m}"}[self.storage]
+        prefix = {"flat": "", "ivf": f"IVF{self.nlist},", "hnsw": f"HNSW{self.m},"}
+        if self.kind not in prefix:
+            raise ValueError(f"unknown index kind: {self.kind}")
+        return prefix[self.kind] + storage
+
+    def estimated_bytes(self, n: int) -> int:
+        """n件のベクトルを入れた時のindexの大きさの見積もり"""
+        if self.kind == "hnsw":
+            return n * (self.code_size + self.m * 2 * 4)
+        if self.kind == "ivf":
+            # 各ベクトルのidと、代表点（量子化しないのでfloat32）の分を足す
+            return n * (self.code_size + 8) + self.nlist * self.d * 4
+        return n * self.code_size
+
+    def __str__(self):
+        params = {"flat": "", "ivf": f"nlist={self.nlist}", "hnsw": f"M={self.m}"}[self.kind]
+        storage = f"pq(m={self.pq_m})" if self.storage == "pq" else self.storage
+        return f"{self.kind}(d={self.d}{', ' + params if params else ''}, {storage})"
+
+
+def pq_subquantizers(d: int, bytes_per_vector: int = PQ_BYTES_PER_VECTOR) -> int:
+    """次元数dを割り切れる数のうち、bytes_per_vector以下で最大のサブ量子化器の数を返す"""
+    return max(m for m in range(1, min(d, bytes_per_vector) + 1) if d % m == 0)
+
+
+def choose_index_spec(n: int, d: int, memory_target: int = INDEX_MEMORY_TARGET, storage: str = STORAGE_MODE) -> IndexSpec:
+    """
+    ベクトルの件数と次元数、メモリの目安からindexの種類を選ぶメソッド
+    ・少ない場合: 学習の要らない総当たり探索（Flat）
+    ・中くらいの場合: ボロノイ領域の数を√n程度にしたIVF（領域あたりの学習データが足りる範囲で）
+    ・多い場合: メモリに収まるならHNSW、収まらないならIVF-PQで圧縮する
+
+    Args:
+        n (int): indexに入れるベクトルの件数
+        d (int): ベクトルの次元数
+        memory_target (int): indexに使って良いメモリの目安（バイト）
+        storage (str): ベクトルの保持形式（STORAGE_MODESのどれか）
+
+    Returns:
+        spec (IndexSpec): 作るindexの種類とパラメータ
+    """
+    if storage == "pq" and n < PQ_MIN_TRAINING:
+        # 直積量子化の代表値を学習するには件数が足りないので、学習の軽いスカラー量子化にする
+        storage = "int8"
+    if n <= FLAT_MAX_VECTORS:
+        return IndexSpec("flat", d, storage=storage)
+    # ボロノイ領域の数は√nを目安にしつつ、1領域あたりの学習データが足りるように上限を設ける
+    nlist = max(1, min(int(round(math.sqrt(n))), n // MIN_POINTS_PER_CENTROID))
+    if n <= LARGE_MIN_VECTORS:
+        return IndexSpec("ivf", d, nlist=nlist, storage=storage)
+    if storage != "pq":
+        # HNSWとPQの組み合わせは内積に対応していないので、PQを使う場合はIVF-PQにする
+        hnsw = IndexSpec("hnsw", d, m=HNSW_M, storage=storage)
+        if hnsw.estimated_bytes(n) <= memory_target:
+            return hnsw
+    return IndexSpec("ivf", d, nlist=nlist, storage="pq")
+
+
+def create_index(spec: IndexSpec) -> faiss.Index:
+    """
+    IndexSpecから空のindexを作る
+    embeddingは正規化してから入れるので、内積（METRIC_INNER_PRODUCT）がそのままコサイン類似度になる
+    """
+    if spec.kind == "hnsw" and spec.storage == "pq":
+        raise ValueError("HNSW with PQ storage does not support inner product; use ivf or int8 storage")
+    return faiss.index_factory(spec.d, spec.factory_string, faiss.METRIC_INNER_PRODUCT)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """ベクトル群を長さ1に正規化したfloat32のコピーを返す（1本だけ渡した場合は(1, 次元数)にする）"""
+    vectors = np.array(vectors, dtype="float32", ndmin=2, order="C")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def build_index(embedding_array: np.ndarray, spec: Optional[IndexSpec] = None,
+                memory_target: int = INDEX_MEMORY_TARGET, storage: str = STORAGE_MODE) -> faiss.Index:
+    """
+    ベクトル群からindexを作って学習・追加まで済ませるメソッド
+    IVF系のindexはクラスタリングによってデータ空間をボロノイ領域に分割することにより高速な近傍探索を可能にする
+    ボロノイ領域の紹介はこちら --> https://ja.wikipedia.org/?curid=91418
+    次元数はembedding_arrayから取るので、`text-embedding-ada-002`以外のモデルでもそのまま使える
+
+    Args:
+        embedding_array (np.ndarray): (件数, 次元数)のfloat32のベクトル群
+        spec (IndexSpec): 作るindexの種類。Noneならchoose_index_specで件数とメモリの目安から選ぶ
+        memory_target (int): indexに使って良いメモリの目安（バイト）
+        storage (str): specを選ぶ時のベクトルの保持形式
+
+    Returns:
+        indexer (faiss.Index): 学習・追加済みのindex
+    """
+    embedding_array = normalize(embedding_array)
+    n, d = embedding_array.shape
+    if spec is None:
+        spec = choose_index_spec(n, d, memory_target, storage)
+    print(f"{n}件のベクトルに対して{spec}のindexを作成")
+    indexer = create_index(spec)
+    if not indexer.is_trained:
+        # ベクトルデータベースからボロノイ領域（と量子化の代表値）を生成
+        indexer.train(embedding_array)
+    indexer.add(embedding_array)
+    return indexer
+
+
+@dataclass
+class SearchTuning:
+    """
+    探索パラメータの自動調整の結果。paramは"nprobe"（IVF）か"efSearch"（HNSW）で、valueが選んだ値
+    curveは値ごとの、クエリの種類ごとのrecall@kとその最小値（recall）、1クエリあたりのミリ秒の一覧
+    """
+    param: str
+    value: int
+    target_recall: float
+    k: int
+    curve: List[dict] = field(default_factory=list)
+
+    @property
+    def nprobe(self) -> Optional[int]:
+        return self.value if self.param == "nprobe" else None
+
+    @property
+    def ef_search(self) -> Optional[int]:
+        return self.value if self.param == "efSearch" else None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def __str__(self):
+        lines = [f"{self.param}={self.value} (recall@{self.k}の目標: {self.target_recall})"]
+        for p in self.curve:
+            by_queries = "  ".join(f"{name}={p[f'recall_{name}']:.3f}" for name in TUNING_QUERY_KINDS if f"recall_{name}" in p)
+            lines.append(f"  {self.param}={p[self.param]:>5}  recall@{self.k}={p['recall']:.3f} ({by_queries})  {p['ms_per_query']:.3f}ms/query")
+        return "\n".join(lines)
+
+
+def exact_neighbours(embedding_array: np.ndarray, k: int, n_samples: int = TUNING_SAMPLES,
+                     seed: int = 0) -> Tuple[np.ndarray, List[set]]:
+    """
+    正規化済みのベクトル群からクエリをサンプルし、総当たり探索（内積）で正解の近傍k件を求めるメソッド
+    クエリ自身はindexに入っているので、正解からクエリ自身を除く
+    indexに入っているベクトルがクエリなので、量子化による取りこぼしを比べる時だけに使う（探索パラメータの調整にはtuning_queriesを使う）
+
+    Returns:
+        sample_ids (np.ndarray): クエリにしたベクトルの行
+        truth (List[set]): クエリごとの正解の近傍の行
+    """
+    n = len(embedding_array)
+    rng = np.random.default_rng(seed)
+    sample_ids = rng.choice(n, size=min(n_samples, n), replace=False)
+    exact = faiss.IndexFlatIP(embedding_array.shape[1])
+    exact.add(embedding_array)
+    # クエリ自身を除くためにk+1件取る
+    _, truth = exact.search(embedding_array[sample_ids], k + 1)
+    return sample_ids, [set(row[row != qid][:k]) for row, qid in zip(truth, sample_ids)]
+
+
+def recall_at_k(truth: List[set], found: np.ndarray, sample_ids: np.ndarray, k: int) -> float:
+    """探索結果（クエリ自身を含めてk+1件以上）のrecall@kを求める"""
+    return float(np.mean([len(t & set(row[row != qid][:k])) / k for t, row, qid in zip(truth, found, sample_ids)]))
+
+
+def probe_queries(embedding_array: np.ndarray, n_queries: int, seed: int = 0) -> np.ndarray:
+    """
+    ベクトル群の次元ごとの平均と標準偏差に合わせた正規分布から、どのベクトルとも重ならないクエリを作るメソッド
+    質問はチャンクとは言い回しが違い、どのチャンクのすぐ近くにも落ちないことがあるので、
+    indexのベクトルをクエリにするよりも厳しく（ボロノイ領域の境目や、まばらな所に落ちるクエリも含めて）recallを見積もれる
+    """
+    rng = np.random.default_rng(seed)
+    n, d = embedding_array.shape
+    sample = embedding_array[np.sort(rng.choice(n, size=min(n, 10000), replace=False))]
+    mean, std = sample.mean(axis=0), sample.std(axis=0)
+    return normalize(rng.standard_normal((n_queries, d)).astype("float32") * std + mean)
+
+
+def tuning_queries(embedding_array: np.ndarray, k: int, n_samples: int = TUNING_SAMPLES, seed: int = 0,
+                   hold_out: bool = True) -> Tuple[np.ndarray, Dict[str, Tuple[np.ndarray, np.ndarray]]]:
+    """
+    探索パラメータの自動調整に使う、評価するindexに入っていないクエリと、総当たり探索（内積）による正解の近傍k件を作るメソッド
+    ・held_out: サンプルしたベクトル。評価の間はindexから取り除き、正解も残りのベクトルから求める
+    ・probe: probe_queriesで作った合成のクエリ
+
+    Args:
+        embedding_array (np.ndarray): 正規化済みのベクトル群
+        k (int): 正解の件数
+        n_samples (int): 種類ごとのクエリの数（held_outはベクトルの1割まで）
+        seed (int): サンプリングの乱数シード
+        hold_out (bool): Falseならheld_outを作らない（ベクトルを取り除けないHNSWなど）
+
+    Returns:
+        held_out_ids (np.ndarray): 評価の間indexから取り除く行
+        query_sets (Dict[str, Tuple[np.ndarray, np.ndarray]]): クエリの種類 -> (クエリ, 正解の行)
+    """
+    n, d = embedding_array.shape
+    rng = np.random.default_rng(seed)
+    n_held_out = min(n_samples, n // 10) if hold_out else 0
+    held_out_ids = np.sort(rng.choice(n, size=n_held_out, replace=False)).astype("int64")
+    queries = {}
+    if n_held_out:
+        queries["held_out"] = embedding_array[held_out_ids]
+    queries["probe"] = probe_queries(embedding_array, n_samples, seed)
+    exact = faiss.IndexFlatIP(d)
+    exact.add(embedding_array)
+    query_sets = {}
+    for name, q in queries.items():
+        # 取り除いた分を多めに取ってから除き、残りのベクトルの中での上位k件を正解にする
+        _, found = exact.search(q, k + n_held_out)
+        query_sets[name] = (q, np.array([row[~np.isin(row, held_out_ids)][:k] for row in found]))
+    return held_out_ids, query_sets
+
+
+def measure_recall(indexer: faiss.Index, query_sets: Dict[str, Tuple[np.ndarray, np.ndarray]], k: int) -> dict:
+    """クエリの種類ごとのrecall@kと、その最小値（recall）、1クエリあたりのミリ秒を計測する"""
+    point = {}
+    elapsed, n_queries = 0.0, 0
+    for name, (queries, truth) in query_sets.items():
+        start = time.perf_counter()
+        _, found = indexer.search(queries, k)
+        elapsed += time.perf_counter() - start
+        n_queries += len(queries)
+        point[f"recall_{name}"] = float(np.mean([len(set(row) & set(t)) / k for row, t in zip(found, truth)]))
+    point["recall"] = min(point[f"recall_{name}"] for name in query_sets)
+    point["ms_per_query"] = elapsed * 1000 / n_queries
+    return point
+
+
+def doubling(start: int, stop: int) -> List[int]:
+    """startから2倍ずつstopまで（stopを含む）の値"""
+    values = [start]
+    while values[-1] < stop:
+        values.append(min(values[-1] * 2, stop))
+    return values
+
+
+def sweep_search_param(indexer: faiss.Index, param: str, values: List[int], set_value,
+                       query_sets: Dict[str, Tuple[np.ndarray, np.ndarray]], target_recall: float, k: int) -> SearchTuning:
+    """探索パラメータを小さい順に試し、目標のrecallを満たした最初の値（満たさなければ最後の値）をindexに設定する"""
+    curve = []
+    chosen = values[-1]
+    for value in values:
+        set_value(value)
+        curve.append({param: value, **measure_recall(indexer, query_sets, k)})
+        if curve[-1]["recall"] >= target_recall:
+            chosen = value
+            break
+    set_value(chosen)
+    return SearchTuning(param=param, value=chosen, target_recall=target_recall, k=k, curve=curve)
+
+
+def tune_nprobe(indexer: faiss.Index, embedding_array: np.ndarray, target_recall: float = RECALL_TARGET,
+                k: int = RECALL_K, n_samples: int = TUNING_SAMPLES, seed: int = 0) -> Optional[SearchTuning]:
+    """
+    IVF系のindexのnprobe（探索するボロノイ領域の数）を、目標のrecallを満たす最小の値に設定するメソッド
+    nprobeの既定値は1なので、ドキュメントが大きくなるほど近傍を取りこぼしやすくなる
+    indexに入っているベクトルをそのままクエリにすると、クエリ自身の領域に近傍が固まっているので楽観的な値になる
+    そこでtuning_queriesのクエリ（indexから取り除いたベクトルと、合成したクエリ）で、総当たり探索（Flat）の結果に対する
+    recall@kをnprobeごとに計測し、どちらの種類のクエリでも目標を満たす最小のnprobeを選ぶ
+
+    Args:
+        indexer (faiss.Index): 学習・追加済みのindex（build_indexで作ったもの。行番号をidとして持つ）
+        embedding_array (np.ndarray): indexに追加したベクトル群（正解の計算に使う）
+        target_recall (float): 目標とするrecall@k
+        k (int): recall@kのk
+        n_samples (int): 種類ごとのクエリの数
+        seed (int): サンプリングの乱数シード
+
+    Returns:
+        tuning (SearchTuning): 選んだnprobeとnprobeごとのrecallと応答時間。IVF系以外のindexならNone
+    """
+    try:
+        ivf = faiss.extract_index_ivf(indexer)
+    except RuntimeError:
+        return None
+    embedding_array = normalize(embedding_array)
+    n = len(embedding_array)
+    k = min(k, n - 1 - n // 10)
+    if k < 1:
+        return None
+    held_out_ids, query_sets = tuning_queries(embedding_array, k, n_samples, seed)
+    # 評価の間だけクエリにしたベクトルをindexから取り除き、終わったら同じidで戻す
+    indexer.remove_ids(held_out_ids)
+    try:
+        # 選んだnprobeはindexに設定され、faiss.write_indexでindexと一緒に保存される
+        return sweep_search_param(indexer, "nprobe", doubling(1, ivf.nlist), lambda value: setattr(ivf, "nprobe", value),
+                                  query_sets, target_recall, k)
+    finally:
+        if len(held_out_ids):
+            indexer.add_with_ids(embedding_array[held_out_ids], held_out_ids)
+
+
+def tune_ef_search(indexer: faiss.Index, embedding_array: np.ndarray, target_recall: float = RECALL_TARGET,
+                   k: int = RECALL_K, n_samples: int = TUNING_SAMPLES, seed: int = 0) -> Optional[SearchTuning]:
+    """
+    HNSWのindexのefSearch（探索中に保持する候補の数）を、目標のrecallを満たす最小の値に設定するメソッド
+    efSearchの既定値は16なので、件数が増えると近傍を取りこぼしやすくなる
+    HNSWはベクトルを取り除けないので、tuning_queriesの合成したクエリだけで計測する（引数はtune_nprobeと同じ）
+
+    Returns:
+        tuning (SearchTuning): 選んだefSearchとefSearchごとのrecallと応答時間。HNSW以外のindexならNone
+    """
+    hnsw_index = faiss.downcast_index(indexer)
+    if not isinstance(hnsw_index, faiss.IndexHNSW):
+        return None
+    embedding_array = normalize(embedding_array)
+    k = min(k, len(embedding_array))
+    if k < 1:
+        return None
+    _, query_sets = tuning_queries(embedding_array, k, n_samples, seed, hold_out=False)
+    # 選んだefSearchはindexに設定され、faiss.write_indexでindexと一緒に保存される
+    return sweep_search_param(indexer, "efSearch", doubling(max(HNSW_MIN_EF_SEARCH, k), HNSW_MAX_EF_SEARCH),
+                              lambda value: setattr(hnsw_index.hnsw, "efSearch", value), query_sets, target_recall, k)
+
+
+def tune_search(indexer: faiss.Index, embedding_array: np.ndarray, target_recall: float = RECALL_TARGET,
+                k: int = RECALL_K, n_samples: int = TUNING_SAMPLES, seed: int = 0) -> Optional[SearchTuning]:
+    """indexの種類に合わせて、IVFならnprobe、HNSWならefSearchを調整する。総当たり探索（Flat）ならNone"""
+    kind = index_kind(indexer)
+    if kind == "ivf":
+        return tune_nprobe(indexer, embedding_array, target_recall, k, n_samples, seed)
+    if kind == "hnsw":
+        return tune_ef_search(indexer, embedding_array, target_recall, k, n_samples, seed)
+    return None
+
+
+def reconstruct_vectors(indexer: faiss.Index) -> np.ndarray:
+    """indexに入っているベクトルを取り出す（IVF系は取り出すために直接参照用の対応表を作る）"""
+    try:
+        faiss.extract_index_ivf(indexer).make_direct_map()
+    except RuntimeError:
+        pass
+    return indexer.reconstruct_n(0, indexer.ntotal)
+
+
+class GrowingIndex:
+    """
+    後からベクトルを追加していけるindexのラッパー
+    追加は学習し直さずにaddするだけなので、大きなコーパスに1ドキュメント足すコストは追加分の件数に比例する
+    IVF系のindexは、追加したベクトルがボロノイ領域の代表点から離れてきた（drift）か、
+    領域ごとの件数の偏り（imbalance）が閾値を超えた時だけ学習し直す
+    件数が増えてchoose_index_specの選ぶ種類が変わった時（Flat→IVFなど）も作り直す
+    """
+    def __init__(self, indexer: faiss.Index, imbalance_threshold: float = IMBALANCE_THRESHOLD,
+                 drift_threshold: float = DRIFT_THRESHOLD):
+        self.imbalance_threshold = imbalance_threshold
+        self.drift_threshold = drift_threshold
+        self.reset(indexer)
+
+    def reset(self, indexer: faiss.Index):
+        self.indexer = indexer
+        self.kind = index_kind(indexer)
+        self.storage = index_storage(indexer)
+        # 学習時点のベクトルと代表点との平均距離。driftの基準にする
+        self.baseline_distance = self.centroid_distance(reconstruct_vectors(indexer)) if self.kind == "ivf" else None
+
+    def centroid_distance(self, vectors: np.ndarray) -> float:
+        # 内積のindexのquantizerは類似度を返すので、割り当てられた代表点との二乗距離を計算し直す
+        quantizer = faiss.extract_index_ivf(self.indexer).quantizer
+        if not len(vectors):
+            return 0.0
+        _, assign = quantizer.search(vectors, 1)
+        centroids = quantizer.reconstruct_batch(assign.ravel())
+        return float(np.mean(np.sum((vectors - centroids) ** 2, axis=1)))
+
+    def add(self, vectors: np.ndarray):
+        """
+        ベクトルを追加するメソッド。必要な場合だけ学習し直す
+
+        Args:
+            vectors (np.ndarray): 追加するfloat32のベクトル群
+        """
+        vectors = normalize(vectors)
+        drift = None
+        if self.kind == "ivf" and self.baseline_distance:
+            drift = self.centroid_distance(vectors) / self.baseline_distance
+        self.indexer.add(vectors)
+        n, d = self.indexer.ntotal, self.indexer.d
+        reason = None
+        if choose_index_spec(n, d, storage=self.storage).kind != self.kind:
+            reason = f"件数が{n}件になったのでindexの種類を見直します"
+        elif drift is not None and drift > self.drift_threshold:
+            reason = f"追加したベクトルが代表点から離れている(drift={drift:.2f})のでボロノイ領域を学習し直します"
+        elif self.kind == "ivf":
+            imbalance = faiss.extract_index_ivf(self.indexer).invlists.imbalance_factor()
+            if imbalance > self.imbalance_threshold:
+                reason = f"ボロノイ領域ごとの件数が偏っている(imbalance={imbalance:.2f})ので学習し直します"
+        if reason is not None:
+            print(reason)
+            self.rebuild()
+
+    def rebuild(self):
+        vectors = reconstruct_vectors(self.indexer)
+        indexer = build_index(vectors, storage=self.storage)
+        tune_search(indexer, vectors)
+        self.reset(indexer)
+
+
+def index_kind(indexer: faiss.Index) -> str:
+    """indexの種類をIndexSpecのkindの名前で返す"""
+    indexer = faiss.downcast_index(indexer)
+    if isinstance(indexer, faiss.IndexIVF):
+        return "ivf"
+    if isinstance(indexer, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def index_storage(indexer: faiss.Index) -> str:
+    """indexがベクトルを保持している形式をIndexSpecのstorageの名前で返す"""
+    indexer = faiss.downcast_index(indexer)
+    if isinstance(indexer, faiss.IndexHNSW):
+        indexer = faiss.downcast_index(indexer.storage)
+    if isinstance(indexer, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    if isinstance(indexer, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "fp16" if indexer.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "int8"
+    return "float32"
+
+
+def index_memory_bytes(indexer: faiss.Index) -> int:
+    """indexがメモリ上で使うバイト数の見積もり（ベクトルの符号とHNSWのリンク、IVFのidと代表点）"""
+    indexer = faiss.downcast_index(indexer)
+    if isinstance(indexer, faiss.IndexHNSW):
+        storage = faiss.downcast_index(indexer.storage)
+        return indexer.ntotal * (storage.code_size + indexer.hnsw.nb_neighbors(0) * 4)
+    if isinstance(indexer, faiss.IndexIVF):
+        return indexer.ntotal * (indexer.code_size + 8) + indexer.nlist * indexer.d * 4
+    return indexer.ntotal * getattr(indexer, "code_size", indexer.d * 4)
+
+
+def rerank(query_embedding: np.ndarray, candidates: np.ndarray, vectors: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    圧縮したindexで絞り込んだ候補を、圧縮していないベクトルとの内積で並べ直すメソッド
+
+    Args:
+        query_embedding (np.ndarray): 正規化済みのクエリ
+        candidates (np.ndarray): 候補の行（-1は該当なし）
+        vectors (np.ndarray): 正規化済みのfloat32のベクトル群
+        k (int): 返す件数
+
+    Returns:
+        scores (np.ndarray): 類似度の高い順に並べた上位k件の内積
+        idx (np.ndarray): その行
+    """
+    candidates = candidates[candidates >= 0]
+    scores = np.asarray(vectors[candidates], dtype="float32") @ query_embedding
+    order = np.argsort(-scores, kind="stable")[:k]
+    return scores[order], candidates[order]
+
+
+def compare_storage_modes(embedding_array: np.ndarray, k: int = RECALL_K, rerank_factor: int = 4,
+                          n_samples: int = TUNING_SAMPLES, seed: int = 0) -> List[dict]:
+    """
+    ベクトルの保持形式ごとに、1ベクトルあたりのバイト数と総当たり探索に対するrecall@kを計測するメソッド
+    量子化による取りこぼしだけを見るため、どの形式も総当たり探索（Flat）で比べる
+    rerank_factor倍の候補を取ってから圧縮していないベクトルで並べ直した場合のrecallも計測する
+
+    Args:
+        embedding_array (np.ndarray): (件数, 次元数)のベクトル群
+        k (int): recall@kのk
+        rerank_factor (int): 並べ直しで取る候補の倍率
+        n_samples (int): クエリとして使うサンプル数
+        seed (int): サンプリングの乱数シード
+
+    Returns:
+        results (List[dict]): 形式ごとのbytes_per_vector, recall, reranked_recall
+    """
+    embedding_array = normalize(embedding_array)
+    n, d = embedding_array.shape
+    k = min(k, n - 1)
+    sample_ids, truth = exact_neighbours(embedding_array, k, n_samples, seed)
+    queries = embedding_array[sample_ids]
+    results = []
+    for storage in STORAGE_MODES:
+        if storage == "pq" and n < PQ_MIN_TRAINING:
+            print(f"{n}件では直積量子化の学習に足りないのでpqは計測しません")
+            continue
+        spec = IndexSpec("flat", d, storage=storage)
+        indexer = create_index(spec)
+        indexer.train(embedding_array)
+        indexer.add(embedding_array)
+        _, found = indexer.search(queries, (k + 1) * rerank_factor)
+        reranked = np.full((len(queries), k + 1), -1)
+        for row, (q, candidates) in enumerate(zip(queries, found)):
+            _, idx = rerank(q, candidates, embedding_array, k + 1)
+            reranked[row, :len(idx)] = idx
+        results.append({"storage": storage, "bytes_per_vector": spec.code_size,
+                        "recall": recall_at_k(truth, found[:, :k + 1], sample_ids, k),
+                        "reranked_recall": recall_at_k(truth, reranked, sample_ids, k)})
+        print(f"{storage:>8}: {spec.code_size:>5}bytes/vector  recall@{k}={results[-1]['recall']:.3f}"
+              f"  再ランク後={results[-1]['reranked_recall']:.3f}")
+    return results
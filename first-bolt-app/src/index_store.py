@@ -0,0 +1,116 @@
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+from lexical_index import LexicalIndex
+from page_store import PageStore
+
+# FAISSのindexとページ情報の保存先。Cloud Runではボリュームをマウントして複数インスタンスで共有する
+INDEX_STORE_DIR = os.environ.get("INDEX_STORE_DIR", ".cache/indexes")
+INDEX_FILE = "index.faiss"
+CHANNELS_FILE = "channels.json"
+META_FILE = "meta.json"
+
+
+def make_document_key(file_id: str, content_hash: str) -> str:
+    """
+    Slackのファイルidと中身のハッシュ(sha256)から保存用のキーを作る
+    同じidでも中身が差し替えられていれば別のキーになる
+    """
+    return f"{file_id}_{content_hash[:16]}"
+
+
+def document_hash(key: str) -> str:
+    """make_document_keyで作ったキーから中身のハッシュの部分を取り出す（別のidで投稿された同じファイルを同一視するため）"""
+    return key.rsplit("_", 1)[-1]
+
+
+class IndexStore:
+    """
+    ドキュメントごとにFAISSのindexとページ情報をディスクに保存するクラス
+    読み込みはメモリマップ（IO_FLAG_MMAP）で行うので、再起動時にembeddingや学習をやり直さずに済み、
+    同じファイルを複数プロセスで共有してもページキャッシュ上は1つ分のメモリで済む
+    """
+    def __init__(self, root: str = INDEX_STORE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self.path(key), INDEX_FILE))
+
+    def save(self, key: str, indexer: faiss.Index, page_store: PageStore, meta: Optional[dict] = None,
+             lexical_index: Optional[LexicalIndex] = None):
+        """
+        indexとページ情報を保存するメソッド
+        書き込み途中のファイルを他のプロセスが読まないよう、一時ディレクトリに書いてからrenameする
+
+        Args:
+            key (str): make_document_keyで作ったドキュメントのキー
+            indexer (faiss.Index): 学習・追加済みのindex
+            page_store (PageStore): ページ番号とテキストを持つページ情報
+            meta (dict): nprobeの調整結果など、indexと一緒に保存しておく情報
+            lexical_index (LexicalIndex): 文字n-gramの転置インデックス
+        """
+        tmp_dir = tempfile.mkdtemp(dir=self.root)
+        faiss.write_index(indexer, os.path.join(tmp_dir, INDEX_FILE))
+        page_store.save(tmp_dir)
+        if lexical_index is not None:
+            lexical_index.save(tmp_dir)
+        with open(os.path.join(tmp_dir, META_FILE), "w", encoding="utf-8") as f:
+            json.dump(meta or {}, f, ensure_ascii=False)
+        try:
+            os.rename(tmp_dir, self.path(key))
+        except OSError:
+            # 別のプロセスが先に同じキーで保存していた場合はそちらを使う
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def load(self, key: str) -> Tuple[faiss.Index, PageStore]:
+        """
+        保存済みのindexをメモリマップで読み込むメソッド
+
+        Args:
+            key (str): make_document_keyで作ったドキュメントのキー
+
+        Returns:
+            indexer (faiss.Index): メモリマップで読み込んだindex
+            page_store (PageStore): メモリマップで読み込んだページ情報
+        """
+        return self.load_index(key), self.load_pages(key)
+
+    def load_index(self, key: str, mmap: bool = True) -> faiss.Index:
+        # 後からベクトルを追加するindexはメモリマップだと書き込めないので、mmap=Falseでメモリ上に読み込む
+        return faiss.read_index(os.path.join(self.path(key), INDEX_FILE), faiss.IO_FLAG_MMAP if mmap else 0)
+
+    def load_pages(self, key: str) -> PageStore:
+        return PageStore.load(self.path(key))
+
+    def load_lexical(self, key: str) -> Optional[LexicalIndex]:
+        # 転置インデックスを作る前に保存されたドキュメントにはファイルが無いのでNoneを返す
+        return LexicalIndex.load(self.path(key)) if LexicalIndex.exists(self.path(key)) else None
+
+    def load_meta(self, key: str) -> dict:
+        try:
+            with open(os.path.join(self.path(key), META_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_channels(self, channels: Dict[str, List[str]]):
+        """チャンネルごとに投稿されたドキュメントのキーを保存する。再起動後もチャンネルとPDFの対応を引き継ぐため"""
+        tmp_path = os.path.join(self.root, f".{CHANNELS_FILE}.{os.getpid()}")
+        with open(tmp_path, "w") as f:
+            json.dump(channels, f)
+        os.replace(tmp_path, os.path.join(self.root, CHANNELS_FILE))
+
+    def load_channels(self) -> Dict[str, List[str]]:
+        try:
+            with open(os.path.join(self.root, CHANNELS_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from slack_sdk.errors import SlackApiError
+
+# PDFの読み込み（ダウンロード・parse・embedding）を同時に実行するワーカー数
+INGESTION_WORKERS = int(os.environ.get("INGESTION_WORKERS", 2))
+# 進捗のステータスメッセージを更新する最短の間隔（秒）。chat.updateのレートリミットに引っかからないようにする
+PROGRESS_INTERVAL = float(os.environ.get("INGESTION_PROGRESS_INTERVAL", 3))
+# 読み込み中のチャンネルに質問が来た時に、読み込みの完了を待つ時間の上限（秒）
+INGESTION_WAIT_TIMEOUT = float(os.environ.get("INGESTION_WAIT_TIMEOUT", 10 * 60))
+
+
+class IngestionJob:
+    """
+    1つのPDFの読み込み処理。進捗は1つのステータスメッセージをchat.updateで書き換えて知らせる
+    最初のメッセージだけchat.postMessageで投稿し、以降は同じメッセージを更新するのでチャンネルが流れない
+    clientにはWebClientの代わりにSlackOutboxも渡せる（その場合は送信を待たずに戻り、送信の失敗はSlackOutboxがログに残す）
+    """
+    def __init__(self, client, channel: str, event: dict):
+        self.client = client
+        self.channel = channel
+        self.event = event
+        self.status_ts: Optional[str] = None
+        self.pages_parsed = 0
+        self.chunks_embedded = 0
+        self.error: Optional[BaseException] = None
+        self.finished = threading.Event()
+        self.last_update = 0.0
+        # 完了や失敗のメッセージを書いた後は、遅れて届いた進捗で上書きしない
+        self.closed = False
+        # 進捗の通知はembeddingのワーカーからも呼ばれるので、メッセージの更新を直列化する
+        self.lock = threading.Lock()
+
+    def post_status(self, text: str, is_progress: bool = False):
+        """ステータスメッセージを書き換える（まだ投稿していなければ投稿する）"""
+        with self.lock:
+            if is_progress and self.closed:
+                return
+            self.closed = not is_progress
+            self.last_update = time.monotonic()
+            try:
+                if self.status_ts is None:
+                    self.status_ts = self.client.chat_postMessage(channel=self.channel, text=text)["ts"]
+                else:
+                    self.client.chat_update(channel=self.channel, ts=self.status_ts, text=text)
+            except SlackApiError as e:
+                # 進捗が伝えられなくても読み込み自体は続ける
+                print(f"Error updating ingestion status: {e}")
+
+    def say(self, text: str = "", **kwargs):
+        """Boltのsayの代わりに渡す関数。読み込み中のメッセージは全てステータスメッセージの書き換えにする"""
+        self.post_status(text or kwargs.get("text", ""))
+
+    def report_progress(self, pages_parsed: Optional[int] = None, chunks_embedded: Optional[int] = None):
+        """parseしたページ数とembeddingしたチャンク数を更新し、前回の更新からPROGRESS_INTERVAL秒経っていれば書き換える"""
+        if pages_parsed is not None:
+            self.pages_parsed = pages_parsed
+        if chunks_embedded is not None:
+            self.chunks_embedded = chunks_embedded
+        if time.monotonic() - self.last_update < PROGRESS_INTERVAL:
+            return
+        self.post_status(f"PDFを読み込み中だよ。parse: {self.pages_parsed}ページ / embedding: {self.chunks_embedded}チャンク",
+                         is_progress=True)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """読み込みが終わるまで待つ。時間内に終わればTrue"""
+        return self.finished.wait(timeout)
+
+
+class IngestionQueue:
+    """
+    PDFの読み込みを専用のワーカーで順番に実行するキュー
+    Boltのリスナーはジョブを積むだけですぐに戻るので、長いPDFの読み込み中も他のイベントが待たされない
+    チャンネルごとに読み込み中のジョブを覚えておき、質問が来たらその完了を待てるようにする
+    """
+    def __init__(self, process: Callable[[IngestionJob], None], workers: int = INGESTION_WORKERS):
+        self.process = process
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingestion")
+        # チャンネル -> 読み込みが終わっていないジョブ
+        self.jobs: Dict[str, List[IngestionJob]] = {}
+        self.lock = threading.Lock()
+
+    def submit(self, job: IngestionJob) -> IngestionJob:
+        with self.lock:
+            self.jobs.setdefault(job.channel, []).append(job)
+            n_waiting = sum(len(jobs) for jobs in self.jobs.values())
+        if n_waiting > self.workers:
+            job.post_status(f"ファイルを受け取ったよ。他のPDFを読み込み中だから、順番が来たら読み始めるね。（待ち: {n_waiting - self.workers}件）",
+                            is_progress=True)
+        else:
+            job.post_status("ファイルを受け取ったよ。なかなか良いドキュメントだね。まずは内容を頭に入れるからちょっと待ってね。",
+                            is_progress=True)
+        self.executor.submit(self.run, job)
+        return job
+
+    def run(self, job: IngestionJob):
+        try:
+            self.process(job)
+        except Exception as e:
+            # ワーカーの中の例外は誰も拾わないので、ここでログとステータスメッセージに残す
+            print(f"Failed to ingest file: {e}")
+            job.error = e
+            job.post_status("ごめんね。PDFの読み込みに失敗しちゃった。もう一度投稿してみてね。")
+        finally:
+            with self.lock:
+                jobs = self.jobs.get(job.channel, [])
+                if job in jobs:
+                    jobs.remove(job)
+                if not jobs:
+                    self.jobs.pop(job.channel, None)
+            job.finished.set()
+
+    def pending(self, channel: str) -> List[IngestionJob]:
+        """チャンネルで読み込みが終わっていないジョブ"""
+        with self.lock:
+            return list(self.jobs.get(channel, []))
+
+    def wait_for_channel(self, channel: str, timeout: float = INGESTION_WAIT_TIMEOUT) -> bool:
+        """チャンネルの読み込み中のジョブが全て終わるまで待つ。時間内に終わればTrue"""
+        deadline = time.monotonic() + timeout
+        for job in self.pending(channel):
+            if not job.wait(max(0.0, deadline - time.monotonic())):
+                return False
+        return True
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
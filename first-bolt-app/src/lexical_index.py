@@ -0,0 +1,201 @@
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass, replace
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from embedding_cache import normalize_text
+from page_store import PageRow
+
+# 文字n-gramの長さ。日本語は単語の区切りが無いので、形態素解析の代わりに2-gramと3-gramを索引語にする
+NGRAM_SIZES = (2, 3)
+# BM25のパラメータ（tfの飽和の強さと、文書の長さによる補正の強さ）
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Reciprocal Rank Fusionの定数。大きいほど上位と下位の差が小さくなる
+RRF_K = 60
+TERMS_FILE = "lexical_terms.json"
+POSTING_OFFSETS_FILE = "lexical_offsets.npy"
+POSTING_DOCS_FILE = "lexical_docs.npy"
+POSTING_TFS_FILE = "lexical_tfs.npy"
+DOC_LENGTHS_FILE = "lexical_lengths.npy"
+
+# 「」や""で囲まれた語と、英字と数字の両方を含む並び（型番・バージョン・品番など）は完全一致で探したい語とみなす
+# 「10月」「2023年」のような数字だけの並びは普通の質問にも出てくるので含めない（ベクトル探索と統合したBM25で拾う）
+QUOTED_PATTERN = re.compile(r"[「『\"“]([^」』\"”]+)[」』\"”]")
+IDENTIFIER_PATTERN = re.compile(r"(?<![A-Za-z0-9_\-./])(?=[A-Za-z0-9_\-./]*[A-Za-z])(?=[A-Za-z0-9_\-./]*\d)[A-Za-z0-9][A-Za-z0-9_\-./]*")
+
+
+def normalize_for_match(text: str) -> str:
+    """全角/半角と大文字/小文字の揺れを吸収し、空白を取り除く"""
+    return "".join(normalize_text(text).lower().split())
+
+
+def char_ngrams(text: str, sizes: Tuple[int, ...] = NGRAM_SIZES) -> List[str]:
+    text = normalize_for_match(text)
+    return [text[i:i + n] for n in sizes for i in range(len(text) - n + 1)]
+
+
+def extract_exact_terms(query: str) -> List[str]:
+    """質問から完全一致で探すべき語（括弧で囲まれた語や、英字と数字を含む型番）を取り出す"""
+    query = normalize_text(query)
+    # 文末の「.」などが型番にくっつかないよう、末尾の記号は除く
+    identifiers = [term.rstrip("_-./") for term in IDENTIFIER_PATTERN.findall(query)]
+    terms = (normalize_for_match(term) for term in QUOTED_PATTERN.findall(query) + identifiers)
+    # 括弧で囲まれた型番は両方の規則に当たるので、順番を保ったまま重複を除く
+    return list(dict.fromkeys(term for term in terms if len(term) >= 2))
+
+
+@dataclass
+class CollectionStats:
+    """
+    複数の転置インデックスを1つのコレクションとみなして順位付けするための、BM25の統計量
+    ドキュメントごとの転置インデックスはそれぞれ文書数・平均の長さ・索引語の出現文書数が違うので、
+    そのままではBM25のスコアを比べられない。チャンネルの全ドキュメントで数えた統計量を使えば比べられる
+    """
+    n_docs: int
+    average_length: float
+    # 質問に含まれる索引語ごとの、その語を含む文書の数
+    document_frequencies: Dict[str, int]
+
+    @classmethod
+    def from_indexes(cls, indexes: Sequence["LexicalIndex"], query: str) -> "CollectionStats":
+        n_docs = sum(len(index) for index in indexes)
+        total_length = sum(index.total_length for index in indexes)
+        document_frequencies = Counter()
+        for index in indexes:
+            document_frequencies.update(index.document_frequencies(query))
+        return cls(n_docs, total_length / n_docs if n_docs else 0.0, dict(document_frequencies))
+
+
+class LexicalIndex:
+    """
+    チャンクのテキストを文字n-gramで索引した転置インデックス。BM25で順位付けする
+    embeddingが苦手な型番・数字・固有名詞の完全一致に強く、APIを呼ばずにマイクロ秒で引ける
+    転置リストはCSR形式（索引語ごとの開始位置と、文書番号・出現回数の配列）でnumpy配列に持つ
+    """
+    def __init__(self, terms: List[str], offsets: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray, doc_lengths: np.ndarray):
+        # terms: 索引語の一覧（並び順が索引語の番号）、offsets: 索引語ごとの転置リストの開始位置（索引語数+1個）
+        # doc_ids, tfs: 転置リスト本体（文書番号と出現回数）、doc_lengths: 文書ごとのn-gramの数
+        self.terms = terms
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.average_length = float(np.mean(doc_lengths)) if len(doc_lengths) else 0.0
+
+    @classmethod
+    def from_texts(cls, texts: Iterable[str]) -> "LexicalIndex":
+        postings = defaultdict(list)
+        doc_lengths = []
+        for doc_id, text in enumerate(texts):
+            ngrams = char_ngrams(text)
+            doc_lengths.append(len(ngrams))
+            for term, tf in Counter(ngrams).items():
+                postings[term].append((doc_id, tf))
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype="int64")
+        np.cumsum([len(postings[term]) for term in terms], out=offsets[1:])
+        pairs = np.array([pair for term in terms for pair in postings[term]], dtype="int32").reshape(-1, 2)
+        return cls(terms, offsets, np.ascontiguousarray(pairs[:, 0]), np.ascontiguousarray(pairs[:, 1]),
+                   np.array(doc_lengths, dtype="int32"))
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    @property
+    def nbytes(self) -> int:
+        # 索引語の辞書はPythonのオブジェクトなので、1語あたり100バイト程度として見積もる
+        return self.offsets.nbytes + self.doc_ids.nbytes + self.tfs.nbytes + self.doc_lengths.nbytes + len(self.terms) * 100
+
+    @property
+    def total_length(self) -> int:
+        return int(np.sum(self.doc_lengths))
+
+    def document_frequencies(self, query: str) -> Dict[str, int]:
+        """質問に含まれる索引語ごとの、その語を含む文書の数"""
+        frequencies = {}
+        for term in set(char_ngrams(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is not None:
+                frequencies[term] = int(self.offsets[term_id + 1] - self.offsets[term_id])
+        return frequencies
+
+    def search(self, query: str, k: int, stats: Optional[CollectionStats] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        質問に含まれる文字n-gramでBM25のスコアを計算し、上位k件を返すメソッド
+
+        Args:
+            query (str): 質問文
+            k (int): 返す件数
+            stats (CollectionStats): 複数の転置インデックスのスコアを比べる場合の、全体で数えた統計量。Noneならこのindexだけで数える
+
+        Returns:
+            scores (np.ndarray): スコアの高い順に並べたBM25のスコア（0より大きいものだけ）
+            idx (np.ndarray): その文書番号
+        """
+        n = stats.n_docs if stats is not None else len(self)
+        average_length = stats.average_length if stats is not None else self.average_length
+        scores = np.zeros(len(self), dtype="float32")
+        for term in set(char_ngrams(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs, tfs = self.doc_ids[start:end], self.tfs[start:end]
+            df = stats.document_frequencies.get(term, len(docs)) if stats is not None else len(docs)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[docs] / average_length)
+            scores[docs] += idf * tfs * (BM25_K1 + 1) / (tfs + norm)
+        idx = np.flatnonzero(scores > 0)
+        idx = idx[np.argsort(-scores[idx], kind="stable")[:k]]
+        return scores[idx], idx
+
+    def save(self, directory: str):
+        with open(os.path.join(directory, TERMS_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.terms, f, ensure_ascii=False)
+        np.save(os.path.join(directory, POSTING_OFFSETS_FILE), self.offsets)
+        np.save(os.path.join(directory, POSTING_DOCS_FILE), self.doc_ids)
+        np.save(os.path.join(directory, POSTING_TFS_FILE), self.tfs)
+        np.save(os.path.join(directory, DOC_LENGTHS_FILE), self.doc_lengths)
+
+    @classmethod
+    def load(cls, directory: str) -> "LexicalIndex":
+        # 転置リストはメモリマップで読み込むので、質問に含まれる索引語の分だけが実際に読み込まれる
+        with open(os.path.join(directory, TERMS_FILE), encoding="utf-8") as f:
+            terms = json.load(f)
+        return cls(terms,
+                   np.load(os.path.join(directory, POSTING_OFFSETS_FILE), mmap_mode="r"),
+                   np.load(os.path.join(directory, POSTING_DOCS_FILE), mmap_mode="r"),
+                   np.load(os.path.join(directory, POSTING_TFS_FILE), mmap_mode="r"),
+                   np.load(os.path.join(directory, DOC_LENGTHS_FILE), mmap_mode="r"))
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, TERMS_FILE))
+
+
+def reciprocal_rank_fusion(rankings: List[List[PageRow]], k: int = RRF_K) -> List[PageRow]:
+    """
+    複数の探索結果の順位を1/(k+順位)の和で統合する（Reciprocal Rank Fusion）
+    ベクトル探索の類似度とBM25のスコアは尺度が違うので、スコアではなく順位だけを使う
+
+    Args:
+        rankings (List[List[PageRow]]): それぞれ良い順に並んだ探索結果
+        k (int): RRFの定数
+
+    Returns:
+        rows (List[PageRow]): 統合したスコアの高い順に並べた行。distanceは統合したスコア
+    """
+    scores = defaultdict(float)
+    rows = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            key = (row.document, row.index)
+            scores[key] += 1 / (k + rank + 1)
+            rows.setdefault(key, row)
+    return [replace(rows[key], distance=score) for key, score in sorted(scores.items(), key=lambda item: -item[1])]
@@ -0,0 +1,194 @@
+import ast
+import contextvars
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import langchain
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from langchain.schema import BaseCache, Generation
+
+# キャッシュファイルの置き場所。複数のbotで同じファイルを共有する
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", ".cache/llm_responses.sqlite3")
+# 回答の有効期限（秒）。元の文書が更新されても古い要約を返し続けないようにする
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", 7 * 24 * 60 * 60))
+# キャッシュに保持する最大件数
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 10000))
+# 1にするとキャッシュを参照せずに必ずAPIを呼ぶ（新しい回答でキャッシュは上書きされる）
+LLM_CACHE_BYPASS = os.environ.get("LLM_CACHE_BYPASS", "0") == "1"
+# temperatureがこれより高い呼び出しはキャッシュしない（毎回違う回答を期待している呼び出しなので）
+LLM_CACHE_MAX_TEMPERATURE = float(os.environ.get("LLM_CACHE_MAX_TEMPERATURE", 0))
+# llm_stringに含まれるパラメータのうち、回答の中身に影響しないもの（キーに含めない）
+# streamingの有無でキーが変わらないので、ストリーミングモードで作った回答も通常モードで使える
+IGNORED_PARAMS = {"streaming", "openai_api_key", "openai_api_base", "openai_organization", "openai_proxy",
+                  "request_timeout", "max_retries", "verbose", "callbacks", "callback_manager", "tags", "metadata"}
+
+_bypass = contextvars.ContextVar("llm_cache_bypass", default=False)
+
+
+@contextmanager
+def bypass_llm_cache():
+    """このブロックの中のLLMの呼び出しだけキャッシュを参照しない（スレッドやasyncioのタスクごとに効く）"""
+    token = _bypass.set(True)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def parse_llm_string(llm_string: str) -> Tuple[Optional[str], Optional[float], Dict[str, Any]]:
+    """
+    LangChainがキャッシュに渡すllm_stringから、モデル名・temperature・回答に影響するその他のパラメータを取り出す
+    llm_stringはシリアライズできるLLMなら「コンストラクタ引数のJSON---呼び出し時の引数」、
+    それ以外なら「パラメータの(名前, 値)のリスト」の文字列になっている
+
+    Args:
+        llm_string (str): LangChainのllm_string
+
+    Returns:
+        model (str): モデル名（既定値のままで指定されていなければNone）
+        temperature (float): temperature（既定値のままで指定されていなければNone）
+        params (Dict[str, Any]): それ以外の回答に影響するパラメータ
+    """
+    constructor, _, call_params = llm_string.rpartition("---")
+    params = {}
+    try:
+        serialized = json.loads(constructor)
+        params["_type"] = ".".join(serialized.get("id", []))
+        params.update(serialized.get("kwargs", {}))
+        params.update(dict(ast.literal_eval(call_params)))
+    except (ValueError, SyntaxError, TypeError, AttributeError):
+        try:
+            params = dict(ast.literal_eval(llm_string))
+        except (ValueError, SyntaxError, TypeError):
+            # 形式が分からなければllm_string全体をパラメータとして扱う
+            params = {"llm_string": llm_string}
+    params = {name: value for name, value in params.items() if name not in IGNORED_PARAMS}
+    model = params.pop("model_name", None) or params.pop("model", None)
+    temperature = params.pop("temperature", None)
+    return model, (float(temperature) if temperature is not None else None), params
+
+
+def make_key(model: Optional[str], temperature: Optional[float], params: Dict[str, Any], prompt: str) -> str:
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    identity = json.dumps([model, temperature, sorted(params.items(), key=lambda item: item[0]), prompt_hash],
+                          ensure_ascii=False, default=str)
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache(BaseCache):
+    """
+    (モデル名, temperature, 展開済みのプロンプトのハッシュ)をキーにしてLLMの回答を保存するSQLiteのキャッシュ
+    langchain.llm_cacheに設定すると、LLMChain.runやload_summarize_chainなど全てのchainのLLM呼び出しで使われる
+    temperatureが0の呼び出しは同じプロンプトなら同じ回答になるので、2回目以降はAPIを呼ばずにミリ秒で返せる
+    有効期限を過ぎた回答は参照された時に捨て、件数が上限を超えたら最後に参照された時刻が古いものから削除する（LRU）
+    """
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl: float = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 bypass: bool = LLM_CACHE_BYPASS, max_temperature: float = LLM_CACHE_MAX_TEMPERATURE):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.max_temperature = max_temperature
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Boltのリスナーは別スレッドで動くのでロックで直列化する
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # 複数プロセスから同じファイルを読み書きできるようにWALモードにする
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                temperature REAL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_last_access ON llm_responses (last_access)")
+        self.conn.commit()
+
+    def is_cacheable(self, temperature: Optional[float]) -> bool:
+        # temperatureが既定値のまま（OpenAIのモデルは0.7）なら、毎回違う回答を期待しているとみなしてキャッシュしない
+        return temperature is not None and temperature <= self.max_temperature
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        model, temperature, params = parse_llm_string(llm_string)
+        if self.bypass or _bypass.get() or not self.is_cacheable(temperature):
+            return None
+        key = make_key(model, temperature, params, prompt)
+        with self.lock:
+            row = self.conn.execute("SELECT response, created_at FROM llm_responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and time.time() - row[1] > self.ttl:
+                self.conn.execute("DELETE FROM llm_responses WHERE key = ?", (key,))
+                self.conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE llm_responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            self.hits += 1
+        return [loads(generation) for generation in json.loads(row[0])]
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        model, temperature, params = parse_llm_string(llm_string)
+        if not self.is_cacheable(temperature):
+            return
+        key = make_key(model, temperature, params, prompt)
+        # ChatGenerationのメッセージも復元できるよう、LangChainのシリアライズ形式で保存する
+        response = json.dumps([dumps(generation) for generation in return_val], ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO llm_responses VALUES (?, ?, ?, ?, ?, ?)",
+                              (key, model, temperature, response, now, now))
+            self.evict()
+            self.conn.commit()
+
+    def clear(self, **kwargs: Any) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM llm_responses")
+            self.conn.commit()
+
+    def evict(self):
+        # 上限を超えた分だけ、最終参照時刻の古いものから削除する
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM llm_responses").fetchone()
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM llm_responses WHERE key IN (SELECT key FROM llm_responses ORDER BY last_access LIMIT ?)",
+                (count - self.max_entries,))
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM llm_responses").fetchone()[0]
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> str:
+        return f"llm cache: hits={self.hits} misses={self.misses} hit_ratio={self.hit_ratio:.1%} entries={len(self)}"
+
+
+def install_llm_cache(cache: Optional[LLMResponseCache] = None) -> LLMResponseCache:
+    """
+    LangChainのキャッシュの差し込み口（langchain.llm_cache）にLLMResponseCacheを設定する
+    既に設定済みならそれを使うので、複数のモジュールから呼んでもキャッシュは1つになる
+    """
+    if cache is not None or not isinstance(langchain.llm_cache, LLMResponseCache):
+        # 空のLLMResponseCacheは__len__が0で偽になるので、Noneかどうかで判定する
+        langchain.llm_cache = cache if cache is not None else LLMResponseCache()
+    return langchain.llm_cache
@@ -0,0 +1,217 @@
+"""
+同期のAppとAsyncAppで、同時にたくさんの会話が来た時の処理時間を比べる負荷試験
+SlackやOpenAIには繋がず、次のように置き換えて、Boltのイベント処理の部分は本物を使う
+- Slack Web API: 別プロセスで立てたローカルのHTTPサーバー（--slack-latency秒待ってok: trueを返す）
+- LLM: chain.run / chain.arunと同じ形で--llm-latency秒待つFakeChain
+app.pyとapp_async.pyと同じ形のリスナー（受付のメッセージ → LLM → 回答のメッセージ）を登録し、
+Socket Modeで届いたイベントと同じBoltRequestを--conversations件まとめてdispatchする
+
+同期のAppはリスナーをスレッドプール（Boltの既定は10スレッド）で実行するので、LLMの応答を待つ間もスレッドを専有し、
+同時に進む会話の数はスレッド数で頭打ちになる。AsyncAppは1つのイベントループで全ての会話を同時に待てる
+
+使い方:
+    python load_test_bolt.py --conversations 200 --llm-latency 2 --output load_test_results.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import numpy as np
+
+TOKEN = "xoxb-load-test"
+BOT_USER_ID = "U0LOADBOT"
+TEAM_ID = "T0LOADTEST"
+CHANNEL = "C0LOADTEST"
+# Boltの同期のAppがリスナーの実行に使うスレッド数の既定値
+BOLT_LISTENER_WORKERS = 10
+
+
+class FakeChain:
+    """chain.run / chain.arunの代わりに、LLMの応答時間だけ待って固定の回答を返す"""
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def run(self, **kwargs) -> str:
+        time.sleep(self.latency)
+        return "回答です。"
+
+    async def arun(self, **kwargs) -> str:
+        await asyncio.sleep(self.latency)
+        return "回答です。"
+
+
+class SlackAPIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 数百の同時接続を受けるので、listenのbacklogを既定の5から増やす
+    request_queue_size = 1024
+
+
+def serve_slack_api(port_queue, latency: float):
+    """どのAPIメソッドにもlatency秒待ってから成功のレスポンスを返す、Slack Web APIの代わりのサーバー"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency)
+            body = json.dumps({"ok": True, "channel": CHANNEL, "ts": f"{time.time():.6f}", "user_id": BOT_USER_ID,
+                               "bot_id": "B0LOADBOT", "team_id": TEAM_ID, "user": "loadbot", "team": "load test",
+                               "url": "https://load-test.slack.com/"}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    server = SlackAPIServer(("127.0.0.1", 0), Handler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def event_body(i: int) -> dict:
+    """Socket Modeで届くmessageイベントと同じ形のリクエストボディ"""
+    return {
+        "token": "load-test",
+        "team_id": TEAM_ID,
+        "api_app_id": "A0LOADTEST",
+        "type": "event_callback",
+        "event_id": f"Ev{i:08d}",
+        "event_time": int(time.time()),
+        "authorizations": [{"enterprise_id": None, "team_id": TEAM_ID, "user_id": BOT_USER_ID, "is_bot": True}],
+        "event": {"type": "message", "channel": CHANNEL, "channel_type": "channel", "user": f"U{i:08d}",
+                  "text": f"質問{i}", "ts": f"{i}.000000", "event_ts": f"{i}.000000"},
+    }
+
+
+def summarize(mode: str, n: int, llm_latency: float, wall_seconds: float, latencies: List[float], peak_threads: int) -> dict:
+    return {
+        "mode": mode,
+        "conversations": n,
+        "llm_latency": llm_latency,
+        "wall_seconds": wall_seconds,
+        "conversations_per_sec": n / wall_seconds,
+        "p50_seconds": float(np.percentile(latencies, 50)),
+        "p99_seconds": float(np.percentile(latencies, 99)),
+        "peak_threads": peak_threads,
+    }
+
+
+def run_sync(n: int, llm_latency: float, base_url: str, workers: int, timeout: float) -> dict:
+    """同期のAppでn件の会話を同時に受けて、全ての回答が返るまでの時間を計測する"""
+    from slack_bolt import App, BoltRequest
+    from slack_sdk import WebClient
+
+    app = App(client=WebClient(token=TOKEN, base_url=base_url), listener_executor=ThreadPoolExecutor(max_workers=workers))
+    chain = FakeChain(llm_latency)
+    started = {}
+    latencies = []
+    peak_threads = [threading.active_count()]
+    lock = threading.Lock()
+    finished = threading.Event()
+
+    @app.event("message")
+    def handle_message_events(body, say):
+        say(text="回答を生成しています。しばらくお待ちください。")
+        say(chain.run(text=body["event"]["text"]))
+        with lock:
+            latencies.append(time.perf_counter() - started[body["event"]["ts"]])
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            if len(latencies) == n:
+                finished.set()
+
+    start = time.perf_counter()
+    for i in range(n):
+        body = event_body(i)
+        started[body["event"]["ts"]] = time.perf_counter()
+        app.dispatch(BoltRequest(body=body, mode="socket_mode"))
+    if not finished.wait(timeout):
+        raise TimeoutError(f"sync: {timeout}秒以内に{n}件中{len(latencies)}件しか回答できませんでした")
+    return summarize(f"sync ({workers} threads)", n, llm_latency, time.perf_counter() - start, latencies, peak_threads[0])
+
+
+async def run_async(n: int, llm_latency: float, base_url: str, timeout: float) -> dict:
+    """AsyncAppでn件の会話を同時に受けて、全ての回答が返るまでの時間を計測する"""
+    from slack_bolt.async_app import AsyncApp
+    from slack_bolt.request.async_request import AsyncBoltRequest
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    app = AsyncApp(client=AsyncWebClient(token=TOKEN, base_url=base_url))
+    chain = FakeChain(llm_latency)
+    started = {}
+    latencies = []
+    peak_threads = [threading.active_count()]
+    finished = asyncio.Event()
+
+    @app.event("message")
+    async def handle_message_events(body, say):
+        await say(text="回答を生成しています。しばらくお待ちください。")
+        await say(await chain.arun(text=body["event"]["text"]))
+        latencies.append(time.perf_counter() - started[body["event"]["ts"]])
+        peak_threads[0] = max(peak_threads[0], threading.active_count())
+        if len(latencies) == n:
+            finished.set()
+
+    start = time.perf_counter()
+    for i in range(n):
+        body = event_body(i)
+        started[body["event"]["ts"]] = time.perf_counter()
+        await app.async_dispatch(AsyncBoltRequest(body=body, mode="socket_mode"))
+    try:
+        await asyncio.wait_for(finished.wait(), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"async: {timeout}秒以内に{n}件中{len(latencies)}件しか回答できませんでした")
+    return summarize("async", n, llm_latency, time.perf_counter() - start, latencies, peak_threads[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同期のAppとAsyncAppで、同時に来た会話を捌く時間を比べる")
+    parser.add_argument("--conversations", type=int, default=200, help="同時に始まる会話の数")
+    parser.add_argument("--llm-latency", type=float, default=2.0, help="LLMの応答にかかる秒数")
+    parser.add_argument("--slack-latency", type=float, default=0.05, help="Slack Web APIの応答にかかる秒数")
+    parser.add_argument("--workers", type=int, default=BOLT_LISTENER_WORKERS, help="同期のAppのリスナーのスレッド数")
+    parser.add_argument("--modes", default="sync,async", help="計測するモード（sync, async）")
+    parser.add_argument("--output", help="結果を書き出すJSONファイル")
+    args = parser.parse_args()
+
+    # Slack Web APIの代わりのサーバーは、スレッド数の計測に混ざらないよう別プロセスで動かす
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_slack_api, args=(port_queue, args.slack_latency), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=10)}/api/"
+    # 全ての会話が直列に処理されても終わる時間を上限にする
+    timeout = args.conversations * (args.llm_latency + 2 * args.slack_latency) + 60
+
+    results = []
+    try:
+        for mode in args.modes.split(","):
+            if mode == "sync":
+                result = run_sync(args.conversations, args.llm_latency, base_url, args.workers, timeout)
+            elif mode == "async":
+                result = asyncio.run(run_async(args.conversations, args.llm_latency, base_url, timeout))
+            else:
+                raise ValueError(f"unknown mode: {mode}")
+            print(json.dumps(result, ensure_ascii=False))
+            results.append(result)
+    finally:
+        server.terminate()
+
+    by_mode = {result["mode"].split()[0]: result for result in results}
+    if "sync" in by_mode and "async" in by_mode:
+        speedup = by_mode["sync"]["wall_seconds"] / by_mode["async"]["wall_seconds"]
+        print(f"asyncはsyncの{speedup:.1f}倍の速さで全ての会話に回答しました")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
-from notion_client import Client
+from notion_client import AsyncClient, Client
+
+# 週報のデータベースのID
+WEEKLY_REPORT_DATABASE_ID = "01be2b6ddec849d199e6c4f555accc98"
 
 
 class NotionWeeklyReportFetcher:
@@ -16,9 +19,11 @@ class NotionWeeklyReportFetcher:
 
     def fetch_records_for_week(self, semester, week):
         # データベースからすべてのレコードを取得
-        pages = self.notion_client.databases.query(
-            database_id="01be2b6ddec849d199e6c4f555accc98")["results"]
+        pages = self.notion_client.databases.query(database_id=WEEKLY_REPORT_DATABASE_ID)["results"]
+        return self.records_for_week(pages, semester, week)
 
+    def records_for_week(self, pages, semester, week):
+        """データベースのレコードから、指定された学期と週の週報だけを取り出す"""
         results = []
         # 各レコードに対して
         for page in pages:
@@ -50,3 +55,16 @@ class NotionWeeklyReportFetcher:
                 results.append(row)
 
         return self.preprocess(results)
+
+
+class AsyncNotionWeeklyReportFetcher(NotionWeeklyReportFetcher):
+    """
+    NotionのAsyncClientで週報を取得するAsyncApp用のfetcher
+    データベースは1回だけ問い合わせて、全ての週の分をまとめて取り出す
+    """
+    def __init__(self, api_key):
+        self.notion_client = AsyncClient(auth=api_key)
+
+    async def fetch_records_for_weeks(self, semester, weeks):
+        pages = (await self.notion_client.databases.query(database_id=WEEKLY_REPORT_DATABASE_ID))["results"]
+        return [self.records_for_week(pages, semester, week) for week in weeks]
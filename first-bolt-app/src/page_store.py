@@ -0,0 +1,92 @@
+import os
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+TEXTS_FILE = "texts.npy"
+OFFSETS_FILE = "offsets.npy"
+PAGE_NUMBERS_FILE = "page_numbers.npy"
+EMBEDDINGS_FILE = "embeddings.npy"
+
+
+@dataclass
+class PageRow:
+    """探索結果の1件分。PageStoreから必要な行だけを取り出して作る"""
+    page_number: int
+    text: str
+    distance: float = 0.0  # 内積のindexでは類似度（大きいほど近い）
+    document: str = ""
+    index: int = -1  # ドキュメント内の行（複数の探索結果を突き合わせる時に使う）
+
+
+class PageStore:
+    """
+    ページ（チャンク）の情報を列ごとにnumpy配列で持つクラス
+    テキストは全件をUTF-8で連結した1つのバッファに入れ、各行の開始位置をoffsetsで持つ
+    ベクトルはFAISSのindexが持っているので、基本的にはここでは持たない（同じベクトルを二重に持たない）
+    indexがベクトルを圧縮して持つ場合だけ、再ランク用に圧縮前のベクトルをembeddingsに持ってディスクに保存する
+    """
+    def __init__(self, texts: np.ndarray, offsets: np.ndarray, page_numbers: np.ndarray,
+                 embeddings: Optional[np.ndarray] = None):
+        # texts: uint8のバッファ、offsets: 行数+1個の開始位置、page_numbers: 行ごとのページ番号
+        # embeddings: 行ごとの正規化済みのfloat32のベクトル（再ランクに使う。無ければNone）
+        self.texts = texts
+        self.offsets = offsets
+        self.page_numbers = page_numbers
+        self.embeddings = embeddings
+
+    @classmethod
+    def from_texts(cls, texts: Iterable[str], page_numbers: Iterable[int]) -> "PageStore":
+        encoded = [text.encode("utf-8") for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype="int64")
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        buffer = np.frombuffer(b"".join(encoded), dtype="uint8")
+        return cls(buffer, offsets, np.fromiter(page_numbers, dtype="int32", count=len(encoded)))
+
+    def __len__(self) -> int:
+        return len(self.page_numbers)
+
+    @property
+    def nbytes(self) -> int:
+        nbytes = self.texts.nbytes + self.offsets.nbytes + self.page_numbers.nbytes
+        # メモリマップで読み込んだembeddingsは再ランクする行しか読まれないので数えない
+        if self.embeddings is not None and not isinstance(self.embeddings, np.memmap):
+            nbytes += self.embeddings.nbytes
+        return nbytes
+
+    def text(self, i: int) -> str:
+        return self.texts[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def rows(self, idx: Iterable[int], distances: Optional[Iterable[float]] = None, document: str = "") -> List[PageRow]:
+        """
+        指定した行だけをPageRowにして返すメソッド。FAISSのsearchが返す-1（該当なし）は取り除く
+
+        Args:
+            idx (Iterable[int]): 取り出す行のインデックス
+            distances (Iterable[float]): 各行の距離（FAISSのsearchの結果）
+            document (str): 行が属するドキュメントのキー
+
+        Returns:
+            rows (List[PageRow]): 取り出した行
+        """
+        idx = list(idx)
+        distances = list(distances) if distances is not None else [0.0] * len(idx)
+        return [PageRow(page_number=int(self.page_numbers[i]), text=self.text(i), distance=float(distance), document=document, index=int(i))
+                for i, distance in zip(idx, distances) if i >= 0]
+
+    def save(self, directory: str):
+        np.save(os.path.join(directory, TEXTS_FILE), self.texts)
+        np.save(os.path.join(directory, OFFSETS_FILE), self.offsets)
+        np.save(os.path.join(directory, PAGE_NUMBERS_FILE), self.page_numbers)
+        if self.embeddings is not None:
+            np.save(os.path.join(directory, EMBEDDINGS_FILE), self.embeddings)
+
+    @classmethod
+    def load(cls, directory: str) -> "PageStore":
+        # メモリマップで読み込むので、探索でヒットした行のテキストだけが実際に読み込まれる
+        embeddings_path = os.path.join(directory, EMBEDDINGS_FILE)
+        return cls(np.load(os.path.join(directory, TEXTS_FILE), mmap_mode="r"),
+                   np.load(os.path.join(directory, OFFSETS_FILE), mmap_mode="r"),
+                   np.load(os.path.join(directory, PAGE_NUMBERS_FILE), mmap_mode="r"),
+                   np.load(embeddings_path, mmap_mode="r") if os.path.exists(embeddings_path) else None)
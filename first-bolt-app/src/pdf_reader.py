@@ -0,0 +1,141 @@
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Dict, Iterator, List
+
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LTPage, LTTextContainer
+from pdfminer.pdfpage import PDFPage
+
+# ページ単位の並列parseに使うプロセス数。1にすると常に1プロセスでparseする
+PARSE_WORKERS = int(os.environ.get("PDF_PARSE_WORKERS", os.cpu_count() or 1))
+# このページ数以上のPDFだけ並列parseする。小さいPDFはプロセス起動のコストの方が大きい
+PARALLEL_THRESHOLD = int(os.environ.get("PDF_PARALLEL_THRESHOLD", 50))
+# 1プロセスあたりの担当ページ範囲を、ワーカー数の何倍に分割するか（処理の重いページの偏りをならす）
+TASKS_PER_WORKER = 4
+# ワーカープロセスの起動方法。Boltのリスナーや送信キューのスレッドが動いているプロセスをforkすると、
+# ロックを握ったままのスレッドの状態を引き継いで固まることがあるので、forkではなくspawnで起動する
+PARSE_START_METHOD = os.environ.get("PDF_PARSE_START_METHOD", "spawn")
+
+# プロセス数 -> 並列parseに使うプロセスプール。PDFごとにプロセスを起動し直さないよう、一度作ったら使い回す
+_parse_pools: Dict[int, ProcessPoolExecutor] = {}
+_parse_pools_lock = threading.Lock()
+
+
+def layout_to_text(page_layout: LTPage) -> str:
+    """1ページ分のレイアウトからテキストを取り出して1行のchunkデータにする"""
+    # ページごとのテキスト内容
+    single_page_text = ""
+    for element in page_layout:
+        # LTTextContainer --> テキストを含むレイアウト要素を表す基本クラス
+        # isinstance --> elementがLTTextContainerのインスタンスかどうかを判定
+        if isinstance(element, LTTextContainer):
+            # get_text() --> elementからテキストを取得
+            # 改行を置換して`single_page_text`に順位追加していくことで
+            # chunkデータに変換している
+            single_page_text += element.get_text().replace("\n", " ")
+    return single_page_text
+
+
+def count_pages(pdf_file: BinaryIO) -> int:
+    """レイアウト解析をせずにページ数だけを数える"""
+    n_pages = sum(1 for _ in PDFPage.get_pages(pdf_file))
+    pdf_file.seek(0)
+    return n_pages
+
+
+def extract_page_range(pdf_path: str, page_numbers: List[int]) -> List[str]:
+    """
+    ワーカープロセスで実行される関数。指定された範囲のページだけをparseする
+    プロセス間で受け渡せるように、ファイルオブジェクトではなくパスを受け取る
+    """
+    return [layout_to_text(page_layout) for page_layout in extract_pages(pdf_path, page_numbers=page_numbers)]
+
+
+def get_parse_pool(workers: int) -> ProcessPoolExecutor:
+    """並列parseに使うプロセスプールを返す。初めて使う時だけ作り、以降はプロセスが起動したままのものを使い回す"""
+    with _parse_pools_lock:
+        executor = _parse_pools.get(workers)
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(PARSE_START_METHOD))
+            _parse_pools[workers] = executor
+        return executor
+
+
+def iter_page_text_parallel(pdf_file: BinaryIO, n_pages: int, workers: int = PARSE_WORKERS) -> Iterator[str]:
+    """
+    ページ範囲を分割して、使い回しのプロセスプールで並列にparseし、ページ順にテキストを返すジェネレータ
+
+    Args:
+        pdf_file (BinaryIO): PDFファイルのバイナリストリーム
+        n_pages (int): PDFのページ数
+        workers (int): parseに使うプロセス数
+
+    Yields:
+        page_text (str): 1ページ分のテキスト
+    """
+    # ワーカーにはパスで渡すので、メモリ上のストリームは一時ファイルに書き出す
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+        shutil.copyfileobj(pdf_file, tmp)
+        tmp.flush()
+        chunk_size = math.ceil(n_pages / (workers * TASKS_PER_WORKER))
+        executor = get_parse_pool(workers)
+        futures = [executor.submit(extract_page_range, tmp.name, list(range(start, min(start + chunk_size, n_pages))))
+                   for start in range(0, n_pages, chunk_size)]
+        try:
+            # 投入した順に結果を待つので、ページ順が保たれる。先頭の範囲が終わり次第後段に流れる
+            for future in futures:
+                yield from future.result()
+        finally:
+            # 途中で読むのをやめた場合は、まだ始まっていない範囲を取り消して他のPDFのためにプールを空ける
+            for future in futures:
+                future.cancel()
+
+
+def iter_page_text(pdf_file: BinaryIO, workers: int = PARSE_WORKERS,
+                   parallel_threshold: int = PARALLEL_THRESHOLD) -> Iterator[str]:
+    """
+    PDFを1回だけparseして、ページのレイアウト解析が終わり次第そのページのテキストを返すジェネレータ
+    extract_pagesは内部でもジェネレータなので、全ページのparseを待たずに後段のembeddingを始められる
+    ページ数がparallel_threshold以上の場合は複数プロセスで並列にparseする
+
+    Args:
+        pdf_file (BinaryIO): PDFファイルのバイナリストリーム
+        workers (int): 並列parseに使うプロセス数
+        parallel_threshold (int): 並列parseに切り替えるページ数
+
+    Yields:
+        page_text (str): 1ページ分のテキスト
+    """
+    if workers > 1:
+        n_pages = count_pages(pdf_file)
+        if n_pages > 0 and n_pages >= parallel_threshold:
+            yield from iter_page_text_parallel(pdf_file, n_pages, workers)
+            return
+    for page_layout in extract_pages(pdf_file):
+        yield layout_to_text(page_layout)
+
+
+if __name__ == "__main__":
+    # 1プロセスと並列parseの実行時間を比較するベンチマーク
+    # 使い方: python pdf_reader.py <PDFファイルのパス> [プロセス数]
+    pdf_path = sys.argv[1]
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else PARSE_WORKERS
+    with open(pdf_path, "rb") as f:
+        print(f"ページ数: {count_pages(f)}")
+        start = time.perf_counter()
+        serial_pages = list(iter_page_text(f, workers=1))
+        serial_time = time.perf_counter() - start
+        f.seek(0)
+        start = time.perf_counter()
+        parallel_pages = list(iter_page_text(f, workers=workers, parallel_threshold=0))
+        parallel_time = time.perf_counter() - start
+    assert serial_pages == parallel_pages, "並列parseの結果が1プロセスの結果と一致しません"
+    print(f"1プロセス: {serial_time:.2f}秒")
+    print(f"{workers}プロセス: {parallel_time:.2f}秒 ({serial_time / parallel_time:.1f}倍)")
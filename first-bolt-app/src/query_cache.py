@@ -0,0 +1,64 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+# 質問クエリのベクトルと回答をプロセス内に保持する件数と有効期限（秒）
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", 1024))
+QUERY_CACHE_TTL = float(os.environ.get("QUERY_CACHE_TTL", 24 * 60 * 60))
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 256))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 60 * 60))
+
+
+class TTLCache:
+    """
+    プロセス内に値を保持するLRUキャッシュ。件数が上限を超えたら最後に参照されたのが古いものから捨てる
+    有効期限を過ぎた値は参照された時に捨てる（回答が古くなりすぎないように）
+    SQLiteのEmbeddingCacheと違ってディスクにも行かないので、同じ質問の繰り返しならミリ秒で返せる
+    """
+    def __init__(self, name: str, max_entries: int, ttl: float):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (保存した時刻, 値)。末尾ほど最近参照されたもの
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        # Boltのリスナーは別スレッドで動くのでロックで直列化する
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> str:
+        return f"{self.name}: hits={self.hits} misses={self.misses} hit_ratio={self.hit_ratio:.1%} entries={len(self)}"
@@ -0,0 +1,328 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from slack_sdk.errors import SlackApiError
+
+# 同じチャンネルにchat.postMessageする最短の間隔（秒）。Slackはチャンネルごとに1秒に1件程度まで
+CHANNEL_POST_INTERVAL = float(os.environ.get("SLACK_CHANNEL_POST_INTERVAL", 1.0))
+# ワークスペース全体で数えられるメソッドの1分あたりの上限（chat.updateとchat.deleteはTier 3）
+METHOD_RATE_LIMITS = {"chat.update": 50, "chat.delete": 50}
+# 送信するスレッドの数。1つのチャンネルの送信は常に1件ずつ順番に行う
+OUTBOX_SENDERS = int(os.environ.get("SLACK_OUTBOX_SENDERS", 4))
+# 429が返った時に、Retry-Afterだけ待って送り直す回数の上限
+OUTBOX_MAX_RETRIES = 5
+
+
+class OutboundMessage(Future):
+    """
+    送信待ちのSlackのAPI呼び出し。送信結果（SlackResponse）はFutureとして受け取れる
+    sayやchat_postMessageのレスポンスの代わりに返すので、["channel"]と["ts"]も引ける
+    まだ投稿されていなければ["ts"]はこのメッセージ自身を返し、SlackOutbox.chat_updateに渡すと投稿後のtsで書き換える
+    """
+    def __init__(self, method: str, channel: str, kwargs: Dict[str, Any], progress: bool = False):
+        super().__init__()
+        self.method = method
+        self.channel = channel
+        self.kwargs = kwargs
+        # 途中経過のメッセージ。続けて積まれた途中経過と1つのメッセージにまとめてよい
+        self.progress = progress
+        self.retries = 0
+
+    def __getitem__(self, key: str) -> Any:
+        if self.done() and self.exception() is None:
+            return self.result()[key]
+        if key == "channel":
+            return self.channel
+        if key == "ts":
+            return self
+        raise KeyError(key)
+
+    def can_merge(self, other: "OutboundMessage") -> bool:
+        # blocksやattachmentsのあるメッセージはテキストだけつなげても壊れるのでまとめない
+        return (self.progress and other.progress and self.method == other.method == "chat.postMessage"
+                and self.kwargs.get("thread_ts") == other.kwargs.get("thread_ts")
+                and set(self.kwargs) <= {"text", "thread_ts"} and set(other.kwargs) <= {"text", "thread_ts"})
+
+
+class ChannelQueue:
+    """1つのチャンネルの送信待ちのメッセージと、次に送信してよい時刻"""
+    def __init__(self):
+        self.messages: Deque[OutboundMessage] = deque()
+        self.next_post = 0.0
+        # 429のRetry-Afterで止められている間は、このチャンネルへの送信を全て止める
+        self.retry_at = 0.0
+        # 送信中のメッセージがあればTrue（チャンネルの中の順番を守るため、1件ずつ送る）
+        self.busy = False
+
+
+class SlackOutbox:
+    """
+    Slackへの投稿とメッセージの書き換えを積んでおき、別スレッドでレートリミットに合わせて送るキュー
+    Boltのリスナーはメッセージを積むだけですぐに戻るので、429のリトライでリスナーのスレッドが止まらない
+    チャンネルごとの投稿の間隔と、メソッドのTierごとの上限を守って送り、429が返ったらRetry-Afterだけ待って送り直す
+    送信待ちの間に同じメッセージへの書き換えが積まれたら最新の内容だけを送り、続けて積まれた途中経過は1つの投稿にまとめる
+    """
+    def __init__(self, client, channel_interval: float = CHANNEL_POST_INTERVAL,
+                 rate_limits: Optional[Dict[str, int]] = None, senders: int = OUTBOX_SENDERS):
+        self.client = client
+        self.channel_interval = channel_interval
+        self.rate_limits = METHOD_RATE_LIMITS if rate_limits is None else rate_limits
+        # チャンネル -> 送信待ちのキュー（送信したチャンネルは末尾に回し、チャンネル間で順番に送る）
+        self.channels: Dict[str, ChannelQueue] = {}
+        # メソッド -> 次に送信してよい時刻
+        self.method_next: Dict[str, float] = {}
+        self.cond = threading.Condition()
+        self.closed = False
+        self.threads = [threading.Thread(target=self.run, name=f"slack-outbox-{i}", daemon=True) for i in range(senders)]
+        for thread in self.threads:
+            thread.start()
+
+    def chat_postMessage(self, channel: str, progress: bool = False, **kwargs) -> OutboundMessage:
+        """WebClient.chat_postMessageの代わり。送信を待たずにOutboundMessageを返す"""
+        return self.enqueue(OutboundMessage("chat.postMessage", channel, kwargs, progress))
+
+    def chat_update(self, channel: str, ts, **kwargs) -> OutboundMessage:
+        """WebClient.chat_updateの代わり。tsにはまだ投稿されていないOutboundMessageも渡せる"""
+        return self.enqueue(OutboundMessage("chat.update", channel, dict(kwargs, ts=ts)))
+
+    def wrap(self, say) -> "OutboxSay":
+        """Boltのsayを、同じチャンネル（とスレッド）に投稿をキューに積むsayに置き換える"""
+        return OutboxSay(self, say.channel, getattr(say, "thread_ts", None))
+
+    def enqueue(self, message: OutboundMessage) -> OutboundMessage:
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("SlackOutbox is closed")
+            queue = self.channels.setdefault(message.channel, ChannelQueue())
+            merged = self.merge(queue, message)
+            if merged is not None:
+                return merged
+            queue.messages.append(message)
+            self.cond.notify()
+        return message
+
+    def merge(self, queue: ChannelQueue, message: OutboundMessage) -> Optional[OutboundMessage]:
+        """送信待ちのメッセージにまとめられればまとめて、まとめた先を返す"""
+        if message.method == "chat.update":
+            for pending in queue.messages:
+                if pending.method == "chat.update" and pending.kwargs["ts"] == message.kwargs["ts"]:
+                    pending.kwargs.update(message.kwargs)
+                    return pending
+        elif queue.messages and queue.messages[-1].can_merge(message):
+            tail = queue.messages[-1]
+            tail.kwargs["text"] = f"{tail.kwargs.get('text', '')}\n{message.kwargs.get('text', '')}"
+            return tail
+        return None
+
+    def ready_at(self, queue: ChannelQueue) -> float:
+        message = queue.messages[0]
+        at = queue.retry_at
+        if message.method == "chat.postMessage":
+            at = max(at, queue.next_post)
+        return max(at, self.method_next.get(message.method, 0.0))
+
+    def take(self) -> Tuple[Optional[OutboundMessage], Optional[float]]:
+        """
+        今送信できるメッセージを取り出す
+
+        Returns:
+            message (OutboundMessage): 送信するメッセージ。無ければNone
+            wait (float): messageがNoneの時、次に送信できるようになるまでの秒数（送信待ちが無ければNone）
+        """
+        now = time.monotonic()
+        wait = None
+        for channel, queue in list(self.channels.items()):
+            if queue.busy:
+                continue
+            if not queue.messages:
+                # 間隔を空ける必要が無くなった空のキューは捨てる
+                if now >= max(queue.next_post, queue.retry_at):
+                    del self.channels[channel]
+                continue
+            at = self.ready_at(queue)
+            if at > now:
+                wait = at - now if wait is None else min(wait, at - now)
+                continue
+            message = queue.messages.popleft()
+            queue.busy = True
+            if message.method == "chat.postMessage":
+                queue.next_post = now + self.channel_interval
+            if message.method in self.rate_limits:
+                self.method_next[message.method] = now + 60 / self.rate_limits[message.method]
+            self.channels[channel] = self.channels.pop(channel)
+            return message, None
+        return None, wait
+
+    def run(self):
+        while True:
+            with self.cond:
+                message, wait = self.take()
+                while message is None:
+                    if self.closed and self.idle():
+                        return
+                    self.cond.wait(wait)
+                    message, wait = self.take()
+            self.send(message)
+
+    def send(self, message: OutboundMessage):
+        kwargs = dict(message.kwargs)
+        try:
+            if isinstance(kwargs.get("ts"), OutboundMessage):
+                # 同じチャンネルのキューは順番に送るので、書き換える元のメッセージはもう送信が終わっている
+                kwargs["ts"] = kwargs["ts"].result(timeout=0)["ts"]
+            response = getattr(self.client, message.method.replace(".", "_"))(channel=message.channel, **kwargs)
+        except SlackApiError as e:
+            if e.response.status_code == 429 and message.retries < OUTBOX_MAX_RETRIES:
+                self.retry_later(message, float(e.response.headers.get("Retry-After", 1)))
+                return
+            self.finish(message, error=e)
+        except Exception as e:
+            self.finish(message, error=e)
+        else:
+            self.finish(message, response=response)
+
+    def retry_later(self, message: OutboundMessage, retry_after: float):
+        print(f"Slack rate limited {message.method}, retrying in {retry_after}s")
+        with self.cond:
+            message.retries += 1
+            retry_at = time.monotonic() + retry_after
+            queue = self.channels.setdefault(message.channel, ChannelQueue())
+            queue.retry_at = max(queue.retry_at, retry_at)
+            if message.method in self.rate_limits:
+                self.method_next[message.method] = max(self.method_next.get(message.method, 0.0), retry_at)
+            # 後から積まれたメッセージより先に送るよう、キューの先頭に戻す
+            queue.messages.appendleft(message)
+            queue.busy = False
+            self.cond.notify_all()
+
+    def finish(self, message: OutboundMessage, response=None, error: Optional[BaseException] = None):
+        with self.cond:
+            queue = self.channels.get(message.channel)
+            if queue is not None:
+                queue.busy = False
+            self.cond.notify_all()
+        if error is not None:
+            # 送信を待っている呼び出し元はいないので、ここでログに残す
+            print(f"Error sending {message.method} to Slack: {error}")
+            message.set_exception(error)
+        else:
+            message.set_result(response)
+
+    def idle(self) -> bool:
+        return all(not queue.messages and not queue.busy for queue in self.channels.values())
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """送信待ちのメッセージが全て送られるまで待つ。時間内に送り終えればTrue"""
+        with self.cond:
+            return self.cond.wait_for(self.idle, timeout)
+
+    def close(self, timeout: Optional[float] = None):
+        """新しいメッセージの受け付けをやめ、送信待ちのメッセージを送り終えたらスレッドを止める"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+class OutboxSay:
+    """Boltのsayの代わりに渡す関数。投稿はSlackOutboxに積むだけで、送信を待たずにOutboundMessageを返す"""
+    def __init__(self, outbox: SlackOutbox, channel: str, thread_ts: Optional[str] = None):
+        self.outbox = outbox
+        self.channel = channel
+        self.thread_ts = thread_ts
+
+    def __call__(self, text="", progress: bool = False, **kwargs) -> OutboundMessage:
+        # Boltのsayと同じく、メッセージ全体をdictで渡すこともできる
+        if isinstance(text, dict):
+            kwargs = dict(text, **kwargs)
+            text = kwargs.pop("text", "")
+        channel = kwargs.pop("channel", None) or self.channel
+        thread_ts = kwargs.pop("thread_ts", None) or self.thread_ts
+        if thread_ts:
+            kwargs["thread_ts"] = thread_ts
+        return self.outbox.chat_postMessage(channel=channel, text=text, progress=progress, **kwargs)
+
+
+class AsyncSlackOutbox:
+    """
+    SlackOutboxのAsyncApp版。AsyncWebClientの送信を、SlackOutboxと同じチャンネルごとの投稿の間隔と
+    メソッドのTierごとの上限に合わせて待ってから送り、429が返ったらRetry-Afterだけasyncio.sleepして送り直す
+    待っている間もイベントループは止まらないので、送信用のスレッドは持たず、呼び出し元は送信の完了をawaitする
+    1つのチャンネルの送信はチャンネルごとのロックで1件ずつ順番に行う
+    """
+    def __init__(self, client, channel_interval: float = CHANNEL_POST_INTERVAL, rate_limits: Optional[Dict[str, int]] = None):
+        self.client = client
+        self.channel_interval = channel_interval
+        self.rate_limits = METHOD_RATE_LIMITS if rate_limits is None else rate_limits
+        self.channel_locks: Dict[str, asyncio.Lock] = {}
+        # チャンネル -> 次にchat.postMessageしてよい時刻
+        self.post_next: Dict[str, float] = {}
+        # チャンネル -> 429のRetry-Afterで止められている間は、このチャンネルへの送信を全て止める
+        self.retry_at: Dict[str, float] = {}
+        # メソッド -> 次に送信してよい時刻
+        self.method_next: Dict[str, float] = {}
+
+    async def chat_postMessage(self, channel: str, **kwargs):
+        """AsyncWebClient.chat_postMessageの代わり。送信できる時刻まで待ってから投稿する"""
+        return await self.send("chat.postMessage", channel, kwargs)
+
+    async def chat_update(self, channel: str, ts: str, **kwargs):
+        """AsyncWebClient.chat_updateの代わり。送信できる時刻まで待ってから書き換える"""
+        return await self.send("chat.update", channel, dict(kwargs, ts=ts))
+
+    def wrap(self, say) -> "AsyncOutboxSay":
+        """Boltのsayを、同じチャンネル（とスレッド）にこの送信キューを通して投稿するsayに置き換える"""
+        return AsyncOutboxSay(self, say.channel, getattr(say, "thread_ts", None))
+
+    async def wait_turn(self, method: str, channel: str):
+        # 送信する時刻を予約してから待つので、同時に待っている他の送信とは時刻が重ならない
+        now = time.monotonic()
+        at = max(now, self.retry_at.get(channel, 0.0), self.method_next.get(method, 0.0))
+        if method == "chat.postMessage":
+            at = max(at, self.post_next.get(channel, 0.0))
+            self.post_next[channel] = at + self.channel_interval
+        if method in self.rate_limits:
+            self.method_next[method] = at + 60 / self.rate_limits[method]
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def send(self, method: str, channel: str, kwargs: Dict[str, Any]):
+        async with self.channel_locks.setdefault(channel, asyncio.Lock()):
+            for retries in range(OUTBOX_MAX_RETRIES + 1):
+                await self.wait_turn(method, channel)
+                try:
+                    return await getattr(self.client, method.replace(".", "_"))(channel=channel, **kwargs)
+                except SlackApiError as e:
+                    if e.response.status_code != 429 or retries == OUTBOX_MAX_RETRIES:
+                        raise
+                    retry_after = float(e.response.headers.get("Retry-After", 1))
+                    print(f"Slack rate limited {method}, retrying in {retry_after}s")
+                    retry_at = time.monotonic() + retry_after
+                    self.retry_at[channel] = max(self.retry_at.get(channel, 0.0), retry_at)
+                    if method in self.rate_limits:
+                        self.method_next[method] = max(self.method_next.get(method, 0.0), retry_at)
+
+
+class AsyncOutboxSay:
+    """OutboxSayのAsyncApp版。投稿はAsyncSlackOutboxを通して送り、レスポンスを返す"""
+    def __init__(self, outbox: AsyncSlackOutbox, channel: str, thread_ts: Optional[str] = None):
+        self.outbox = outbox
+        self.channel = channel
+        self.thread_ts = thread_ts
+
+    async def __call__(self, text="", progress: bool = False, **kwargs):
+        # 途中経過をまとめるのはSlackOutboxだけなので、progressは同期版と同じ呼び方ができるように受け取るだけ
+        if isinstance(text, dict):
+            kwargs = dict(text, **kwargs)
+            text = kwargs.pop("text", "")
+        channel = kwargs.pop("channel", None) or self.channel
+        thread_ts = kwargs.pop("thread_ts", None) or self.thread_ts
+        if thread_ts:
+            kwargs["thread_ts"] = thread_ts
+        return await self.outbox.chat_postMessage(channel=channel, text=text, **kwargs)
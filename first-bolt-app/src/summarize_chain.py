@@ -8,6 +8,7 @@ from langchain.chains.summarize import load_summarize_chain
 from langchain.chat_models import ChatOpenAI
 from langchain.docstore.document import Document
 from langchain.prompts import PromptTemplate
+from llm_cache import install_llm_cache
 
 load_dotenv('./.env')
 
@@ -23,6 +24,8 @@ class Summarizer:
         要約文同士を対照して追加すべきエッセンスを逐次加えていく指示を定義したテンプレートを作成している。
         また、この二つのテンプレートを用いて要約を行うチェーンを定義する。
         """
+        # temperature=0の同じプロンプトへの回答は、APIを呼ばずにSQLiteのキャッシュから返す（importした時にはファイルを作らない）
+        install_llm_cache()
         # 入力された文章の要約を指示するテンプレート
         self.input_prompt = PromptTemplate(template=self.prompt_template,
                                            input_variables=["text"])
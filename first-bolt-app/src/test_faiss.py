@@ -1,13 +1,11 @@
 import os
 import sys
 
-import numpy as np
 import openai
-import pandas as pd
 from copybot_pdf import CoPyBotPDF
 from dotenv import load_dotenv
-from openai import Embedding
-from openai.embeddings_utils import get_embedding
+from index_factory import HNSW_M, IndexSpec, compare_storage_modes
+from page_store import PageStore
 
 load_dotenv()
 openai.api_key = os.environ.get("OPENAI_API_KEY")
@@ -97,23 +95,19 @@ class Test(CoPyBotPDF):
             "バスケットは高速なゲームだね",
             "エクアドルは赤道が通るよ"] * 3
 
-        # 検索対象となるテキスト群をベクトル化
-        response = Embedding.create(input=self.target_texts,
-                                    model="text-embedding-ada-002")
-        # 色んなプロパティを含んでいるresponseの中から、ベクトル表現のみを取り出したリストを作る
-        self.embedding = [record["embedding"] for record in response["data"]]
+        # 検索対象となるテキスト群をベクトル化（2回目以降はキャッシュから読み込まれるのでAPIを呼ばない）
         # ベクトルのnumpy配列を作成（動作確認を行うメソッドで必要）
-        self.embedding_array = np.array(self.embedding).astype("float32")
-        # 検索対象となるテキスト群のDataFrameを作成（動作確認を行うメソッドで必要）
-        self.pages_df = pd.DataFrame(self.target_texts, columns=["text"])
+        self.embedding_array = self.embedder.embed(self.target_texts)
+        # 検索対象となるテキスト群のPageStoreを作成（動作確認を行うメソッドで必要）
+        self.page_store = PageStore.from_texts(self.target_texts, range(1, len(self.target_texts) + 1))
 
 
 if __name__ == "__main__":
     query = "今日は雨振らんくてよかったねえ"
-    query_embedding = get_embedding(query, engine="text-embedding-ada-002")
 
     # CoPyBotPDFを継承したTestクラスを作成
     test = Test()
+    query_embedding = test.embedder.embed_query(query)
 
     # 動作確認用のインスタンス変数を作成
     test.test()
@@ -124,4 +118,15 @@ if __name__ == "__main__":
     test.init_voronoi_indexer()
     # ボロノイ探索を実行。上位3件のテキストを取得
     top_n_pages = test.voronoi_diagram_search(query_embedding)
-    print(top_n_pages.iloc[0, 0])
+    print(top_n_pages[0].text)
+
+    # index-factoryで種類を指定してindexerを作り、同じ質問に対する結果を比べる
+    d = test.embedding_array.shape[1]
+    for spec in [IndexSpec("flat", d), IndexSpec("ivf", d, nlist=3), IndexSpec("hnsw", d, m=HNSW_M),
+                 IndexSpec("flat", d, storage="fp16"), IndexSpec("flat", d, storage="int8")]:
+        test.index_spec = spec
+        test.init_voronoi_indexer()
+        print(spec, test.voronoi_diagram_search(query_embedding)[0].text)
+
+    # ベクトルの保持形式ごとに、1ベクトルあたりのバイト数と総当たり探索に対するrecallの低下を計測する
+    compare_storage_modes(test.embedding_array)
@@ -1,8 +1,25 @@
+import asyncio
+import os
+import threading
+import time
+from functools import lru_cache
 from typing import Any, Dict, List, Union
+from uuid import UUID
 
 import tiktoken
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.schema import AgentAction
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
+from langchain.schema import LLMResult
+from slack_sdk.errors import SlackApiError
+
+# ストリーミング中にメッセージを書き換える最短の間隔（秒）。chat.updateはTier 3（1分あたり50回程度）なので、それを超えない程度にする
+STREAM_UPDATE_INTERVAL = float(os.environ.get("STREAM_UPDATE_INTERVAL", 1.0))
+# 前回の書き換えからこのトークン数が溜まったら、間隔を待たずに書き換える
+STREAM_UPDATE_TOKENS = int(os.environ.get("STREAM_UPDATE_TOKENS", 100))
+# 生成中であることを示すためにメッセージの末尾に付ける印
+STREAM_CURSOR = " ▌"
+STREAM_ERROR_NOTE = "\n（回答の生成中にエラーが発生したため、ここで途切れています）"
+# 最後の書き込みがレートリミットに掛かった時に、Retry-Afterだけ待って試す回数
+STREAM_FINAL_RETRIES = 3
 
 
 class AcademicPeriod:
@@ -25,39 +42,173 @@ ACADEMIC_PERIODS = {
 }
 
 
-class SlackCallbackHandler(BaseCallbackHandler):
-    def __init__(self, say_function):
-        self.say = say_function
-        self.token_count = 0
-        self.content = []
+class SlackStream:
+    """
+    1回のLLM呼び出しのストリーミングの状態
+    届いたトークンを溜めておき、前回の書き換えからinterval秒経つかmax_tokensトークン溜まったら書き換えどきと判断する
+    """
+    def __init__(self, interval: float, max_tokens: int):
+        self.interval = interval
+        self.max_tokens = max_tokens
+        self.tokens: List[str] = []
+        # 前回の書き換えから溜まったトークン数
+        self.pending = 0
+        # 最初に投稿したメッセージ（chat.updateに使うchannelとtsを持つ）
+        self.response = None
+        self.last_update = 0.0
+        # レートリミットに掛かった時に、Retry-Afterで指定された次に書き換えてよい時刻
+        self.next_allowed = 0.0
+
+    @property
+    def text(self) -> str:
+        return "".join(self.tokens)
+
+    def add(self, token: str) -> bool:
+        """トークンを溜め、メッセージを書き換えるべきならTrueを返す"""
+        self.tokens.append(token)
+        self.pending += 1
+        now = time.monotonic()
+        if now < self.next_allowed:
+            return False
+        return now - self.last_update >= self.interval or self.pending >= self.max_tokens
+
+    def flushed(self):
+        self.pending = 0
+        self.last_update = time.monotonic()
+
+    def rate_limited(self, error: SlackApiError) -> float:
+        """429のRetry-Afterの秒数だけ書き換えを止め、その秒数を返す"""
+        retry_after = float(error.response.headers.get("Retry-After", 1))
+        self.next_allowed = time.monotonic() + retry_after
+        return retry_after
+
+
+class SlackStreamingHandler(BaseCallbackHandler):
+    """
+    LLMの回答を1つのSlackのメッセージに流し込むコールバック
+    最初のトークンでsayでメッセージを投稿し、以降は同じメッセージをchat.updateで書き換える
+    書き換えはinterval秒ごとかmax_tokensトークンごとにまとめ、回答の完了時とエラー時には残りを必ず書き込む
+    1つのchainで複数回LLMを呼んでも混ざらないよう、状態はLLMの呼び出し（run_id）ごとに持つ
+    """
+    def __init__(self, say, client, interval: float = STREAM_UPDATE_INTERVAL, max_tokens: int = STREAM_UPDATE_TOKENS,
+                 prefix: str = ""):
+        # say: メッセージを投稿してレスポンス（channelとts）を返す関数、client: chat.updateを呼ぶWebClientかSlackOutbox
+        # prefix: 書き換えのたびにメッセージの先頭に付ける文字列（まとめて質問された時の質問の見出しなど）
+        self.say = say
+        self.client = client
+        self.prefix = prefix
+        self.interval = interval
+        self.max_tokens = max_tokens
+        self.streams: Dict[UUID, SlackStream] = {}
+        self.lock = threading.Lock()
+
+    def stream(self, run_id: UUID, pop: bool = False) -> SlackStream:
+        with self.lock:
+            stream = self.streams.setdefault(run_id, SlackStream(self.interval, self.max_tokens))
+            if pop:
+                del self.streams[run_id]
+        return stream
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> Any:
+        if not token:
+            return
+        stream = self.stream(run_id)
+        if stream.add(token):
+            self.write(stream, stream.text + STREAM_CURSOR)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> Any:
+        stream = self.stream(run_id, pop=True)
+        # LLMのキャッシュから返った場合はトークンが流れてこないので、結果の全文を書き込む
+        text = stream.text or response.generations[0][0].text
+        print(text)
+        self.write(stream, text, final=True)
+
+    def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], *, run_id: UUID, **kwargs: Any) -> Any:
+        stream = self.stream(run_id, pop=True)
+        if stream.response is not None or stream.tokens:
+            self.write(stream, stream.text + STREAM_ERROR_NOTE, final=True)
+
+    def write(self, stream: SlackStream, text: str, final: bool = False):
+        text = self.prefix + text
+        for _ in range(STREAM_FINAL_RETRIES if final else 1):
+            try:
+                if stream.response is None:
+                    stream.response = self.say(text)
+                else:
+                    self.client.chat_update(channel=stream.response["channel"], ts=stream.response["ts"], text=text)
+                stream.flushed()
+                return
+            except SlackApiError as e:
+                if e.response.status_code != 429:
+                    print(f"Error streaming to Slack: {e}")
+                    return
+                retry_after = stream.rate_limited(e)
+                # 途中経過は次の書き換えに回せば良いが、最後の書き込みは待ってでも届ける
+                if final:
+                    time.sleep(retry_after)
+
+
+class AsyncSlackStreamingHandler(AsyncCallbackHandler):
+    """SlackStreamingHandlerのAsyncApp版。sayとchat.updateをawaitするので、イベントループを止めない"""
+    def __init__(self, say, client, interval: float = STREAM_UPDATE_INTERVAL, max_tokens: int = STREAM_UPDATE_TOKENS,
+                 prefix: str = ""):
+        self.say = say
+        self.client = client
+        self.prefix = prefix
+        self.interval = interval
+        self.max_tokens = max_tokens
+        self.streams: Dict[UUID, SlackStream] = {}
+
+    def stream(self, run_id: UUID, pop: bool = False) -> SlackStream:
+        stream = self.streams.setdefault(run_id, SlackStream(self.interval, self.max_tokens))
+        if pop:
+            del self.streams[run_id]
+        return stream
 
-    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> Any:
-        pass
+    async def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        if not token:
+            return
+        stream = self.stream(run_id)
+        if stream.add(token):
+            await self.write(stream, stream.text + STREAM_CURSOR)
 
-    def on_llm_new_token(self, token: str, **kwargs: Any) -> Any:
-        if self.token_count < 100:
-            self.token_count += 1
-            self.content.append(token)
-        else:
-            self.token_count = 0
-            print("".join(self.content))
-            self.say("".join(self.content))
-            self.content = []
+    async def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        stream = self.stream(run_id, pop=True)
+        text = stream.text or response.generations[0][0].text
+        print(text)
+        await self.write(stream, text, final=True)
 
-    def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> Any:
-        """Run when LLM errors."""
+    async def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], *, run_id: UUID, **kwargs: Any) -> None:
+        stream = self.stream(run_id, pop=True)
+        if stream.response is not None or stream.tokens:
+            await self.write(stream, stream.text + STREAM_ERROR_NOTE, final=True)
 
-    def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any) -> Any:
-        print(f"on_chain_start {serialized['name']}")
+    async def write(self, stream: SlackStream, text: str, final: bool = False):
+        text = self.prefix + text
+        for _ in range(STREAM_FINAL_RETRIES if final else 1):
+            try:
+                if stream.response is None:
+                    stream.response = await self.say(text)
+                else:
+                    await self.client.chat_update(channel=stream.response["channel"], ts=stream.response["ts"], text=text)
+                stream.flushed()
+                return
+            except SlackApiError as e:
+                if e.response.status_code != 429:
+                    print(f"Error streaming to Slack: {e}")
+                    return
+                retry_after = stream.rate_limited(e)
+                if final:
+                    await asyncio.sleep(retry_after)
 
-    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> Any:
-        print(f"on_tool_start {serialized['name']}")
 
-    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
-        print(f"on_agent_action {action}")
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Return the tokenizer for a model. Loading it is slow, so it is cached."""
+    return tiktoken.encoding_for_model(model)
 
 
 def num_tokens(text: str, model: str) -> int:
     """Return the number of tokens in a string."""
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_encoding(model)
     return len(encoding.encode(text))
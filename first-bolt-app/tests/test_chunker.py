@@ -0,0 +1,46 @@
+import chunker
+import pytest
+from chunker import iter_chunks, split_page
+
+
+class ByteEncoding:
+    """1バイトを1トークンとみなすtiktokenの代わり（テストでトークナイザをダウンロードしない）"""
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+    def decode_bytes(self, tokens):
+        return bytes(tokens)
+
+
+@pytest.fixture(autouse=True)
+def byte_tokens(monkeypatch):
+    monkeypatch.setattr(chunker, "get_encoding", lambda model: ByteEncoding())
+    monkeypatch.setattr(chunker, "num_tokens", lambda text, model: len(text.encode("utf-8")))
+
+
+def test_short_page_is_a_single_chunk():
+    chunks = split_page("short page", 3, max_tokens=20, overlap=5)
+    assert [(chunk.page_number, chunk.text) for chunk in chunks] == [(3, "short page")]
+
+
+def test_blank_page_has_no_chunks():
+    assert split_page(" \n\t", 1) == []
+
+
+def test_long_page_is_split_with_overlap():
+    text = "abcdefghijklmnopqrstuvwxyz"
+    chunks = split_page(text, 7, max_tokens=10, overlap=3)
+    assert [chunk.text for chunk in chunks] == ["abcdefghij", "hijklmnopq", "opqrstuvwx", "vwxyz"]
+    assert all(chunk.page_number == 7 for chunk in chunks)
+
+
+def test_drops_characters_cut_at_chunk_boundaries():
+    # 「あ」などは3バイトなので、4トークンごとに切ると文字の途中で切れる
+    chunks = split_page("あいうえお", 1, max_tokens=4, overlap=0)
+    assert len(chunks) == 4
+    assert all(len(chunk.text.encode("utf-8")) <= 4 and chunk.text in "あいうえお" for chunk in chunks)
+
+
+def test_iter_chunks_numbers_pages_from_one():
+    chunks = list(iter_chunks(["first", "", "third"], max_tokens=20, overlap=5))
+    assert [(chunk.page_number, chunk.text) for chunk in chunks] == [(1, "first"), (3, "third")]
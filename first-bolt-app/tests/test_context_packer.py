@@ -0,0 +1,34 @@
+import context_packer
+import pytest
+from context_packer import SEPARATOR, context_budget, pack_context
+
+
+@pytest.fixture(autouse=True)
+def char_tokens(monkeypatch):
+    # 1文字を1トークンとみなす（テストでトークナイザをダウンロードしない）
+    monkeypatch.setattr(context_packer, "num_tokens", lambda text, model: len(text))
+
+
+def test_packs_passages_in_order_until_budget():
+    packed = pack_context(["a" * 10, "b" * 10, "c" * 10], budget=2 * (10 + len(SEPARATOR)), model="gpt-3.5-turbo")
+    assert packed.text == SEPARATOR + "a" * 10 + SEPARATOR + "b" * 10
+    assert packed.packed_ranks == [0, 1]
+    assert (packed.n_packed, packed.n_candidates) == (2, 3)
+    assert packed.used_tokens == packed.budget
+
+
+def test_skips_passages_that_do_not_fit():
+    # 2番目は大きすぎるので飛ばし、3番目の短いチャンクで残りを埋める
+    packed = pack_context(["a" * 10, "b" * 100, "c" * 5], budget=30, model="gpt-3.5-turbo")
+    assert packed.packed_ranks == [0, 2]
+    assert packed.used_tokens <= 30
+
+
+def test_empty_budget_packs_nothing():
+    packed = pack_context(["a"], budget=0, model="gpt-3.5-turbo")
+    assert (packed.text, packed.n_packed, packed.used_tokens) == ("", 0, 0)
+
+
+def test_context_budget_leaves_room_for_prompt_and_answer():
+    assert context_budget("gpt-3.5-turbo-16k", prompt_tokens=384, answer_reserve=1000) == 16384 - 384 - 1000
+    assert context_budget("gpt-3.5-turbo", prompt_tokens=5000) == 0
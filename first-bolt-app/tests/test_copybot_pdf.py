@@ -0,0 +1,20 @@
+from copybot_pdf import split_numbered_questions
+
+
+def test_splits_numbered_questions():
+    text = "質問です\n1. 売上は？\n2) 費用は？\n（3）利益は？\nQ4: 来期は？\n⑤ 人数は？"
+    assert split_numbered_questions(text) == ["売上は？", "費用は？", "利益は？", "来期は？", "人数は？"]
+
+
+def test_accepts_full_width_numbers():
+    assert split_numbered_questions("１．売上は？\n２）費用は？") == ["売上は？", "費用は？"]
+
+
+def test_ignores_numbers_that_are_not_list_markers():
+    # 行頭の年や小数は番号ではない
+    assert split_numbered_questions("2023年の売上は？") == []
+    assert split_numbered_questions("1.5倍になった理由は？") == []
+
+
+def test_returns_empty_list_for_a_single_question():
+    assert split_numbered_questions("売上はいくらですか？") == []
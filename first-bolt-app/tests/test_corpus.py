@@ -0,0 +1,124 @@
+import json
+import os
+
+import faiss
+import numpy as np
+import pytest
+from corpus import CorpusManager
+from index_factory import build_index, normalize
+from index_store import CHANNELS_FILE, IndexStore, make_document_key
+from lexical_index import LexicalIndex
+from page_store import PageStore
+
+D = 8
+
+
+def vectors(n, seed):
+    return normalize(np.random.default_rng(seed).normal(size=(n, D)).astype("float32"))
+
+
+def document(name, n, seed):
+    """(キー, index, ページ情報, ベクトル, 転置インデックス)を作る"""
+    embedding_array = vectors(n, seed)
+    texts = [f"{name} chunk {i}" for i in range(n)]
+    return (make_document_key(name, f"{seed:016x}"), build_index(embedding_array), PageStore.from_texts(texts, range(1, n + 1)),
+            embedding_array, LexicalIndex.from_texts(texts))
+
+
+def add(corpus, channel, doc):
+    key, indexer, page_store, embedding_array, lexical_index = doc
+    corpus.add(channel, key, indexer, page_store, {}, embedding_array, lexical_index)
+
+
+@pytest.fixture
+def read_flags(monkeypatch):
+    """faiss.read_indexに渡されたフラグを記録する"""
+    flags = []
+    read_index = faiss.read_index
+
+    def recording_read_index(path, flag=0):
+        flags.append(flag)
+        return read_index(path, flag)
+    monkeypatch.setattr(faiss, "read_index", recording_read_index)
+    return flags
+
+
+def test_channel_search_merges_base_and_added_documents(tmp_path, read_flags):
+    corpus = CorpusManager(IndexStore(str(tmp_path)))
+    docs = [document("F1", 30, 0), document("F2", 20, 1)]
+    for doc in docs:
+        add(corpus, "C1", doc)
+    queries = vectors(5, 99)
+    corpus.search_many("C1", queries, k=5)
+    channel_index = corpus.channel_indexes["C1"]
+    # 最初のドキュメントのindexはメモリマップのまま使い、2つ目からはメモリ上のdeltaに追加する
+    assert channel_index.mmapped and read_flags == [faiss.IO_FLAG_MMAP]
+    assert channel_index.delta.indexer.ntotal == 20
+    # チャンネルのindexができた後に投稿されたドキュメントもdeltaに追加される
+    docs.append(document("F3", 10, 2))
+    add(corpus, "C1", docs[-1])
+    assert channel_index.delta.indexer.ntotal == 30
+    assert channel_index.memory_bytes == 30 * D * 4
+
+    # 全ドキュメントのベクトルを1つのindexに入れて総当たりで探した結果と一致する
+    exact = faiss.IndexFlatIP(D)
+    exact.add(np.vstack([doc[3] for doc in docs]))
+    names = [(doc[0], i) for doc in docs for i in range(len(doc[3]))]
+    distances, idx = exact.search(queries, 5)
+    for rows, row_distances, row_idx in zip(corpus.search_many("C1", queries, k=5), distances, idx):
+        assert [(row.document, row.index) for row in rows] == [names[i] for i in row_idx]
+        np.testing.assert_allclose([row.distance for row in rows], row_distances, rtol=1e-5)
+
+
+def test_channel_index_without_store_uses_the_document_index():
+    corpus = CorpusManager()
+    add(corpus, "C1", document("F1", 10, 0))
+    add(corpus, "C1", document("F2", 10, 1))
+    rows = corpus.search("C1", vectors(1, 99), k=20)
+    assert len(rows) == 20
+    assert not corpus.channel_indexes["C1"].mmapped
+
+
+def test_evicts_least_recently_used_documents_over_budget(tmp_path, capsys):
+    corpus = CorpusManager(IndexStore(str(tmp_path)), memory_budget=0)
+    docs = [document(f"F{i}", 10, i) for i in range(3)]
+    for doc in docs:
+        add(corpus, "C1", doc)
+    # 予算を超えても、最後に使ったドキュメントだけは残す
+    assert list(corpus.resident) == [("C1", docs[2][0])]
+    assert "メモリから追い出しました" in capsys.readouterr().out
+    # 追い出したドキュメントは質問された時にディスクから読み込み直す
+    assert corpus.get("C1", docs[0][0]).page_store.text(0) == "F0 chunk 0"
+    assert list(corpus.resident) == [("C1", docs[2][0]), ("C1", docs[0][0])]
+
+
+def test_evicts_least_recently_used_channel_indexes_over_budget(tmp_path):
+    corpus = CorpusManager(IndexStore(str(tmp_path)), memory_budget=1)
+    add(corpus, "C1", document("F1", 10, 0))
+    add(corpus, "C1", document("F2", 10, 1))
+    add(corpus, "C2", document("F3", 10, 2))
+    add(corpus, "C2", document("F4", 10, 3))
+    corpus.search("C1", vectors(1, 99))
+    corpus.search("C2", vectors(1, 99))
+    assert list(corpus.channel_indexes) == ["C2"]
+    # 追い出されたチャンネルのindexは次の質問で作り直す
+    assert len(corpus.search("C1", vectors(1, 99), k=20)) == 20
+
+
+def test_restores_channels_after_restart(tmp_path):
+    store = IndexStore(str(tmp_path))
+    corpus = CorpusManager(store)
+    docs = [document("F1", 10, 0), document("F2", 10, 1)]
+    for doc in docs:
+        add(corpus, "C1", doc)
+    with open(os.path.join(str(tmp_path), CHANNELS_FILE)) as f:
+        assert json.load(f) == {"C1": [docs[0][0], docs[1][0]]}
+    # 保存されていないドキュメントのキーは引き継がない
+    store.save_channels({"C1": [docs[0][0], docs[1][0], "missing"]})
+
+    restarted = CorpusManager(IndexStore(str(tmp_path)))
+    assert restarted.document_keys("C1") == [docs[0][0], docs[1][0]]
+    assert restarted.resident == {}
+    rows = restarted.search("C1", docs[1][3][:1], k=1)
+    assert (rows[0].document, rows[0].index) == (docs[1][0], 0)
+    assert [row.document for row in restarted.lexical_search("C1", "F2 chunk 4", k=1)] == [docs[1][0]]
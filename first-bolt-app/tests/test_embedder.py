@@ -0,0 +1,118 @@
+import threading
+from collections import Counter
+
+import embedder
+import numpy as np
+import pytest
+from embedder import BatchEmbedder, TokenBucket, iter_batches
+from embedding_provider import EmbeddingProvider
+from openai.error import RateLimitError
+
+
+@pytest.fixture(autouse=True)
+def char_tokens(monkeypatch):
+    # 1文字を1トークンとみなす（テストでトークナイザをダウンロードしない）
+    monkeypatch.setattr(embedder, "num_tokens", lambda text, model: len(text))
+
+
+class FlakyProvider(EmbeddingProvider):
+    """テキストごとに、最初のfailures回は429を返してから長さを値にしたベクトルを返すプロバイダ"""
+    def __init__(self, failures=None):
+        self.failures = Counter(failures or {})
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def model(self):
+        return "flaky"
+
+    @property
+    def is_remote(self):
+        return False
+
+    def embed_batch(self, texts):
+        with self.lock:
+            for text in texts:
+                self.calls[text] += 1
+            if any(self.calls[text] <= self.failures[text] for text in texts):
+                raise RateLimitError("rate limited")
+        return [np.full(2, len(text), dtype="float32") for text in texts]
+
+
+def test_iter_batches_respects_token_and_size_limits():
+    texts = ["aaaa", "bbbb", "cc", "dddddddddddd", "e", "f", "g"]
+    batches = list(iter_batches(texts, max_batch_tokens=10, max_batch_size=2))
+    assert batches == [(0, ["aaaa", "bbbb"], 8), (2, ["cc"], 2), (3, ["dddddddddddd"], 12), (4, ["e", "f"], 2), (6, ["g"], 1)]
+
+
+def test_iter_batches_accepts_generators():
+    assert list(iter_batches(iter(["ab", "cd"]), max_batch_tokens=10)) == [(0, ["ab", "cd"], 4)]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket_waits_for_refill(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(embedder, "time", clock)
+    bucket = TokenBucket(per_minute=60)
+    bucket.acquire(60)
+    assert clock.sleeps == []
+    # 1秒に1トークンずつ補充されるので、空の状態から5トークンには5秒待つ
+    bucket.acquire(5)
+    assert clock.sleeps == [pytest.approx(5.0)]
+
+
+def test_token_bucket_caps_requests_at_capacity(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(embedder, "time", clock)
+    bucket = TokenBucket(per_minute=60)
+    # 容量を超える要求も、容量分だけ消費して通す
+    bucket.acquire(1000)
+    assert clock.sleeps == []
+    assert bucket.tokens == 0
+
+
+def test_embed_batch_with_retry_backs_off_on_rate_limit(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(embedder.time, "sleep", sleeps.append)
+    provider = FlakyProvider({"a": 2})
+    batch_embedder = BatchEmbedder(provider, max_retries=2, use_cache=False)
+    assert [float(v[0]) for v in batch_embedder.embed_batch_with_retry(["a"], 1)] == [1.0]
+    assert len(sleeps) == 2 and 1 <= sleeps[0] < 2 and 2 <= sleeps[1] < 3
+
+
+def test_embed_keeps_input_order_across_batches():
+    provider = FlakyProvider()
+    batch_embedder = BatchEmbedder(provider, max_batch_tokens=3, max_workers=4, use_cache=False)
+    texts = ["a", "bb", "ccc", "d", "ee"]
+    assert batch_embedder.embed(texts)[:, 0].tolist() == [1, 2, 3, 1, 2]
+
+
+def test_embed_stream_retries_failed_batches_in_later_rounds():
+    provider = FlakyProvider({"bb": 2})
+    batch_embedder = BatchEmbedder(provider, max_batch_tokens=2, max_retries=0, max_rounds=3, use_cache=False)
+    texts, embeddings = batch_embedder.embed_stream(["a", "bb", "c"])
+    assert texts == ["a", "bb", "c"]
+    assert embeddings[:, 0].tolist() == [1, 2, 1]
+    # 最後の周回で成功した結果も使われ、成功したバッチはやり直さない
+    assert provider.calls == {"a": 1, "bb": 3, "c": 1}
+
+
+def test_embed_stream_gives_up_after_max_rounds():
+    provider = FlakyProvider({"bb": 10})
+    batch_embedder = BatchEmbedder(provider, max_batch_tokens=2, max_retries=0, max_rounds=3, use_cache=False)
+    with pytest.raises(RuntimeError):
+        batch_embedder.embed_stream(["a", "bb"])
+    # 結果を受け取らない投げ直しはしない
+    assert provider.calls["bb"] == 3
@@ -0,0 +1,70 @@
+import sqlite3
+
+import embedding_cache
+import numpy as np
+import pytest
+from embedding_cache import EmbeddingCache, make_key, normalize_text
+
+
+class FakeClock:
+    """呼ばれるたびに1秒進む時計（LRUの順番がtime.timeの分解能に左右されないようにする）"""
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(embedding_cache, "time", clock)
+    return clock
+
+
+def vector(value):
+    return np.full(3, value, dtype="float32")
+
+
+def test_counts_hits_and_misses(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"))
+    cache.put_many("model", ["a", "b"], [vector(1), vector(2)])
+    found = cache.get_many("model", ["a", "c", "b"])
+    assert sorted(found) == [0, 2]
+    np.testing.assert_array_equal(found[2], vector(2))
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert cache.hit_ratio == pytest.approx(2 / 3)
+
+
+def test_key_is_model_and_normalized_text(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"))
+    cache.put_many("model-a", ["ＡＢＣ　１２３\n改行"], [vector(1)])
+    # 全角/半角と空白の揺れは同じキーになる
+    assert normalize_text("ＡＢＣ　１２３\n改行") == "ABC 123 改行"
+    assert make_key("model-a", "ABC 123  改行") == make_key("model-a", "ＡＢＣ　１２３\n改行")
+    assert list(cache.get_many("model-a", ["ABC 123 改行"])) == [0]
+    # モデルが違えばベクトルは比べられないので別のキーになる
+    assert cache.get_many("model-b", ["ABC 123 改行"]) == {}
+
+
+def test_evicts_least_recently_used_entries(tmp_path, clock):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    cache.put_many("model", ["a"], [vector(1)])
+    cache.put_many("model", ["b"], [vector(2)])
+    # aを参照したので、次に追い出されるのはb
+    cache.get_many("model", ["a"])
+    cache.put_many("model", ["c"], [vector(3)])
+    assert sorted(cache.get_many("model", ["a", "b", "c"])) == [0, 2]
+
+
+def test_reopens_existing_cache_in_wal_mode(tmp_path):
+    path = str(tmp_path / "nested" / "cache.sqlite3")
+    EmbeddingCache(path).put_many("model", ["a"], [vector(1)])
+    reopened = EmbeddingCache(path)
+    np.testing.assert_array_equal(reopened.get_many("model", ["a"])[0], vector(1))
+    (journal_mode,) = reopened.conn.execute("PRAGMA journal_mode").fetchone()
+    assert journal_mode == "wal"
+    # 別の接続（別のプロセス）からも同じファイルを読める
+    (count,) = sqlite3.connect(path).execute("SELECT COUNT(*) FROM embeddings").fetchone()
+    assert count == 1
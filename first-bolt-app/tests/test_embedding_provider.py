@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from embedding_provider import EmbeddingProvider, LocalEmbeddingProvider, OpenAIEmbeddingProvider, get_embedding_provider
+
+
+def test_provider_must_implement_the_interface():
+    class Incomplete(EmbeddingProvider):
+        model = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_local_provider_embeds_without_api():
+    provider = LocalEmbeddingProvider(dimension=32)
+    vectors = provider.embed_batch(["売上の推移", "費用の内訳", ""])
+    assert not provider.is_remote
+    assert provider.model == "local-hashing-262144-rp32-seed0"
+    assert [vector.shape for vector in vectors] == [(32,)] * 3
+    np.testing.assert_allclose(np.linalg.norm(vectors[0]), 1.0, rtol=1e-5)
+    assert not vectors[2].any()
+
+
+def test_local_provider_scores_similar_texts_higher():
+    provider = LocalEmbeddingProvider()
+    query, similar, unrelated = provider.embed_batch(
+        ["2023年度の売上高の推移", "2023年度の売上高は前年から増加した", "社員旅行の集合場所は東京駅です"])
+    assert query @ similar > query @ unrelated
+    # ランダム射影は入力の次元数と乱数シードだけで決まるので、別のインスタンスでも同じベクトルになる
+    np.testing.assert_allclose(LocalEmbeddingProvider().embed_batch(["2023年度の売上高の推移"])[0], query)
+
+
+def test_get_embedding_provider():
+    provider = get_embedding_provider("openai")
+    assert isinstance(provider, OpenAIEmbeddingProvider)
+    assert provider.is_remote and provider.model == "text-embedding-ada-002"
+    with pytest.raises(ValueError):
+        get_embedding_provider("unknown")
@@ -0,0 +1,69 @@
+import file_downloader
+import pytest
+import requests
+from file_downloader import FileTooLargeError, download_slack_file
+
+
+class FakeResponse:
+    def __init__(self, chunks, headers=None, error=None):
+        self.chunks = chunks
+        self.headers = headers or {}
+        self.error = error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+        if self.error is not None:
+            raise self.error
+
+
+@pytest.fixture
+def spooled_files(monkeypatch):
+    """作られたSpooledTemporaryFileを記録する"""
+    files = []
+    original = file_downloader.SpooledTemporaryFile
+
+    def spool(*args, **kwargs):
+        files.append(original(*args, **kwargs))
+        return files[-1]
+    monkeypatch.setattr(file_downloader, "SpooledTemporaryFile", spool)
+    return files
+
+
+def fake_get(monkeypatch, response, calls=None):
+    def get(url, **kwargs):
+        if calls is not None:
+            calls.append(kwargs)
+        return response
+    monkeypatch.setattr(file_downloader.session, "get", get)
+
+
+def test_downloads_with_timeout(monkeypatch, spooled_files):
+    calls = []
+    fake_get(monkeypatch, FakeResponse([b"abc", b"def"]), calls)
+    file, content_hash = download_slack_file("https://example.com/file", "token", timeout=(1, 2))
+    assert file.read() == b"abcdef"
+    assert len(content_hash) == 64
+    assert calls[0]["timeout"] == (1, 2)
+
+
+def test_closes_file_when_read_times_out(monkeypatch, spooled_files):
+    fake_get(monkeypatch, FakeResponse([b"abc"], error=requests.exceptions.ConnectionError("read timed out")))
+    with pytest.raises(requests.exceptions.ConnectionError):
+        download_slack_file("https://example.com/file", "token")
+    assert spooled_files[0].closed
+
+
+def test_closes_file_when_body_exceeds_limit(monkeypatch, spooled_files):
+    fake_get(monkeypatch, FakeResponse([b"a" * 6, b"b" * 6]))
+    with pytest.raises(FileTooLargeError):
+        download_slack_file("https://example.com/file", "token", max_bytes=10)
+    assert spooled_files[0].closed
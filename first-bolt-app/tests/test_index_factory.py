@@ -0,0 +1,111 @@
+import faiss
+import index_factory
+import numpy as np
+import pytest
+from index_factory import GrowingIndex, IndexSpec, build_index, index_kind, tune_search
+
+
+def clustered(n, d=16, center=0, seed=0):
+    """center番目の軸の周りに固まった正規化済みのベクトル"""
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(scale=0.3, size=(n, d)).astype("float32")
+    vectors[:, center] += 1.0
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+@pytest.fixture(autouse=True)
+def small_flat_limit(monkeypatch):
+    # 少ない件数でもIVFのまま試せるように、Flatを選ぶ件数の上限を下げる
+    monkeypatch.setattr(index_factory, "FLAT_MAX_VECTORS", 100)
+
+
+def ivf_index(vectors, nlist=8):
+    return build_index(vectors, spec=IndexSpec("ivf", vectors.shape[1], nlist=nlist))
+
+
+def test_adding_similar_vectors_does_not_rebuild():
+    growing = GrowingIndex(ivf_index(clustered(800)))
+    indexer = growing.indexer
+    growing.add(clustered(50, seed=1))
+    assert growing.indexer is indexer
+    assert growing.indexer.ntotal == 850
+
+
+def test_rebuilds_when_added_vectors_drift_from_centroids(capsys):
+    growing = GrowingIndex(ivf_index(clustered(800)))
+    indexer = growing.indexer
+    # 学習した時とは別の軸の周りのベクトルは、どの代表点からも遠い
+    growing.add(clustered(50, center=1, seed=1))
+    assert "drift=" in capsys.readouterr().out
+    assert growing.indexer is not indexer
+    assert growing.indexer.ntotal == 850
+
+
+def test_rebuilds_when_lists_become_imbalanced(capsys):
+    growing = GrowingIndex(ivf_index(clustered(800)))
+    indexer = growing.indexer
+    # 代表点そのものを大量に足すとdriftは小さいまま、1つの領域にだけ件数が偏る
+    centroid = faiss.extract_index_ivf(indexer).quantizer.reconstruct(0)
+    growing.add(np.tile(centroid, (3000, 1)))
+    assert "imbalance=" in capsys.readouterr().out
+    assert growing.indexer is not indexer
+    assert growing.indexer.ntotal == 3800
+
+
+def test_rebuilds_when_index_kind_changes(monkeypatch):
+    monkeypatch.setattr(index_factory, "FLAT_MAX_VECTORS", 500)
+    growing = GrowingIndex(build_index(clustered(400)))
+    assert growing.kind == "flat"
+    growing.add(clustered(200, seed=1))
+    assert growing.kind == "ivf"
+    assert index_kind(growing.indexer) == "ivf"
+    assert growing.indexer.ntotal == 600
+
+
+def spread(n, d=16, seed=0):
+    """偏りのない正規化済みのベクトル（近傍が多くの領域にまたがるのでnprobe=1では取りこぼす）"""
+    vectors = np.random.default_rng(seed).normal(size=(n, d)).astype("float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def recall(indexer, vectors, queries, k=10):
+    """調整に使っていないクエリで、総当たり探索に対するrecall@kを求める"""
+    exact = faiss.IndexFlatIP(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+    _, found = indexer.search(queries, k)
+    return np.mean([len(set(t) & set(f)) / k for t, f in zip(truth, found)])
+
+
+def test_tune_nprobe_reaches_target_recall():
+    vectors = spread(3000)
+    indexer = ivf_index(vectors, nlist=32)
+    assert recall(indexer, vectors, spread(200, seed=1)) < 0.95
+    tuning = tune_search(indexer, vectors, target_recall=0.95)
+    assert tuning.param == "nprobe" and tuning.nprobe > 1
+    assert tuning.curve[-1]["recall"] >= 0.95
+    # 選んだnprobeはindexに設定されていて、調整に使っていないクエリでも目標に近いrecallになる
+    assert faiss.extract_index_ivf(indexer).nprobe == tuning.nprobe
+    assert recall(indexer, vectors, spread(200, seed=1)) >= 0.9
+    # 評価の間だけ取り除いたベクトルは同じ行番号で戻っている
+    assert indexer.ntotal == 3000
+    assert list(indexer.search(vectors[:5], 1)[1][:, 0]) == [0, 1, 2, 3, 4]
+
+
+def test_tune_ef_search_reaches_target_recall():
+    vectors = spread(3000)
+    indexer = build_index(vectors, spec=IndexSpec("hnsw", 16, m=4))
+    tuning = tune_search(indexer, vectors, target_recall=0.95)
+    assert tuning.param == "efSearch"
+    assert tuning.curve[-1]["recall"] >= 0.95
+    assert faiss.downcast_index(indexer).hnsw.efSearch == tuning.ef_search
+    assert recall(indexer, vectors, spread(200, seed=1)) >= 0.9
+
+
+def test_tune_search_skips_flat_index():
+    vectors = spread(50)
+    indexer = build_index(vectors)
+    assert index_kind(indexer) == "flat"
+    assert tune_search(indexer, vectors) is None
@@ -0,0 +1,67 @@
+import os
+
+import faiss
+import numpy as np
+import pytest
+from index_factory import build_index, normalize
+from index_store import IndexStore, make_document_key
+from lexical_index import LexicalIndex
+from page_store import PageStore
+
+D = 8
+
+
+def vectors(n, seed):
+    return normalize(np.random.default_rng(seed).normal(size=(n, D)).astype("float32"))
+
+
+def document(name, n, seed):
+    """(キー, index, ページ情報, ベクトル, 転置インデックス)を作る"""
+    embedding_array = vectors(n, seed)
+    texts = [f"{name} chunk {i}" for i in range(n)]
+    return (make_document_key(name, f"{seed:016x}"), build_index(embedding_array), PageStore.from_texts(texts, range(1, n + 1)),
+            embedding_array, LexicalIndex.from_texts(texts))
+
+
+@pytest.fixture
+def read_flags(monkeypatch):
+    """faiss.read_indexに渡されたフラグを記録する"""
+    flags = []
+    read_index = faiss.read_index
+
+    def recording_read_index(path, flag=0):
+        flags.append(flag)
+        return read_index(path, flag)
+    monkeypatch.setattr(faiss, "read_index", recording_read_index)
+    return flags
+
+
+def test_index_store_round_trip(tmp_path, read_flags):
+    store = IndexStore(str(tmp_path))
+    key, indexer, page_store, embedding_array, lexical_index = document("F1", 20, 0)
+    store.save(key, indexer, page_store, {"storage": "float32"}, lexical_index)
+    assert store.exists(key)
+    loaded_index, loaded_pages = store.load(key)
+    # 保存したindexはメモリマップで読み込む
+    assert read_flags == [faiss.IO_FLAG_MMAP]
+    np.testing.assert_allclose(loaded_index.reconstruct_n(0, 20), embedding_array, rtol=1e-6)
+    assert [loaded_pages.text(i) for i in range(20)] == [page_store.text(i) for i in range(20)]
+    assert store.load_meta(key) == {"storage": "float32"}
+    assert list(store.load_lexical(key).search("chunk 3", 1)[1]) == [3]
+
+
+def test_index_store_save_is_atomic_and_keeps_the_first_copy(tmp_path):
+    store = IndexStore(str(tmp_path))
+    key, indexer, page_store, _, _ = document("F1", 20, 0)
+    store.save(key, indexer, page_store, {"version": 1})
+    # 同じキーで後から保存されたもの（別プロセスが同時に保存した場合）は捨てられ、書き込み途中の一時ディレクトリも残らない
+    store.save(key, indexer, page_store, {"version": 2})
+    assert store.load_meta(key) == {"version": 1}
+    assert os.listdir(str(tmp_path)) == [key]
+
+
+def test_index_store_ignores_missing_documents(tmp_path):
+    store = IndexStore(str(tmp_path))
+    assert not store.exists("missing")
+    assert store.load_meta("missing") == {}
+    assert store.load_channels() == {}
@@ -0,0 +1,113 @@
+import threading
+from types import SimpleNamespace
+
+import ingestion_queue
+import pytest
+from copybot_pdf import CoPyBotPDF
+from ingestion_queue import IngestionJob, IngestionQueue
+from slack_sdk.errors import SlackApiError
+
+
+class FakeClient:
+    """chat.postMessageとchat.updateの呼び出しを記録するWebClientの代わり"""
+    def __init__(self):
+        self.posted = []
+        self.updated = []
+
+    def chat_postMessage(self, channel, text):
+        self.posted.append((channel, text))
+        return {"ts": f"{len(self.posted)}.0"}
+
+    def chat_update(self, channel, ts, text):
+        self.updated.append((channel, ts, text))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ingestion_queue, "time", clock)
+    return clock
+
+
+def test_runs_jobs_in_submission_order():
+    client = FakeClient()
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def process(job):
+        if not order:
+            started.set()
+            release.wait(5)
+        order.append(job.event["id"])
+
+    queue = IngestionQueue(process, workers=1)
+    jobs = [queue.submit(IngestionJob(client, "C1", {"id": i})) for i in range(3)]
+    started.wait(5)
+    # ワーカーが1つなら、2件目からは順番待ちになることを知らせる
+    assert "待ち: 1件" in client.posted[1][1] and "待ち: 2件" in client.posted[2][1]
+    assert queue.pending("C1") == jobs
+    release.set()
+    queue.shutdown()
+    assert order == [0, 1, 2]
+    assert queue.pending("C1") == []
+
+
+def test_progress_updates_are_throttled(clock):
+    client = FakeClient()
+    job = IngestionJob(client, "C1", {})
+    job.post_status("ファイルを受け取ったよ。", is_progress=True)
+    # 前回の更新からPROGRESS_INTERVAL秒経つまでは、進捗を覚えておくだけでメッセージは書き換えない
+    job.report_progress(pages_parsed=1)
+    job.report_progress(pages_parsed=2, chunks_embedded=3)
+    assert client.updated == []
+    clock.now += ingestion_queue.PROGRESS_INTERVAL
+    job.report_progress(pages_parsed=4)
+    assert client.updated == [("C1", "1.0", "PDFを読み込み中だよ。parse: 4ページ / embedding: 3チャンク")]
+    # 完了のメッセージを書いた後は、遅れて届いた進捗で上書きしない
+    job.say("OK. 準備ができたよ。")
+    clock.now += ingestion_queue.PROGRESS_INTERVAL
+    job.report_progress(chunks_embedded=10)
+    assert client.updated[-1][2] == "OK. 準備ができたよ。"
+    assert len(client.posted) == 1
+
+
+def test_wait_for_channel():
+    client = FakeClient()
+    release = threading.Event()
+    queue = IngestionQueue(lambda job: release.wait(5), workers=2)
+    queue.submit(IngestionJob(client, "C1", {}))
+    # 他のチャンネルの読み込みは待たない
+    assert queue.wait_for_channel("C2", timeout=0)
+    assert not queue.wait_for_channel("C1", timeout=0.05)
+    release.set()
+    assert queue.wait_for_channel("C1", timeout=5)
+    queue.shutdown()
+
+
+def test_failed_job_reports_failure_status(capsys):
+    client = FakeClient()
+    error = SlackApiError("file_not_found", {"ok": False, "error": "file_not_found"})
+
+    class FailingClient:
+        def files_info(self, file):
+            raise error
+
+    # files.infoの失敗もprocess_file_shareの外まで伝わり、ジョブが失敗として終わる
+    bot = SimpleNamespace()
+    queue = IngestionQueue(lambda job: CoPyBotPDF.process_file_share(bot, job.event, job.say, FailingClient(), job))
+    job = queue.submit(IngestionJob(client, "C1", {"channel": "C1", "files": [{"id": "F1"}]}))
+    assert job.wait(5)
+    queue.shutdown()
+    assert job.error is error
+    assert client.updated[-1][2] == "ごめんね。PDFの読み込みに失敗しちゃった。もう一度投稿してみてね。"
+    assert "Error getting file info" in capsys.readouterr().out
+    assert queue.pending("C1") == []
@@ -0,0 +1,52 @@
+from lexical_index import CollectionStats, LexicalIndex, extract_exact_terms, reciprocal_rank_fusion
+from page_store import PageRow
+
+
+def test_extracts_identifiers_and_quoted_terms():
+    assert extract_exact_terms("型番ABC-123の「保守契約」について。") == ["保守契約", "abc-123"]
+    assert extract_exact_terms("バージョンはv2.1.0です.") == ["v2.1.0"]
+
+
+def test_plain_numbers_are_not_exact_terms():
+    assert extract_exact_terms("2023年10月の売上は？") == []
+
+
+def test_ranks_exact_match_first():
+    index = LexicalIndex.from_texts(["売上の推移について", "型番ABC-123の仕様", "型番ABC-456の仕様"])
+    scores, idx = index.search("ABC-123の仕様は？", k=3)
+    assert idx[0] == 1
+    assert list(scores) == sorted(scores, reverse=True)
+
+
+def test_collection_stats_make_scores_comparable_across_indexes():
+    texts = [f"ドキュメント{i}の本文" for i in range(20)] + ["型番ABC-123の仕様"]
+    combined = LexicalIndex.from_texts(texts)
+    parts = [LexicalIndex.from_texts(texts[:10]), LexicalIndex.from_texts(texts[10:])]
+    query = "ABC-123の仕様"
+    stats = CollectionStats.from_indexes(parts, query)
+    assert stats.n_docs == len(texts)
+    expected_scores, expected_idx = combined.search(query, k=3)
+    scores, idx = parts[1].search(query, k=3, stats=stats)
+    assert idx[0] + 10 == expected_idx[0]
+    assert abs(scores[0] - expected_scores[0]) < 1e-4
+
+
+def test_save_and_load(tmp_path):
+    index = LexicalIndex.from_texts(["売上の推移", "費用の内訳"])
+    index.save(str(tmp_path))
+    loaded = LexicalIndex.load(str(tmp_path))
+    assert LexicalIndex.exists(str(tmp_path))
+    assert list(loaded.search("費用", k=1)[1]) == [1]
+
+
+def test_reciprocal_rank_fusion_favours_rows_ranked_by_both():
+    a, b, c = (PageRow(page_number=i, text=str(i), document="doc", index=i) for i in range(3))
+    fused = reciprocal_rank_fusion([[a, b], [b, c]], k=60)
+    assert [row.index for row in fused] == [1, 0, 2]
+    assert fused[0].distance == 1 / 62 + 1 / 61
+
+
+def test_reciprocal_rank_fusion_keeps_documents_apart():
+    a = PageRow(page_number=1, text="a", document="doc1", index=0)
+    b = PageRow(page_number=1, text="b", document="doc2", index=0)
+    assert len(reciprocal_rank_fusion([[a], [b]])) == 2
@@ -0,0 +1,140 @@
+import importlib.util
+import os
+from typing import Any, Mapping
+
+import langchain
+import llm_cache
+import pytest
+from langchain.chat_models import ChatOpenAI
+from langchain.llms.fake import FakeListLLM
+from langchain.schema import Generation
+from llm_cache import LLMResponseCache, bypass_llm_cache, install_llm_cache, make_key, parse_llm_string
+
+
+class FakeLLM(FakeListLLM):
+    """APIを呼ばずにresponsesを順番に返すLLM。キャッシュのキーに使うモデル名とtemperatureを持つ"""
+    model_name: str = "fake-model"
+    temperature: float = 0
+
+    @property
+    def _identifying_params(self) -> Mapping[str, Any]:
+        return {"model_name": self.model_name, "temperature": self.temperature}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_cache, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = LLMResponseCache(path=str(tmp_path / "llm.sqlite3"))
+    monkeypatch.setattr(langchain, "llm_cache", cache)
+    return cache
+
+
+def llm_string(**kwargs):
+    params = {"model_name": "gpt-3.5-turbo", "temperature": 0, "openai_api_key": "sk-test", **kwargs}
+    return ChatOpenAI(**params)._get_llm_string()
+
+
+def test_parses_model_temperature_and_params():
+    model, temperature, params = parse_llm_string(llm_string(max_tokens=100, streaming=True))
+    assert (model, temperature) == ("gpt-3.5-turbo", 0.0)
+    # APIキーやstreamingは回答の中身に影響しないのでキーに含めない
+    assert params == {"_type": "langchain.chat_models.openai.ChatOpenAI", "max_tokens": 100, "stop": None}
+
+
+def test_key_depends_on_model_temperature_params_and_prompt():
+    key = make_key(*parse_llm_string(llm_string()), "質問")
+    assert key == make_key(*parse_llm_string(llm_string(streaming=True, openai_api_key="sk-other")), "質問")
+    assert key != make_key(*parse_llm_string(llm_string(model_name="gpt-4")), "質問")
+    assert key != make_key(*parse_llm_string(llm_string(temperature=0.5)), "質問")
+    assert key != make_key(*parse_llm_string(llm_string(max_tokens=100)), "質問")
+    assert key != make_key(*parse_llm_string(llm_string()), "別の質問")
+
+
+def test_round_trip_through_langchain(cache):
+    llm = FakeLLM(responses=["1回目の回答", "2回目の回答", "3回目の回答"])
+    assert llm("質問") == "1回目の回答"
+    # 同じプロンプトならLLMを呼ばずにキャッシュの回答を返す
+    assert llm("質問") == "1回目の回答"
+    assert llm("別の質問") == "2回目の回答"
+    # モデル名が違えば別のキーになる
+    assert FakeLLM(responses=["他のモデルの回答"], model_name="other-model")("質問") == "他のモデルの回答"
+    assert (cache.hits, cache.misses, len(cache)) == (1, 3, 3)
+
+
+def test_does_not_cache_sampled_responses(cache):
+    llm = FakeLLM(responses=["1回目の回答", "2回目の回答"], temperature=0.7)
+    assert [llm("質問"), llm("質問")] == ["1回目の回答", "2回目の回答"]
+    assert len(cache) == 0
+
+
+def test_expires_after_ttl(tmp_path, clock):
+    cache = LLMResponseCache(path=str(tmp_path / "llm.sqlite3"), ttl=60)
+    cache.update("質問", llm_string(), [Generation(text="回答")])
+    clock.now += 60
+    assert cache.lookup("質問", llm_string())[0].text == "回答"
+    clock.now += 1
+    assert cache.lookup("質問", llm_string()) is None
+    assert len(cache) == 0
+
+
+def test_evicts_least_recently_used_over_max_entries(tmp_path, clock):
+    cache = LLMResponseCache(path=str(tmp_path / "llm.sqlite3"), max_entries=2)
+    for prompt in ("A", "B"):
+        clock.now += 1
+        cache.update(prompt, llm_string(), [Generation(text=prompt)])
+    # Aを参照すると、Bの方が古くなる
+    clock.now += 1
+    cache.lookup("A", llm_string())
+    clock.now += 1
+    cache.update("C", llm_string(), [Generation(text="C")])
+    assert len(cache) == 2
+    assert cache.lookup("B", llm_string()) is None
+    assert [cache.lookup(prompt, llm_string())[0].text for prompt in ("A", "C")] == ["A", "C"]
+
+
+def test_bypass_context_skips_lookup_but_updates(cache):
+    llm = FakeLLM(responses=["1回目の回答", "2回目の回答"])
+    assert llm("質問") == "1回目の回答"
+    with bypass_llm_cache():
+        assert llm("質問") == "2回目の回答"
+    # ブロックの外では、ブロックの中で作った新しい回答を返す
+    assert llm("質問") == "2回目の回答"
+
+
+def test_bypass_env_var(tmp_path, monkeypatch):
+    monkeypatch.setenv("LLM_CACHE_BYPASS", "1")
+    # 環境変数はimport時に読むので、別の名前で読み込み直す
+    spec = importlib.util.spec_from_file_location("llm_cache_bypassed", llm_cache.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    cache = module.LLMResponseCache(path=str(tmp_path / "llm.sqlite3"))
+    assert cache.bypass
+    cache.update("質問", llm_string(), [Generation(text="回答")])
+    assert cache.lookup("質問", llm_string()) is None
+    assert len(cache) == 1
+
+
+def test_install_llm_cache_is_idempotent(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(langchain, "llm_cache", None)
+    cache = install_llm_cache()
+    assert langchain.llm_cache is cache
+    assert install_llm_cache() is cache
+    # 明示的に渡したキャッシュは差し替える
+    other = LLMResponseCache(path=str(tmp_path / "other.sqlite3"))
+    assert install_llm_cache(other) is other and langchain.llm_cache is other
+    assert os.path.exists(tmp_path / ".cache" / "llm_responses.sqlite3")
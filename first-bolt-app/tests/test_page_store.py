@@ -0,0 +1,29 @@
+import numpy as np
+from page_store import PageStore
+
+
+def test_save_and_load_round_trip(tmp_path):
+    texts = ["1ページ目", "", "3ページ目 with ASCII"]
+    page_store = PageStore.from_texts(texts, [1, 2, 3])
+    page_store.embeddings = np.eye(3, 4, dtype="float32")
+    page_store.save(str(tmp_path))
+
+    loaded = PageStore.load(str(tmp_path))
+    assert len(loaded) == 3
+    assert [loaded.text(i) for i in range(3)] == texts
+    assert list(loaded.page_numbers) == [1, 2, 3]
+    np.testing.assert_array_equal(loaded.embeddings, page_store.embeddings)
+    # メモリマップで読み込んだembeddingsはメモリの使用量に数えない
+    assert loaded.nbytes == page_store.nbytes - page_store.embeddings.nbytes
+
+
+def test_load_without_embeddings(tmp_path):
+    PageStore.from_texts(["a"], [1]).save(str(tmp_path))
+    assert PageStore.load(str(tmp_path)).embeddings is None
+
+
+def test_rows_skip_missing_results():
+    page_store = PageStore.from_texts(["a", "b"], [10, 20])
+    rows = page_store.rows([1, -1], [0.5, 0.0], "doc")
+    assert len(rows) == 1
+    assert (rows[0].page_number, rows[0].text, rows[0].distance, rows[0].document, rows[0].index) == (20, "b", 0.5, "doc", 1)
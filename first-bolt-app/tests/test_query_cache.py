@@ -0,0 +1,36 @@
+import query_cache
+from query_cache import TTLCache
+
+
+def test_evicts_least_recently_used(monkeypatch):
+    cache = TTLCache("test", max_entries=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    # aを参照したので、次に追い出されるのはb
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_expires_entries_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(query_cache.time, "monotonic", lambda: now[0])
+    cache = TTLCache("test", max_entries=10, ttl=60)
+    cache.put("a", 1)
+    now[0] += 60
+    assert cache.get("a") == 1
+    now[0] += 61
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_counts_hits_and_misses():
+    cache = TTLCache("test", max_entries=10, ttl=60)
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("b")
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.hit_ratio == 0.5
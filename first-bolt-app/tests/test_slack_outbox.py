@@ -0,0 +1,219 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+import slack_outbox
+from slack_outbox import OUTBOX_MAX_RETRIES, AsyncSlackOutbox, SlackOutbox
+from slack_sdk.errors import SlackApiError
+
+
+class FakeClient:
+    """呼ばれたAPIを記録するWebClientの代わり。rate_limitedに入れた回数だけ429を返す"""
+    def __init__(self, rate_limited=0, retry_after="0"):
+        self.calls = []
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+
+    def call(self, method, **kwargs):
+        with self.lock:
+            if self.rate_limited:
+                self.rate_limited -= 1
+                response = SimpleNamespace(status_code=429, headers={"Retry-After": self.retry_after})
+                raise SlackApiError("ratelimited", response)
+            self.calls.append((method, kwargs))
+            return {"ok": True, "channel": kwargs["channel"], "ts": f"{len(self.calls)}.0"}
+
+    def chat_postMessage(self, **kwargs):
+        return self.call("chat.postMessage", **kwargs)
+
+    def chat_update(self, **kwargs):
+        return self.call("chat.update", **kwargs)
+
+
+def manual_outbox(client):
+    # 送信スレッドを起動せず、drainで送信するので送る順番が決まる
+    return SlackOutbox(client, channel_interval=0, rate_limits={}, senders=0)
+
+
+def drain(outbox):
+    while True:
+        message, _ = outbox.take()
+        if message is None:
+            return
+        outbox.send(message)
+
+
+def test_merges_adjacent_progress_posts():
+    client = FakeClient()
+    outbox = manual_outbox(client)
+    first = outbox.chat_postMessage(channel="C1", text="読み込んでいます", progress=True)
+    second = outbox.chat_postMessage(channel="C1", text="回答を考えています", progress=True)
+    outbox.chat_postMessage(channel="C1", text="回答です")
+    drain(outbox)
+    assert first is second
+    assert [kwargs["text"] for _, kwargs in client.calls] == ["読み込んでいます\n回答を考えています", "回答です"]
+
+
+def test_does_not_merge_progress_into_other_threads_or_blocks():
+    client = FakeClient()
+    outbox = manual_outbox(client)
+    outbox.chat_postMessage(channel="C1", text="a", progress=True)
+    outbox.chat_postMessage(channel="C1", text="b", thread_ts="1.0", progress=True)
+    outbox.chat_postMessage(channel="C1", text="c", blocks=[], progress=True)
+    drain(outbox)
+    assert [kwargs["text"] for _, kwargs in client.calls] == ["a", "b", "c"]
+
+
+def test_coalesces_updates_and_resolves_pending_ts():
+    client = FakeClient()
+    outbox = manual_outbox(client)
+    posted = outbox.chat_postMessage(channel="C1", text="途中")
+    outbox.chat_update(channel="C1", ts=posted["ts"], text="途中まで")
+    outbox.chat_update(channel="C1", ts=posted["ts"], text="完成")
+    drain(outbox)
+    assert client.calls == [("chat.postMessage", {"channel": "C1", "text": "途中"}),
+                            ("chat.update", {"channel": "C1", "ts": "1.0", "text": "完成"})]
+    assert posted["ts"] == "1.0"
+
+
+def test_retries_after_rate_limit_in_order():
+    client = FakeClient(rate_limited=2)
+    outbox = manual_outbox(client)
+    first = outbox.chat_postMessage(channel="C1", text="1")
+    outbox.chat_postMessage(channel="C1", text="2")
+    drain(outbox)
+    assert first.retries == 2
+    assert [kwargs["text"] for _, kwargs in client.calls] == ["1", "2"]
+
+
+def test_waits_for_retry_after_before_sending_again():
+    client = FakeClient(rate_limited=1, retry_after="30")
+    outbox = manual_outbox(client)
+    message = outbox.chat_postMessage(channel="C1", text="1")
+    drain(outbox)
+    # Retry-Afterの間はこのチャンネルに送らない
+    assert client.calls == []
+    assert not message.done()
+    _, wait = outbox.take()
+    assert 0 < wait <= 30
+
+
+def test_gives_up_after_max_retries():
+    client = FakeClient(rate_limited=100)
+    outbox = manual_outbox(client)
+    message = outbox.chat_postMessage(channel="C1", text="1")
+    while not message.done():
+        with outbox.cond:
+            for queue in outbox.channels.values():
+                queue.retry_at = 0.0
+        drain(outbox)
+    assert isinstance(message.exception(), SlackApiError)
+
+
+def test_keeps_order_within_each_channel_with_many_senders():
+    client = FakeClient()
+    outbox = SlackOutbox(client, channel_interval=0, rate_limits={}, senders=4)
+    for i in range(20):
+        for channel in ("C1", "C2", "C3"):
+            outbox.chat_postMessage(channel=channel, text=str(i))
+    assert outbox.flush(timeout=10)
+    outbox.close(timeout=10)
+    for channel in ("C1", "C2", "C3"):
+        texts = [kwargs["text"] for _, kwargs in client.calls if kwargs["channel"] == channel]
+        assert texts == [str(i) for i in range(20)]
+
+
+def test_wrapped_say_posts_to_the_same_channel_and_thread():
+    client = FakeClient()
+    outbox = manual_outbox(client)
+    say = outbox.wrap(SimpleNamespace(channel="C1", thread_ts="9.0"))
+    say({"text": "こんにちは", "blocks": []})
+    drain(outbox)
+    assert client.calls == [("chat.postMessage", {"channel": "C1", "text": "こんにちは", "blocks": [], "thread_ts": "9.0"})]
+
+
+class AsyncFakeClient(FakeClient):
+    """AsyncWebClientの代わり"""
+    async def chat_postMessage(self, **kwargs):
+        return self.call("chat.postMessage", **kwargs)
+
+    async def chat_update(self, **kwargs):
+        return self.call("chat.update", **kwargs)
+
+
+class FakeClock:
+    """time.monotonicとasyncio.sleepの代わり。時刻は進めず、sleepで待とうとした秒数を記録する"""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        # 他のコルーチンにも順番を回す
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(slack_outbox, "time", clock)
+    monkeypatch.setattr(slack_outbox, "asyncio", SimpleNamespace(Lock=asyncio.Lock, sleep=clock.sleep))
+    return clock
+
+
+def test_async_outbox_paces_posts_per_channel(clock):
+    client = AsyncFakeClient()
+    outbox = AsyncSlackOutbox(client, channel_interval=1.0, rate_limits={})
+
+    async def run():
+        await asyncio.gather(*(outbox.chat_postMessage(channel="C1", text=str(i)) for i in range(3)),
+                             outbox.chat_postMessage(channel="C2", text="0"))
+
+    asyncio.run(run())
+    # 同じチャンネルには1秒ずつ空けて順番に投稿し、他のチャンネルへの投稿は待たせない
+    assert sorted(clock.sleeps) == [1.0, 2.0]
+    assert [kwargs["text"] for _, kwargs in client.calls if kwargs["channel"] == "C1"] == ["0", "1", "2"]
+    assert len(client.calls) == 4
+
+
+def test_async_outbox_limits_tier_methods_across_channels(clock):
+    client = AsyncFakeClient()
+    outbox = AsyncSlackOutbox(client, channel_interval=0, rate_limits={"chat.update": 30})
+
+    async def run():
+        await asyncio.gather(*(outbox.chat_update(channel=channel, ts="1.0", text="a") for channel in ("C1", "C2", "C3")))
+
+    asyncio.run(run())
+    # 1分あたり30回までなので、チャンネルが違っても2秒ずつ空ける
+    assert sorted(clock.sleeps) == [2.0, 4.0]
+    assert len(client.calls) == 3
+
+
+def test_async_outbox_retries_after_rate_limit(clock):
+    client = AsyncFakeClient(rate_limited=2, retry_after="5")
+    outbox = AsyncSlackOutbox(client, channel_interval=0, rate_limits={})
+    response = asyncio.run(outbox.chat_postMessage(channel="C1", text="1"))
+    assert response["ts"] == "1.0"
+    assert clock.sleeps == [5.0, 5.0]
+
+
+def test_async_outbox_gives_up_after_max_retries(clock):
+    client = AsyncFakeClient(rate_limited=100)
+    outbox = AsyncSlackOutbox(client, channel_interval=0, rate_limits={})
+    with pytest.raises(SlackApiError):
+        asyncio.run(outbox.chat_postMessage(channel="C1", text="1"))
+    assert client.rate_limited == 100 - (OUTBOX_MAX_RETRIES + 1)
+
+
+def test_async_wrapped_say_posts_to_the_same_channel_and_thread(clock):
+    client = AsyncFakeClient()
+    outbox = AsyncSlackOutbox(client, channel_interval=0, rate_limits={})
+    say = outbox.wrap(SimpleNamespace(channel="C1", thread_ts="9.0"))
+    response = asyncio.run(say({"text": "こんにちは", "blocks": []}, progress=True))
+    assert response["ts"] == "1.0"
+    assert client.calls == [("chat.postMessage", {"channel": "C1", "text": "こんにちは", "blocks": [], "thread_ts": "9.0"})]
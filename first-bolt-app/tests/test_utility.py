@@ -0,0 +1,164 @@
+import asyncio
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+import utility
+from langchain.schema import Generation, LLMResult
+from slack_sdk.errors import SlackApiError
+from utility import STREAM_CURSOR, STREAM_ERROR_NOTE, AsyncSlackStreamingHandler, SlackStreamingHandler
+
+
+class FakeClock:
+    """time.monotonicとtime.sleepの代わり。sleepは待たずに時刻を進めて、待った秒数を記録する"""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def rate_limited(retry_after):
+    return SlackApiError("ratelimited", SimpleNamespace(status_code=429, headers={"Retry-After": str(retry_after)}))
+
+
+class FakeSlack:
+    """sayとchat.updateの呼び出しを記録する。errorsに積んだ例外は、次のchat.updateで1つずつ投げる"""
+    def __init__(self):
+        self.said = []
+        self.updates = []
+        self.errors = []
+
+    def say(self, text):
+        self.said.append(text)
+        return {"channel": "C1", "ts": f"{len(self.said)}.0"}
+
+    def chat_update(self, channel, ts, text):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.updates.append((ts, text))
+
+
+class AsyncFakeSlack(FakeSlack):
+    async def say(self, text):
+        return FakeSlack.say(self, text)
+
+    async def chat_update(self, channel, ts, text):
+        return FakeSlack.chat_update(self, channel, ts, text)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(utility, "time", clock)
+
+    async def sleep(seconds):
+        clock.sleep(seconds)
+    monkeypatch.setattr(utility, "asyncio", SimpleNamespace(sleep=sleep))
+    return clock
+
+
+def result(text):
+    return LLMResult(generations=[[Generation(text=text)]])
+
+
+def test_coalesces_tokens_by_interval_and_count(clock):
+    slack = FakeSlack()
+    handler = SlackStreamingHandler(slack.say, slack, interval=1.0, max_tokens=3)
+    run_id = uuid4()
+    # 最初のトークンで投稿し、以降は間隔かトークン数が溜まるまで書き換えない
+    handler.on_llm_new_token("a", run_id=run_id)
+    handler.on_llm_new_token("b", run_id=run_id)
+    handler.on_llm_new_token("c", run_id=run_id)
+    assert slack.said == ["a" + STREAM_CURSOR] and slack.updates == []
+    handler.on_llm_new_token("d", run_id=run_id)
+    assert slack.updates == [("1.0", "abcd" + STREAM_CURSOR)]
+    clock.now += 1.0
+    handler.on_llm_new_token("e", run_id=run_id)
+    assert slack.updates[-1] == ("1.0", "abcde" + STREAM_CURSOR)
+    # 完了時は溜まっている分をカーソル無しで必ず書き込む
+    handler.on_llm_new_token("f", run_id=run_id)
+    handler.on_llm_end(result("abcdef"), run_id=run_id)
+    assert slack.updates[-1] == ("1.0", "abcdef")
+    assert handler.streams == {}
+
+
+def test_keeps_a_message_per_run_id(clock):
+    slack = FakeSlack()
+    handler = SlackStreamingHandler(slack.say, slack, prefix="Q: ")
+    first, second = uuid4(), uuid4()
+    handler.on_llm_new_token("1つ目", run_id=first)
+    handler.on_llm_new_token("2つ目", run_id=second)
+    handler.on_llm_end(result("1つ目"), run_id=first)
+    handler.on_llm_end(result("2つ目"), run_id=second)
+    assert slack.said == ["Q: 1つ目" + STREAM_CURSOR, "Q: 2つ目" + STREAM_CURSOR]
+    assert slack.updates == [("1.0", "Q: 1つ目"), ("2.0", "Q: 2つ目")]
+
+
+def test_writes_cached_response_without_tokens(clock):
+    slack = FakeSlack()
+    handler = SlackStreamingHandler(slack.say, slack)
+    # LLMのキャッシュから返るとトークンが流れてこないので、結果の全文を投稿する
+    handler.on_llm_end(result("キャッシュの回答"), run_id=uuid4())
+    assert slack.said == ["キャッシュの回答"]
+
+
+def test_flushes_partial_answer_on_error(clock):
+    slack = FakeSlack()
+    handler = SlackStreamingHandler(slack.say, slack)
+    run_id = uuid4()
+    handler.on_llm_new_token("途中", run_id=run_id)
+    handler.on_llm_new_token("まで", run_id=run_id)
+    handler.on_llm_error(RuntimeError("boom"), run_id=run_id)
+    assert slack.updates == [("1.0", "途中まで" + STREAM_ERROR_NOTE)]
+    # 何も投稿していなければエラーの時も何も書かない
+    handler.on_llm_error(RuntimeError("boom"), run_id=uuid4())
+    assert len(slack.said) == 1
+
+
+def test_waits_for_retry_after_when_rate_limited(clock):
+    slack = FakeSlack()
+    handler = SlackStreamingHandler(slack.say, slack, interval=1.0, max_tokens=100)
+    run_id = uuid4()
+    handler.on_llm_new_token("a", run_id=run_id)
+    clock.now += 1.0
+    # 途中経過の書き換えが429になったら、Retry-Afterの間は書き換えずにトークンを溜める
+    slack.errors = [rate_limited(5)]
+    handler.on_llm_new_token("b", run_id=run_id)
+    clock.now += 4.0
+    handler.on_llm_new_token("c", run_id=run_id)
+    assert slack.updates == [] and clock.sleeps == []
+    clock.now += 1.0
+    handler.on_llm_new_token("d", run_id=run_id)
+    assert slack.updates == [("1.0", "abcd" + STREAM_CURSOR)]
+    # 最後の書き込みは、Retry-Afterだけ待ってから書き直す
+    slack.errors = [rate_limited(2)]
+    handler.on_llm_end(result("abcd"), run_id=run_id)
+    assert clock.sleeps == [2.0]
+    assert slack.updates[-1] == ("1.0", "abcd")
+
+
+def test_async_handler_streams_and_retries(clock):
+    slack = AsyncFakeSlack()
+    handler = AsyncSlackStreamingHandler(slack.say, slack, interval=1.0, max_tokens=2)
+    first, second = uuid4(), uuid4()
+
+    async def run():
+        await handler.on_llm_new_token("a", run_id=first)
+        await handler.on_llm_new_token("x", run_id=second)
+        await handler.on_llm_new_token("b", run_id=first)
+        await handler.on_llm_new_token("c", run_id=first)
+        slack.errors = [rate_limited(3)]
+        await handler.on_llm_end(result("abc"), run_id=first)
+        await handler.on_llm_error(RuntimeError("boom"), run_id=second)
+
+    asyncio.run(run())
+    assert slack.said == ["a" + STREAM_CURSOR, "x" + STREAM_CURSOR]
+    assert slack.updates == [("1.0", "abc" + STREAM_CURSOR), ("1.0", "abc"), ("2.0", "x" + STREAM_ERROR_NOTE)]
+    assert clock.sleeps == [3.0]
+    assert handler.streams == {}
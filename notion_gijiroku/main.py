@@ -1,4 +1,5 @@
 import os
+import sys
 
 import notion
 
@@ -6,6 +7,12 @@ from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from dotenv import load_dotenv
 
+# LLMのキャッシュとSlackの送信キューはfirst-bolt-app/srcのものを共有して使う（srcはパッケージになっていないので、パスを通す）
+# srcにも同名のnotion.pyがあるので、notion_gijirokuのモジュールが優先されるように末尾に追加する
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "first-bolt-app", "src"))
+from llm_cache import install_llm_cache
+from slack_outbox import SlackOutbox
+
 # GPT-3.5-turbo
 from langchain.chat_models import ChatOpenAI
 from langchain import LLMChain
@@ -31,6 +38,8 @@ load_dotenv()
 
 # ボットトークンとソケットモードハンドラーを使ってアプリを初期化します
 app = App(token=os.environ.get("SLACK_BOT_TOKEN"))
+# 投稿はキューに積んで別スレッドでレートリミットに合わせて送るので、続けて投稿しても429のリトライでリスナーが止まらない
+outbox = SlackOutbox(app.client)
 
 # モデル作成
 # わかりやすい解説
@@ -83,6 +92,7 @@ select_block = [
 
 @app.event("app_mention")
 def mention_handler(body, say):
+    say = outbox.wrap(say)
     # メンションの内容を取得
     mention_text = body["event"]["text"]
     if "マンスリーレビューをまとめてください" in mention_text:
@@ -100,9 +110,10 @@ def mention_handler(body, say):
 def action_button_click(body, ack, say):
     # アクションを確認したことを即時で応答します
     ack()
+    say = outbox.wrap(say)
     # セレクトボックスで選択した値を取得
     selected = body["state"]["values"]["gijiroku_select"]["gijiroku_select_option"]["selected_option"]["text"]["text"]
-    say(text=selected + "の議事録を取得しています。")
+    say(text=selected + "の議事録を取得しています。", progress=True)
 
     # 議事録取得
     raw_gijiroku = notion.Gijiroku().gijiroku_contents(selected)
@@ -118,7 +129,7 @@ def action_button_click(body, ack, say):
     """
     say(text=msg)
 
-    say(text="議事録の内容をまとめています。")
+    say(text="議事録の内容をまとめています。", progress=True)
 
     # chatGPTに投げるメッセージ
     gpt_text = f"""
@@ -134,6 +145,8 @@ def action_button_click(body, ack, say):
 
 # アプリを起動します
 if __name__ == "__main__":
+    # temperature=0の同じプロンプトへの回答は、APIを呼ばずにSQLiteのキャッシュから返す
+    install_llm_cache()
     mention_text = (
         "-困ったときは学習が目的というところに立ち返って、学習に最適な進め方を行う。-たとえば、プロダクトの締め切りに追われたとしても、リソース効率が落ちるからという理由でモブプログラミングを軽視しない。プロダクトを作ることが目的にならないように注意を払う。-モブプロにおいては、実装を実際に行う時間と、いったん立ち止まって情報の整理や質疑応答を行う時間に分けて運用すると学習効果が高まります。"
     )
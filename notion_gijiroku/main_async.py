@@ -0,0 +1,141 @@
+# main.pyのAsyncApp版
+# Notion・LLM・Slackの呼び出しを全てawaitするので、議事録の要約を待つ間も他のメンションに応答できる
+
+import asyncio
+import os
+import sys
+
+import notion
+
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from dotenv import load_dotenv
+
+# LLMのキャッシュとSlackの送信キューはfirst-bolt-app/srcのものを共有して使う（srcはパッケージになっていないので、パスを通す）
+# srcにも同名のnotion.pyがあるので、notion_gijirokuのモジュールが優先されるように末尾に追加する
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "first-bolt-app", "src"))
+from llm_cache import install_llm_cache
+from slack_outbox import AsyncSlackOutbox
+
+# GPT-3.5-turbo
+from langchain.chat_models import ChatOpenAI
+from langchain import LLMChain
+from langchain.prompts.chat import (
+    ChatPromptTemplate,
+    # System メッセージテンプレート
+    SystemMessagePromptTemplate,
+    # user メッセージテンプレート
+    HumanMessagePromptTemplate,
+)
+
+# 環境変数を設定
+load_dotenv()
+
+# ボットトークンとソケットモードハンドラーを使ってアプリを初期化します
+app = AsyncApp(token=os.environ.get("SLACK_BOT_TOKEN"))
+# 投稿はチャンネルごとのレートリミットに合わせて送り、429が返ったらRetry-Afterだけ待って送り直す
+outbox = AsyncSlackOutbox(app.client)
+
+# モデル作成
+llm = ChatOpenAI(temperature=0, openai_api_key=os.environ.get("OPENAI_API_KEY"), model_name="gpt-3.5-turbo")
+
+# 日本語で ChatGPT っぽく丁寧に説明させる
+system_message_prompt = SystemMessagePromptTemplate.from_template("You are an assistant who thinks step by step and includes a thought path in your response. Your answers are in Japanese.")
+# ユーザーからの入力
+human_template = (
+    "{text}" + "-困ったときは学習が目的というところに立ち返って、学習に最適な進め方を行う。-たとえば、プロダクトの締め切りに追われたとしても、リソース効率が落ちるからという理由でモブプログラミングを軽視しない。プロダクトを作ることが目的にならないように注意を払う。-モブプロにおいては、実装を実際に行う時間と、いったん立ち止まって情報の整理や質疑応答を行う時間に分けて運用すると学習効果が高まります。"
+)
+
+# User role のテンプレートに
+human_message_prompt = HumanMessagePromptTemplate.from_template(human_template)
+
+# ひとつのChatTemplateに
+chat_prompt = ChatPromptTemplate.from_messages([system_message_prompt, human_message_prompt])
+chat_prompt.input_variables = ["text"]
+
+# カスタムプロンプトを入れてchain 化
+chain = LLMChain(llm=llm, prompt=chat_prompt)
+
+ym_select = {"2023年5月": "2023-05", "2023年6月": "2023-06", "2023年7月": "2023-07"}
+
+options = []
+for k, v in ym_select.items():
+    options.append({"text": {"type": "plain_text", "text": k}, "value": v})
+
+select_block = [
+    {
+        "type": "section",
+        "block_id": "monthly_select",
+        "text": {"type": "mrkdwn", "text": "どの月のマンスリーレビューをまとめますか？"},
+        "accessory": {
+            "action_id": "monthly_select_option",
+            "type": "static_select",
+            "placeholder": {"type": "plain_text", "text": "Select an item"},
+            "options": options,
+        },
+    }
+]
+
+
+@app.event("app_mention")
+async def mention_handler(body, say):
+    say = outbox.wrap(say)
+    # メンションの内容を取得
+    mention_text = body["event"]["text"]
+    if "マンスリーレビューをまとめてください" in mention_text:
+        await say(blocks=select_block)
+        # セレクトボックスを出したら終了
+        return
+    elif "Notionの議事録をまとめてください" in mention_text:
+        await say(blocks=await notion.AsyncGijiroku().gijiroku_select_block())
+        return
+    # LLMを動作させてチャンネルで発言
+    await say(await chain.arun(text=mention_text))
+
+
+@app.action("gijiroku_select_option")
+async def action_button_click(body, ack, say):
+    # アクションを確認したことを即時で応答します
+    await ack()
+    say = outbox.wrap(say)
+    # セレクトボックスで選択した値を取得
+    selected = body["state"]["values"]["gijiroku_select"]["gijiroku_select_option"]["selected_option"]["text"]["text"]
+    await say(text=selected + "の議事録を取得しています。")
+
+    # 議事録取得
+    raw_gijiroku = await notion.AsyncGijiroku().gijiroku_contents(selected)
+    if not raw_gijiroku:
+        await say(text="議事録が取得できませんでした。対象月を変更してください。")
+        return
+
+    msg = f"""
+    Notionから取得した議事録の内容はこちらです。
+    =============================================
+    {raw_gijiroku}
+    =============================================
+    """
+    await say(text=msg)
+
+    await say(text="議事録の内容をまとめています。")
+
+    # chatGPTに投げるメッセージ
+    gpt_text = f"""
+    次の文章を要約してください。
+    ----------------------------------
+    {raw_gijiroku}
+    """
+    # チャンネルにメッセージを投稿します
+    output = await chain.arun(text=gpt_text)
+    await say(text=f"======================== {selected}の議事録の要約 ========================")
+    await say(output)
+
+
+async def main():
+    await AsyncSocketModeHandler(app, os.environ["SLACK_APP_TOKEN"]).start_async()
+
+
+# アプリを起動します
+if __name__ == "__main__":
+    # temperature=0の同じプロンプトへの回答は、APIを呼ばずにSQLiteのキャッシュから返す
+    install_llm_cache()
+    asyncio.run(main())
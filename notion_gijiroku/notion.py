@@ -1,5 +1,7 @@
+import asyncio
 import os
 import re
+from notion_client import AsyncClient as AsyncNotionClient
 from notion_client import Client as NotionClient
 from notion_client.api_endpoints import BlocksChildrenEndpoint
 
@@ -17,7 +19,10 @@ class Gijiroku:
     # 「第○○回...」の一覧を取得
     def gijiroku_list(self):
         gijiroku = self.endpoint.list(self.gijiroku_page_id)
+        return self._parse_gijiroku_list(gijiroku)
 
+    # 議事録ページのblock一覧から「第○○回...」と日付の辞書を作る
+    def _parse_gijiroku_list(self, gijiroku):
         pattern = '\d{4}-\d{2}-\d{2}'
         dict = {}
         for block in gijiroku["results"]:
@@ -34,10 +39,12 @@ class Gijiroku:
 
     # 「議事録をまとめてください」のセレクトボックス用のblockを返す
     def gijiroku_select_block(self):
-        gijiroku_options = []
-
         # 「第○○回...」の一覧を取得
-        for k, v in self.gijiroku_list().items():
+        return self._gijiroku_select_block(self.gijiroku_list())
+
+    def _gijiroku_select_block(self, gijiroku_list):
+        gijiroku_options = []
+        for k, v in gijiroku_list.items():
             gijiroku_options.append({"text": {"type": "plain_text", "text": k}, "value": v})
 
         return [
@@ -94,3 +101,51 @@ class Gijiroku:
                 if rich_text:
                     # 全角スペースを削除
                     return rich_text[0]["plain_text"].replace("\u3000", " ")
+
+
+# NotionのAsyncClientで議事録を取得するAsyncApp用のクラス
+# 子blockの取得はblockごとに1リクエストかかるので、兄弟のblockの子要素は並行して取得する
+class AsyncGijiroku(Gijiroku):
+    def __init__(self):
+        self.notion_client = AsyncNotionClient(auth=os.environ.get("NOTION_API_KEY"), timeout_ms=900_00)
+        self.gijiroku_page_id = "0d1661a7710c4bc892b590b5df7faea9"
+
+    # blockの子要素の一覧を取得
+    async def _list_children(self, block_id):
+        return (await self.notion_client.blocks.children.list(block_id))["results"]
+
+    # 「第○○回...」の一覧を取得
+    async def gijiroku_list(self):
+        return self._parse_gijiroku_list({"results": await self._list_children(self.gijiroku_page_id)})
+
+    # 「議事録をまとめてください」のセレクトボックス用のblockを返す
+    async def gijiroku_select_block(self):
+        return self._gijiroku_select_block(await self.gijiroku_list())
+
+    # 議事メモの内容を取得する
+    # 引数は取得対象の回
+    async def gijiroku_contents(self, target):
+        body = []
+        for block in await self._list_children(self.gijiroku_page_id):
+            if block.get("heading_1"):
+                if target in self._get_text_from_heading(block, "1"):
+                    for block2 in await self._list_children(block["id"]):
+                        if "議事メモ" in self._get_text_from_heading(block2, "2"):
+                            body.extend(await self._get_texts_recursively(block2))
+        return body
+
+    # 自要素のplain_textと、子要素のplain_textを再帰的に取得して順番通りに並べたリストを返す
+    # 子要素を持つblockの取得は並行して行う（gatherは渡した順番のまま結果を返す）
+    async def _get_texts_recursively(self, block):
+        contents = await self._list_children(block["id"])
+        children = await asyncio.gather(
+            *(self._get_texts_recursively(content) for content in contents if content["has_children"]))
+        children = iter(children)
+        body = []
+        for content in contents:
+            txt = self._get_text_from_list_item(content)
+            if txt:
+                body.append(txt)
+            if content["has_children"]:
+                body.extend(next(children))
+        return body